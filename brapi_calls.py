@@ -0,0 +1,143 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+# Location of the on disk caches (calls index, ...) shared by successive runs
+CACHE_DIR = os.environ.get('BRAPI2ISA_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'brapi2isa'))
+# Time (in seconds) a discovered calls index stays valid
+CALLS_TTL = 24 * 3600
+
+
+def _normalize_call(call: str) -> str:
+    return call.strip().strip('/')
+
+
+def _cache_file(endpoint: str) -> str:
+    digest = hashlib.sha1(endpoint.encode('utf-8')).hexdigest()
+    return os.path.join(CACHE_DIR, 'calls', digest + '.json')
+
+
+class CallsIndex:
+    """ Calls (with their methods and versions) supported by a BrAPI endpoint
+
+    The index is discovered once per endpoint by paging through `/calls` (or `/serverinfo` on BrAPI v2),
+    kept in memory for every client of the same endpoint and persisted on disk for CALLS_TTL seconds.
+    """
+
+    _registry = {}
+    _locks = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(self, endpoint: str, calls: dict, fetched: float = None):
+        self.endpoint = endpoint
+        self.calls = calls
+        self.fetched = fetched or time.time()
+
+    @classmethod
+    def for_client(cls, client, ttl: int = None) -> 'CallsIndex':
+        """
+        Return the calls index of the client endpoint, discovering it if needed
+        :param client BrapiClient used for the discovery requests
+        :param ttl maximum age (in seconds) of a persisted index, CALLS_TTL by default
+        """
+        ttl = CALLS_TTL if ttl is None else ttl
+        with cls._registry_lock:
+            lock = cls._locks.setdefault(client.endpoint, threading.Lock())
+        # one discovery per endpoint, other endpoints are not blocked meanwhile
+        with lock:
+            index = cls._registry.get(client.endpoint)
+            if index is None or index.expired(ttl):
+                index = cls.load(client.endpoint, ttl, client.logger)
+                if index is None:
+                    index = cls.discover(client)
+                    index.save(client.logger)
+                cls._registry[client.endpoint] = index
+            return index
+
+    @classmethod
+    def clear(cls):
+        """Forget the in memory indexes (persisted indexes are kept)"""
+        with cls._registry_lock:
+            cls._registry.clear()
+
+    @classmethod
+    def discover(cls, client) -> 'CallsIndex':
+        """Page through the calls advertised by the client endpoint"""
+        calls = {}
+        if is_brapi_v2(client.endpoint):
+            client.logger.debug("Discovering calls of %s through serverinfo", client.endpoint)
+            services = client.fetch_object('/serverinfo').get('calls') or []
+        else:
+            client.logger.debug("Discovering calls of %s through calls", client.endpoint)
+            services = client.fetch_objects('GET', '/calls')
+        for service in services:
+            call = _normalize_call(service.get('call') or service.get('service') or '')
+            if not call:
+                continue
+            entry = calls.setdefault(call, {'methods': [], 'versions': []})
+            for key in ('methods', 'versions'):
+                for value in service.get(key) or []:
+                    if value not in entry[key]:
+                        entry[key].append(value)
+        client.logger.debug("Endpoint %s supports %d calls", client.endpoint, len(calls))
+        return cls(client.endpoint, calls)
+
+    @classmethod
+    def load(cls, endpoint: str, ttl: int, logger: logging.Logger = None):
+        """Return the persisted index of an endpoint, None when missing or older than ttl"""
+        try:
+            with open(_cache_file(endpoint), 'r', encoding='utf-8') as fh:
+                cached = json.load(fh)
+        except (OSError, ValueError):
+            return None
+        if cached.get('endpoint') != endpoint:
+            return None
+        index = cls(endpoint, cached.get('calls', {}), cached.get('fetched'))
+        if index.expired(ttl):
+            return None
+        if logger:
+            logger.debug("Using cached calls index for %s", endpoint)
+        return index
+
+    def save(self, logger: logging.Logger = None):
+        path = _cache_file(self.endpoint)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + '.' + str(os.getpid())
+            with open(tmp_path, 'w', encoding='utf-8') as fh:
+                json.dump({'endpoint': self.endpoint, 'fetched': self.fetched, 'calls': self.calls}, fh)
+            os.replace(tmp_path, path)
+        except OSError as oserror:
+            # the index is still usable in memory
+            if logger:
+                logger.warning("Could not persist calls index: %s", oserror)
+
+    def expired(self, ttl: int) -> bool:
+        return time.time() - self.fetched > ttl
+
+    @property
+    def empty(self) -> bool:
+        return not self.calls
+
+    def supports(self, call: str, method: str = None, version: str = None) -> bool:
+        """
+        Test if a call is advertised by the endpoint
+        :param call BrAPI call (ex 'studies/{studyDbId}/observationunits'), the comparison is case sensitive
+        :param method if provided, the HTTP method must be listed for the call
+        :param version if provided, the BrAPI version must be listed for the call
+        """
+        entry = self.calls.get(_normalize_call(call))
+        if entry is None:
+            return False
+        if method and entry['methods'] and method.upper() not in (m.upper() for m in entry['methods']):
+            return False
+        if version and entry['versions'] and version not in entry['versions']:
+            return False
+        return True
+
+
+def is_brapi_v2(endpoint: str) -> bool:
+    return '/v2' in endpoint.rstrip('/').lower().rsplit('/brapi', 1)[-1]
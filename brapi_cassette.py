@@ -0,0 +1,123 @@
+import hashlib
+import io
+import json
+import mmap
+import os
+import threading
+import zlib
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+DATA_FILE = 'cassette.dat'
+INDEX_FILE = 'cassette.idx'
+# Response headers worth replaying
+KEPT_HEADERS = ('Content-Type', 'Retry-After')
+
+
+def request_key(method: str, url: str, params=None, data=None, json_body=None) -> str:
+    """Identify a request by its method, canonical URL (sorted query) and body"""
+    if isinstance(params, dict):
+        params = sorted(params.items())
+    prepared = requests.Request(method.upper(), url, params=params, data=data, json=json_body).prepare()
+    body = prepared.body or b''
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    digest = hashlib.sha1(prepared.method.encode('utf-8') + b' ' + prepared.url.encode('utf-8') + b'\n' + body)
+    return digest.hexdigest()
+
+
+class CassetteResponse:
+    """Response replayed from a cassette, offering the parts of requests.Response used by the client"""
+
+    def __init__(self, url: str, status_code: int, content: bytes, headers: dict = None):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.headers = CaseInsensitiveDict(headers or {})
+        self.raw = io.BytesIO(content)
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code < 400
+
+    def json(self):
+        return json.loads(self.content)
+
+    def close(self):
+        pass
+
+    def __repr__(self):
+        return f'<Response [{self.status_code}]>'
+
+
+class Cassette:
+    """ Compact store of the HTTP responses of a BrAPI conversion
+
+    Response bodies are appended zlib compressed to a single data file, a JSON lines index maps the request
+    keys to their offset in that file. When replaying, the index is loaded once and bodies are read from
+    the memory mapped data file.
+    """
+
+    def __init__(self, directory: str, mode: str):
+        if mode not in ('record', 'replay'):
+            raise ValueError(f"Unknown cassette mode: {mode}")
+        self.directory = directory
+        self.mode = mode
+        self.index = {}
+        self._lock = threading.Lock()
+        self._data = None
+        self._data_fh = None
+        self._index_fh = None
+        if mode == 'record':
+            os.makedirs(directory, exist_ok=True)
+            self._data_fh = open(os.path.join(directory, DATA_FILE), 'ab')
+            self._index_fh = open(os.path.join(directory, INDEX_FILE), 'a', encoding='utf-8')
+        else:
+            self._load()
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode == 'replay'
+
+    def _load(self):
+        index_path = os.path.join(self.directory, INDEX_FILE)
+        if not os.path.exists(index_path):
+            raise RuntimeError(f"No cassette found in {self.directory}")
+        with open(index_path, 'r', encoding='utf-8') as fh:
+            for line in fh:
+                if line.strip():
+                    entry = json.loads(line)
+                    # the last recording of a request wins
+                    self.index[entry['key']] = entry
+        with open(os.path.join(self.directory, DATA_FILE), 'rb') as fh:
+            if os.fstat(fh.fileno()).st_size:
+                self._data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def record(self, key: str, response) -> CassetteResponse:
+        """Store a live response, return a replayable copy of it (the live body is consumed)"""
+        content = response.content
+        headers = {name: response.headers[name] for name in KEPT_HEADERS if name in response.headers}
+        compressed = zlib.compress(content)
+        with self._lock:
+            offset = self._data_fh.tell()
+            self._data_fh.write(compressed)
+            self._data_fh.flush()
+            entry = {'key': key, 'url': response.url, 'status': response.status_code, 'headers': headers,
+                     'offset': offset, 'length': len(compressed)}
+            self._index_fh.write(json.dumps(entry) + '\n')
+            self._index_fh.flush()
+            self.index[key] = entry
+        return CassetteResponse(response.url, response.status_code, content, headers)
+
+    def replay(self, key: str, url: str) -> CassetteResponse:
+        entry = self.index.get(key)
+        if entry is None:
+            raise RuntimeError(f"No recorded response for {url} in cassette {self.directory}")
+        content = zlib.decompress(self._data[entry['offset']:entry['offset'] + entry['length']])
+        return CassetteResponse(entry['url'], entry['status'], content, entry['headers'])
+
+    def close(self):
+        for fh in (self._data_fh, self._index_fh, self._data):
+            if fh is not None:
+                fh.close()
@@ -1,30 +1,187 @@
-import json
 import logging
 from collections.abc import Iterable
 from typing import List
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
+import os
 import time
 import re
-from cachetools import cached, LRUCache, TTLCache
+import queue
+import threading
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+
+from brapi_calls import CallsIndex, is_brapi_v2
+from brapi_cassette import Cassette, request_key
+from brapi_json import BrapiPage, loads
+from brapi_logging import sampled
+from brapi_metrics import ClientMetrics, call_type
+from brapi_paging import AdaptivePager, parse_retry_after
+from brapi_ratelimit import HedgePolicy, RateLimiter
+from brapi_shared_cache import SharedCache
 
 
 def url_path_join(*args):
     """Join path(s) in URL using slashes"""
     return '/'.join(s.strip('/') for s in args)
 
+# BrAPI v2 asynchronous searches: polling of the results and concurrency of search_many
+SEARCH_POLL_INTERVAL = 1
+SEARCH_MAX_POLL_INTERVAL = 30
+SEARCH_TIMEOUT = 600
+SEARCH_WORKERS = 8
+# Objects buffered by each search of search_many ahead of their consumer
+SEARCH_BUFFER = 2000
+# Requests per second sent to an endpoint by all the processes of the host, and latency percentile after which a GET
+# is hedged, when not given to the client (see brapi_ratelimit)
+RATE_LIMIT = float(os.environ.get('BRAPI2ISA_RATE_LIMIT') or 0) or None
+HEDGE_PERCENTILE = float(os.environ.get('BRAPI2ISA_HEDGE') or 0) or None
+# Threads sending the hedged requests of a client
+HEDGE_WORKERS = 16
+# File of the cache of germplasm, taxon ids, ontologies and calls decisions shared by the worker processes of a
+# run, when not given to the client (see brapi_shared_cache)
+SHARED_CACHE_FILE = os.environ.get('BRAPI2ISA_SHARED_CACHE') or None
+_END = object()
+
+
+def _timestamp(value):
+    """Parse an ISO 8601 observation time stamp, naive time stamps are taken as UTC"""
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except (ValueError, AttributeError):
+        return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def filter_observations(obs_units: Iterable, start: str = None, end: str = None, level: str = None,
+                        variable_ids: List[str] = None) -> Iterable:
+    """Keep the observations of the units matching the filters of get_study_observations, drop the units left empty"""
+    start_time, end_time = _timestamp(start), _timestamp(end)
+    for obs_unit in obs_units:
+        if level and obs_unit.get('observationLevel') and obs_unit['observationLevel'].lower() != level.lower():
+            continue
+        observations = []
+        for observation in obs_unit.get('observations') or []:
+            if variable_ids and observation.get('observationVariableDbId') not in variable_ids:
+                continue
+            if start_time or end_time:
+                time_stamp = _timestamp(observation.get('observationTimeStamp'))
+                if time_stamp is None or (start_time and time_stamp < start_time) \
+                        or (end_time and time_stamp > end_time):
+                    continue
+            observations.append(observation)
+        if observations:
+            yield dict(obs_unit, observations=observations)
+
+
+class IdentityMap:
+    """ Run-scoped map of the BrAPI objects fetched by a client, by URL path
+
+    An object is fetched once per run: later requests are served from the map, and requests made while the
+    object is being fetched wait for that call instead of sending their own (single flight). Failed calls are
+    not kept, the next request tries again.
+    """
+
+    def __init__(self, on_saved=None):
+        """:param on_saved called with the path of each request served by the map"""
+        self.on_saved = on_saved
+        self._objects = {}
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self.sent = Counter()
+        self.saved = Counter()
+        self.coalesced = Counter()
+
+    @staticmethod
+    def kind(path: str) -> str:
+        """Entity of a path, for the report (ex 'studies', 'germplasm', 'studies/variables')"""
+        parts = path.split('?')[0].strip('/').split('/')
+        return '/'.join(parts[0::2])
+
+    def get(self, path: str, fetch):
+        """Return the object of path, calling fetch() unless it is already fetched or being fetched"""
+        kind = self.kind(path)
+        with self._lock:
+            stored = path in self._objects
+            flight = self._in_flight.get(path)
+            leader = not stored and flight is None
+            if stored:
+                self.saved[kind] += 1
+            elif leader:
+                flight = self._in_flight[path] = Future()
+                self.sent[kind] += 1
+            else:
+                self.saved[kind] += 1
+                self.coalesced[kind] += 1
+        if not leader:
+            if self.on_saved is not None:
+                self.on_saved(path)
+            return self._objects[path] if stored else flight.result()
+        try:
+            obj = fetch()
+        except Exception as e:
+            with self._lock:
+                del self._in_flight[path]
+            flight.set_exception(e)
+            raise
+        with self._lock:
+            self._objects[path] = obj
+            del self._in_flight[path]
+        flight.set_result(obj)
+        return obj
+
+    def report(self) -> dict:
+        """Requests sent and saved (served from the map, of which coalesced with an in-flight call) by entity"""
+        with self._lock:
+            return {kind: {'sent': self.sent[kind], 'saved': self.saved[kind], 'coalesced': self.coalesced[kind]}
+                    for kind in sorted(set(self.sent) | set(self.saved))}
+
 
 class BrapiClient:
     """ Provide methods to the BRAPI
+
+    With `record` (or `replay`) set to a directory, every HTTP response is stored in (or served from)
+    a cassette in that directory, allowing offline and deterministic runs.
+    With `rate_limit`, the requests to the endpoint of every process of the host share a token bucket of
+    rate_limit requests per second. With `hedge`, GET requests slower than this percentile of the latency of their
+    call are sent twice and the first response wins, see HedgePolicy. Neither applies to replayed requests, and
+    recorded requests are not hedged.
+    With `shared_cache` set to a file, the germplasm, taxon ids, ontologies registry and calls decisions are looked
+    up in and added to a SharedCache used by the other worker processes of the run (not with a cassette).
     """
 
-    def __init__(self, endpoint: str, logger: logging.Logger):
+    def __init__(self, endpoint: str, logger: logging.Logger, record: str = None, replay: str = None,
+                 rate_limit: float = None, hedge: float = None, shared_cache: str = None):
         self.endpoint = endpoint
         self.logger = logger
         self.obs_unit_call = " "
         self.obs_var_call = " "
         self.taxon = {}
+        self.session = self._create_session()
+        if record and replay:
+            raise ValueError("A client can not record and replay at the same time")
+        self.cassette = None
+        if record:
+            self.cassette = Cassette(record, 'record')
+        elif replay:
+            self.cassette = Cassette(replay, 'replay')
+        self._calls_index = None
+        # results of prefetch_studies, consumed once by the per study methods
+        self._prefetched = {}
+        # called with the path and the number of objects of every page read by fetch_objects
+        self.on_page = None
+        rate_limit = rate_limit or RATE_LIMIT
+        self.rate_limiter = RateLimiter.for_endpoint(endpoint, rate_limit) if rate_limit else None
+        hedge = hedge or HEDGE_PERCENTILE
+        self.hedging = HedgePolicy(hedge) if hedge and self.cassette is None else None
+        self._hedge_executor = None
+        shared_cache = shared_cache or SHARED_CACHE_FILE
+        self.shared_cache = SharedCache.for_path(shared_cache) if shared_cache and self.cassette is None else None
+        self.begin_run()
 
     # def get_phenotypes(self) -> Iterable:
     #     """Returns a phenotype information from a BrAPI endpoint."""
@@ -41,51 +198,66 @@ class BrapiClient:
 
     def get_study_germplasms(self, study_id: str) -> Iterable:
         """"Given a BRAPI study identifier returns an array of germplasm objects"""
+        prefetched = self._prefetched.pop(('germplasm', study_id), None)
+        if prefetched is not None:
+            yield from prefetched
+            return
         yield from self.fetch_objects('GET', f'/studies/{study_id}/germplasm')
 
 
+    def calls_index(self) -> CallsIndex:
+        """Return the calls supported by the endpoint, shared by every client of this endpoint"""
+        if self.cassette is not None:
+            # the discovery requests must be part of the cassette, the shared index is not used
+            if self._calls_index is None:
+                self._calls_index = CallsIndex.discover(self)
+            return self._calls_index
+        return CallsIndex.for_client(self)
+
     def _get_obs_unit_call(self) -> str:
         """Choose which BrAPI call to use in order to fetch observation unit by study"""
         if self.obs_unit_call == " ":
-            r = requests.get(self.endpoint + "calls?pageSize=100")
-            if r.status_code != requests.codes.ok:
-                self.logger.debug("\n\nERROR in get_obs_units_in_study " + str(r.status_code) + str(r.json()))
-                raise RuntimeError("Non-200 status code")
-            elif r.json()['metadata']['pagination']['totalCount'] == 0:
-                self.logger.debug(" EMPTY CALLS Call, assume OBSERVATIONUNIT THE 1.1 WAY")
-                self.obs_unit_call = "observationUnits"
-            elif any(el['call'] == 'studies/{studyDbId}/observationUnits' for el in r.json()['result']['data']):
-                self.logger.debug(" GOT OBSERVATIONUNIT THE 1.1 WAY")
-                self.obs_unit_call = "observationUnits"
-            elif any(el['call'] == 'studies/{studyDbId}/observationunits' for el in r.json()['result']['data']):
-                self.logger.debug(" GOT OBSERVATIONUNIT THE 1.2+ WAY")
-                self.obs_unit_call = "observationunits"        
-            else:
-                if any(el['call'] == 'phenotypes-search' for el in r.json()['result']['data']):
-                    self.logger.debug(" GOT NO STUDY OBSERVATIONUNIT CALL, TAKING PHENOTYPESEARCH INSTEAD")
-                    self.obs_unit_call = "phenotypes-search"
-                else:
-                    self.logger.debug(" GOT NO STUDY OBSERVATIONUNIT CALL, QUITTING PROCESS")
-
+            self.obs_unit_call = self._shared(url_path_join(self.endpoint, 'calls') + '?obs_unit_call',
+                                              self._choose_obs_unit_call)
         return self.obs_unit_call
 
+    def _choose_obs_unit_call(self) -> str:
+        calls = self.calls_index()
+        if calls.empty:
+            self.logger.debug(" EMPTY CALLS Call, assume OBSERVATIONUNIT THE 1.1 WAY")
+            return "observationUnits"
+        elif calls.supports('studies/{studyDbId}/observationUnits'):
+            self.logger.debug(" GOT OBSERVATIONUNIT THE 1.1 WAY")
+            return "observationUnits"
+        elif calls.supports('studies/{studyDbId}/observationunits'):
+            self.logger.debug(" GOT OBSERVATIONUNIT THE 1.2+ WAY")
+            return "observationunits"
+        elif calls.supports('phenotypes-search'):
+            self.logger.debug(" GOT NO STUDY OBSERVATIONUNIT CALL, TAKING PHENOTYPESEARCH INSTEAD")
+            return "phenotypes-search"
+        self.logger.debug(" GOT NO STUDY OBSERVATIONUNIT CALL, QUITTING PROCESS")
+        return " "
+
     def _get_obs_var_call(self) -> str:
         """Choose which BrAPI call to use in order to fetch observation variables by study"""
         if self.obs_var_call == " ":
-            r = requests.get(self.endpoint + "calls?pageSize=100")
-            if r.status_code != requests.codes.ok:
-                self.logger.debug("\n\nERROR in get_obs_var_in_study " + r.status_code + r.json())
-                raise RuntimeError("Non-200 status code")
-            elif r.json()['metadata']['pagination']['totalCount'] == 0:
-                self.logger.debug(" EMPTY CALLS Call, assume OBSERVATIONVARIABLE THE 1.0 WAY")
-                self.obs_var_call = "observationVariables"
-            elif any(el['call'] == 'studies/{studyDbId}/observationVariables' for el in r.json()['result']['data']):
-                self.logger.debug(" GOT OBSERVATIONVARIABLE THE 1.0 WAY")
-                self.obs_var_call = "observationVariables"
-            else:
-                self.logger.debug(" GOT OBSERVATIONVARIABLE THE 1.1+ WAY")
-                self.obs_var_call = "observationvariables"
+            self.obs_var_call = self._shared(url_path_join(self.endpoint, 'calls') + '?obs_var_call',
+                                             self._choose_obs_var_call)
         return self.obs_var_call
+
+    def _choose_obs_var_call(self) -> str:
+        calls = self.calls_index()
+        if calls.empty:
+            self.logger.debug(" EMPTY CALLS Call, assume OBSERVATIONVARIABLE THE 1.0 WAY")
+            return "observationVariables"
+        elif calls.supports('studies/{studyDbId}/observationVariables'):
+            self.logger.debug(" GOT OBSERVATIONVARIABLE THE 1.0 WAY")
+            return "observationVariables"
+        elif calls.supports('studies/{studyDbId}/observationvariables') or not calls.supports('variables'):
+            self.logger.debug(" GOT OBSERVATIONVARIABLE THE 1.1+ WAY")
+            return "observationvariables"
+        self.logger.debug(" GOT NO STUDY OBSERVATIONVARIABLE CALL, TAKING VARIABLES INSTEAD (2.0 WAY)")
+        return "variables"
     
     # #NOTE: if phenotype search is needed in the future
     # def _get_observation_call(self) -> str:
@@ -100,29 +272,141 @@ class BrapiClient:
     #     return self.obs_call
 
 
-    def get_study_observation_units(self, study_id: str) -> Iterable:
-        """ Given a BRAPI study identifier, return an list of BRAPI observation units"""
-        observation_unit_call = self._get_obs_unit_call()
-        if observation_unit_call == 'phenotypes-search':
-            yield from self.fetch_objects('GET', f'/phenotypes-search', params={'studyDbId':study_id})
+    def get_study_observation_units(self, study_id: str, partitions: int = 1) -> Iterable:
+        """ Given a BRAPI study identifier, return an list of BRAPI observation units
+        :param partitions number of ranges of pages downloaded concurrently, see fetch_partitioned
+        """
+        prefetched = self._prefetched.pop(('observationunits', study_id), None)
+        if prefetched is not None:
+            yield from prefetched
+            return
+        path, params = self.study_paged_calls(study_id)['observation_units']
+        if partitions > 1:
+            yield from self.fetch_partitioned('GET', path, params=params, partitions=partitions)
         else:
-            yield from self.fetch_objects('GET', f'/studies/{study_id}/{observation_unit_call}')
+            yield from self.fetch_objects('GET', path, params=params)
     
+    def get_study_observations(self, study_id: str, start: str = None, end: str = None, level: str = None,
+                               variable_ids: List[str] = None) -> Iterable:
+        """
+        Given a BRAPI study identifier, return its observation units holding only the observations matching
+        the filters. The filters are sent to the endpoint when it supports them (v2 /observations or
+        phenotypes-search) and are applied again locally.
+        :param start, end observationTimeStamp window (ISO 8601), either bound may be omitted
+        :param level observation level of the units
+        :param variable_ids observation variables of the observations
+        """
+        calls = self.calls_index()
+        if is_brapi_v2(self.endpoint) and calls.supports('observations'):
+            params = {'studyDbId': study_id}
+            if start:
+                params['observationTimeStampRangeStart'] = start
+            if end:
+                params['observationTimeStampRangeEnd'] = end
+            if level:
+                params['observationUnitLevelName'] = level
+            units = {}
+            # the v2 observationVariableDbId filter takes a single variable
+            for variable_id in variable_ids or [None]:
+                if variable_id:
+                    params['observationVariableDbId'] = variable_id
+                for observation in self.fetch_objects('GET', '/observations', params=dict(params)):
+                    unit = units.setdefault(observation.get('observationUnitDbId'), {
+                        'observationUnitDbId': observation.get('observationUnitDbId'),
+                        'observationUnitName': observation.get('observationUnitName'),
+                        'germplasmDbId': observation.get('germplasmDbId'),
+                        'germplasmName': observation.get('germplasmName'),
+                        'observations': []})
+                    unit['observations'].append(observation)
+            obs_units = units.values()
+        elif calls.supports('phenotypes-search'):
+            params = {'studyDbId': study_id}
+            if start:
+                params['observationTimeStampRangeStart'] = start
+            if end:
+                params['observationTimeStampRangeEnd'] = end
+            if level:
+                params['observationLevel'] = level
+            if variable_ids:
+                params['observationVariableDbIds'] = list(variable_ids)
+            obs_units = self.fetch_objects('GET', '/phenotypes-search', params=params)
+        else:
+            self.logger.info("No observation filters on this endpoint, the whole study is fetched and filtered")
+            obs_units = self.get_study_observation_units(study_id)
+
+        yield from filter_observations(obs_units, start, end, level, variable_ids)
+
     # #NOTE: if phenotype search is needed in the future
     # def get_observations_units(self, study_id: str, ) -> Iterable:
     #     """ Given a BRAPI study identifier, return an list of observationUnits"""
     #     observation_call = self._get_observation_call()
     #     yield from self.fetch_objects('GET', f'/{observation_call}', params={'studyDbIds':study_id})
 
-    @cached(cache=TTLCache(maxsize=4096, ttl=900))
     def get_germplasm(self, germplasm_id: str) -> dict:
         """ Given a BRAPI germplasm identifiers, return an list of BRAPI germplasm attributes"""
-        return self.fetch_object(f'/germplasm/{germplasm_id}')
+        path = f'/germplasm/{germplasm_id}'
+        return self.identity_map.get(path, lambda: self._shared(url_path_join(self.endpoint, path),
+                                                                lambda: self._fetch_object(path)))
+
+    def get_study_observed_variables(self, study_id: str, observed: Iterable[str] = None) -> Iterable:
+        """"
+        Given a BRAPI study identifier, returns a list of BRAPI observation Variables objects
+        :param observed ids of the variables observed in the study: on endpoints paging /variables, the variables
+        are then taken from the variables of the endpoint, fetched once per run, when all of them are found there
+        """
+        prefetched = self._prefetched.pop(('variables', study_id), None)
+        if prefetched is not None:
+            yield from prefetched
+            return
+        path, params = self.study_paged_calls(study_id)['variables']
+        observed = set(observed or ())
+        if observed and path == '/variables':
+            variables = [variable for variable in self.get_variables()
+                         if variable.get('observationVariableDbId') in observed]
+            if observed <= {variable.get('observationVariableDbId') for variable in variables}:
+                yield from variables
+                return
+        # the variables of the study may be paged from /variables (2.0 way)
+        key = path + ''.join(f'?{name}={value}' for name, value in params.items())
+        yield from self.identity_map.get(key, lambda: list(self.fetch_objects('GET', path, params=dict(params))))
 
-    def get_study_observed_variables(self, study_id: str) -> Iterable:
-        """" Given a BRAPI study identifier, returns a list of BRAPI observation Variables objects """
+    def get_variables(self) -> List[dict]:
+        """All the observation variables of the endpoint, paged from /variables once per client"""
+        return self.identity_map.get('/variables', lambda: list(self.fetch_objects('GET', '/variables')))
+
+    def study_paged_calls(self, study_id: str) -> dict:
+        """Path and query params of the paged calls fetching the observation units, germplasm and variables of a study"""
+        observation_unit_call = self._get_obs_unit_call()
+        if observation_unit_call == 'phenotypes-search':
+            units = ('/phenotypes-search', {'studyDbId': study_id})
+        else:
+            units = (f'/studies/{study_id}/{observation_unit_call}', {})
         observation_var_call = self._get_obs_var_call()
-        yield from self.fetch_objects('GET', f'/studies/{study_id}/{observation_var_call}')
+        if observation_var_call == "variables":
+            variables = ('/variables', {'studyDbId': study_id})
+        else:
+            variables = (f'/studies/{study_id}/{observation_var_call}', {})
+        return {'observation_units': units, 'germplasm': (f'/studies/{study_id}/germplasm', {}),
+                'variables': variables}
+
+    def count_objects(self, path: str, params: dict = None) -> int:
+        """Number of objects of a paged call, read from the totalCount of a page of a single object"""
+        url = url_path_join(self.endpoint, path)
+        self.logger.debug('counting %s', url)
+        r = self._request('GET', url, params=dict(params or {}, page=0, pageSize=1))
+        if r.status_code != requests.codes.ok:
+            self.logger.error("problem with request: " + str(r))
+            raise RuntimeError("Non-200 status code")
+        pagination = loads(r.content)['metadata']['pagination']
+        if pagination.get('totalCount') is not None:
+            return int(pagination['totalCount'])
+        # the pages of the size returned (1 unless the server ignores the page size), the last one may not be full
+        return int(pagination['totalPages']) * int(pagination.get('pageSize') or 1)
+
+    def count_study(self, study_id: str, kinds: tuple = ('observation_units', 'germplasm', 'variables')) -> dict:
+        """Number of observation units, germplasm and variables of a study, without downloading them"""
+        calls = self.study_paged_calls(study_id)
+        return {kind: self.count_objects(*calls[kind]) for kind in kinds}
 
     def get_trials(self, trial_ids: List[str]=None) -> Iterable:
         """"
@@ -141,109 +425,397 @@ class BrapiClient:
             for trial_id in trial_ids:
                 yield self.fetch_object(f'/trials/{trial_id}')
 
+    @staticmethod
+    def _create_session() -> requests.Session:
+        """HTTP session with retries, its connection pool is reused by every call of the client"""
+        session = requests.Session()
+        # throttling and gateway timeouts are handled by the pager, only connection errors are retried here
+        retry = Retry(connect=3, backoff_factor=1)
+        adapter = HTTPAdapter(max_retries=retry)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def _request(self, method: str, url: str, params=None, data=None, json_body=None, headers=None,
+                 stream: bool = False):
+        """Send an HTTP request with the client session, recording or replaying it when a cassette is used"""
+        start = time.time()
+        kwargs = dict(params=params, data=data, json=json_body, headers=headers)
+        if self.cassette is None:
+            if method == 'GET' and self.hedging is not None:
+                r = self._hedged_get(url, dict(kwargs, stream=stream))
+            else:
+                r = self._send(method, url, stream=stream, **kwargs)
+        else:
+            key = request_key(method, url, params, data, json_body)
+            if self.cassette.replaying:
+                r = self.cassette.replay(key, url)
+            else:
+                r = self.cassette.record(key, self._send(method, url, **kwargs))
+        self.metrics.request(url, time.time() - start, r.status_code)
+        if not stream:
+            # the bodies of the streamed pages are counted by fetch_objects
+            self.metrics.add(url, 'response_bytes', len(r.content))
+        return r
+
+    def _send(self, method: str, url: str, **kwargs):
+        """Send a request once the rate limit allows it"""
+        if self.rate_limiter is not None:
+            waited = self.rate_limiter.acquire()
+            if waited:
+                self.metrics.add(url, 'rate_limited_seconds', waited)
+        return self.session.request(method, url, **kwargs)
+
+    def _hedged_get(self, url: str, kwargs: dict):
+        """Send a GET, and a second one if the first is slower than usual: the first response wins"""
+        call = call_type(self.endpoint, url)
+        delay = self.hedging.delay(call)
+        start = time.time()
+        if delay is None:
+            r = self._send('GET', url, **kwargs)
+            self.hedging.observe(call, time.time() - start)
+            return r
+        if self._hedge_executor is None:
+            self._hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix='hedge')
+        pending = [self._hedge_executor.submit(self._send, 'GET', url, **kwargs)]
+        wait(pending, timeout=delay)
+        # a hedge never waits for the rate limit: it is dropped instead
+        if not pending[0].done() and self.hedging.spend(call) \
+                and (self.rate_limiter is None or self.rate_limiter.try_acquire()):
+            self.metrics.add(url, 'hedged_requests')
+            pending.append(self._hedge_executor.submit(self.session.request, 'GET', url, **kwargs))
+        first = pending[0]
+        candidates = list(pending)
+        while candidates:
+            done, _ = wait(candidates, return_when=FIRST_COMPLETED)
+            finished = [future for future in candidates if future in done]
+            winners = [future for future in finished if future.exception() is None]
+            candidates = [future for future in candidates if future not in done]
+            if winners:
+                first = winners[0]
+                break
+        for future in pending:
+            if future is not first:
+                # the response of the slower request is dropped, its connection released
+                future.add_done_callback(lambda f: f.exception() is None and f.result().close())
+        if first is not pending[0]:
+            self.metrics.add(url, 'hedge_wins')
+        r = first.result()
+        self.hedging.observe(call, time.time() - start)
+        return r
+
+    def _sleep(self, seconds: float):
+        """Wait before retrying a request, replayed requests are retried right away"""
+        if self.cassette is None or not self.cassette.replaying:
+            time.sleep(seconds)
+
+    def begin_run(self):
+        """Start a new run: the objects fetched by the previous runs of this client are fetched again"""
+        self.metrics = ClientMetrics(self.endpoint)
+        self.identity_map = IdentityMap(on_saved=lambda path: self.metrics.add(path, 'cache_hits'))
+
+    def identity_report(self) -> dict:
+        """Requests sent and saved by the identity map during the current run, see IdentityMap.report"""
+        return self.identity_map.report()
+
+    def shared_cache_report(self) -> dict:
+        """Hit rates of the shared cache in this process, see SharedCache.report"""
+        return self.shared_cache.report() if self.shared_cache is not None else {}
+
+    def _shared(self, url: str, fetch):
+        """Return the value of url from the shared cache, calling fetch() and storing its result on a miss"""
+        if self.shared_cache is None:
+            return fetch()
+        value = self.shared_cache.get(url, _END, kind=call_type(self.endpoint, url))
+        if value is not _END:
+            self.metrics.add(url, 'shared_cache_hits')
+            return value
+        value = fetch()
+        self.shared_cache.put(url, value)
+        return value
+
+    def close(self):
+        if self._hedge_executor is not None:
+            self._hedge_executor.shutdown(wait=False)
+        self.session.close()
+        if self.cassette is not None:
+            self.cassette.close()
+
     def fetch_object(self, path: str) -> dict:
         """
-        Fetch single BrAPI object by path
+        Fetch single BrAPI object by path, once per run (see IdentityMap)
         :param path URL path of the BrAPI call (ex '/studies/1', '/germplasm/2', ...)
-        :return a BrAPI object parsed from JSON to python dict
+        :return a BrAPI object parsed from JSON to python dict, shared by the callers: do not modify it
         """
+        return self.identity_map.get(path, lambda: self._fetch_object(path))
+
+    def _fetch_object(self, path: str) -> dict:
         url = url_path_join(self.endpoint, path)
-        self.logger.debug('GET ' + url)
-        session = requests.Session()
-        retry = Retry(connect=3, backoff_factor=15)
-        adapter = HTTPAdapter(max_retries=retry)
-        session.mount('http://', adapter)
-        session.mount('https://', adapter)
-        r = session.get(url)
+        self.logger.debug('GET %s', url)
+        r = self._request('GET', url)
         # Covering internal server errors by retrying one more time
         if r.status_code == 500:
-            time.sleep(5)
-            r = requests.get(url)
+            self.metrics.add(url, 'server_error_retries')
+            self._sleep(5)
+            r = self._request('GET', url)
         elif r.status_code != requests.codes.ok:
             logging.error("problem with request: " + str(r))
             raise RuntimeError("Non-200 status code")
-        return r.json()["result"]
+        return loads(r.content)["result"]
 
-    def fetch_objects(self, method: str, path: str, params: dict=None, data: dict=None) -> Iterable:
+    def fetch_objects(self, method: str, path: str, params: dict=None, data: dict=None, page_size: int = None,
+                      first_page: int = 0, last_page: int = None) -> Iterable:
         """
         Fetch BrAPI objects with pagination
         :param method HTTP method of the BrAPI call (GET, POST, PUT)
         :param path URL path of the BrAPI call (ex '/studies', '/germplasm-search', ...)
         :param params dict containing the query params for the BrAPI call
         :param data dict containing the request body (used for 'POST' calls)
+        :param page_size, first_page, last_page only fetch the pages first_page to last_page (excluded, to the last
+        page when None) of page_size objects, see fetch_partitioned
         :return iterable of BrAPI objects parsed from JSON to python dict
         """
-        page = 0
-        pagesize = 1000
         maxcount = None
         # set a default dict for parameters
         params = params or {}
         url = url_path_join(self.endpoint, path)
-        session = requests.Session()
-        retry = Retry(connect=3, backoff_factor=15)
-        adapter = HTTPAdapter(max_retries=retry)
-        session.mount('http://', adapter)
-        session.mount('https://', adapter)
-        while maxcount is None or page < maxcount:
-            params['page'] = page
-            params['pageSize'] = pagesize
-            self.logger.debug('retrieving page ' + str(page)+ ' of '+ str(maxcount)+ ' from '+ str(url))
-            self.logger.info("paging params:" + str(params))
-
-            if method == 'GET':
-                self.logger.debug("GETting " + url)
-                r = session.get(url, params=params, data=data)
-            elif method == 'PUT':
-                self.logger.debug("PUTting "+  url)
-                r = session.put(url, params=params, data=data)
-            elif method == 'POST':
-                # params['User-Agent'] = "Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko)
-                # Chrome/41.0.2272.101 Safari/537.36"
-                params['Accept'] = "application/json"
-                params['Content-Type'] = "application/json"
-                self.logger.debug("POSTing " + url)
-                self.logger.debug("POSTing " + str(params) + str(data))
-                headers = {}
-                r = session.post(url, params=json.dumps(params).encode('utf-8'), json=data,
-                                  headers=headers)
-                self.logger.debug(r)
-            else:
-                raise RuntimeError(f"Unknown method: {method}")
-            if r.status_code == 504 and pagesize != 100:
-                pagesize = 100
-                self.logger.info("504 Gateway Timeout Error, testing with pagesize = 100") 
-                continue
-            elif r.status_code != requests.codes.ok:
+        end = None
+        if page_size is not None:
+            # the range must end on a page boundary: the pages keep their size (a 504 still shrinks them)
+            pager = AdaptivePager(self.endpoint, path, self.logger, adaptive=False, sleep=self._sleep)
+            pager.size = page_size
+            pager.offset = first_page * page_size
+            if last_page is not None:
+                end = last_page * page_size
+        elif self.cassette is None:
+            pager = AdaptivePager(self.endpoint, path, self.logger)
+        else:
+            # recorded page sizes must not depend on timings to be replayable
+            pager = AdaptivePager(self.endpoint, path, self.logger, adaptive=False, sleep=self._sleep)
+        try:
+            while True:
+                params['page'] = pager.page
+                params['pageSize'] = pager.size
+                self.logger.debug('retrieving page %s of %s from %s', pager.page, maxcount, url)
+                sampled.log(self.logger, logging.INFO, url, "paging params: %s", params)
+
+                start = time.time()
+                if method == 'GET':
+                    self.logger.debug("GETting %s", url)
+                    r = self._request('GET', url, params=params, data=data, stream=True)
+                elif method == 'PUT':
+                    self.logger.debug("PUTting %s", url)
+                    r = self._request('PUT', url, params=params, data=data, stream=True)
+                elif method == 'POST':
+                    # search parameters and paging are sent in the JSON body, other params stay in the query
+                    body = dict(data or {}, page=params['page'], pageSize=params['pageSize'])
+                    query = {key: value for key, value in params.items() if key not in ('page', 'pageSize')}
+                    self.logger.debug("POSTing %s %s", url, body)
+                    r = self._request('POST', url, params=query or None, json_body=body, stream=True)
+                    self.logger.debug(r)
+                else:
+                    raise RuntimeError(f"Unknown method: {method}")
+                request_time = time.time() - start
+                if r.status_code != requests.codes.ok:
+                    # release the connection, the error body is not read
+                    r.close()
+                if r.status_code in (429, 503) and pager.throttled(r):
+                    self.metrics.add(url, 'throttled_retries')
+                    continue
+                elif r.status_code == 504 and pager.timed_out():
+                    self.metrics.add(url, 'page_size_downgrades')
+                    continue
+                elif r.status_code != requests.codes.ok:
+                    self.logger.error("problem with request: " + str(r))
+                    raise RuntimeError("Non-200 status code")
+
+                # the page is decoded once, objects are yielded as they are parsed
+                page = BrapiPage(r)
+                count = 0
+                try:
+                    for obj in page:
+                        count += 1
+                        yield obj
+                finally:
+                    r.close()
+                maxcount = page.total_pages
+                pager.observe(request_time + page.elapsed, page.nbytes, count)
+                self.metrics.add(url, 'pages')
+                self.metrics.add(url, 'response_bytes', page.nbytes)
+                self.metrics.add(url, 'page_seconds', page.elapsed)
+                if self.on_page is not None:
+                    self.on_page(path, count)
+
+                if not pager.advance(count, maxcount) or (end is not None and pager.offset >= end):
+                    break
+        finally:
+            pager.save()
+
+    def fetch_partitioned(self, method: str, path: str, params: dict = None, partitions: int = 2) -> Iterable:
+        """
+        Fetch the objects of a paged call as fetch_objects, with its pages split in `partitions` ranges downloaded
+        concurrently. The number of pages is read from the totalCount of a single object page, the last range goes
+        on to the last page even when objects were added since.
+        :return iterable of the BrAPI objects, in the pages order
+        """
+        params = dict(params or {})
+        page_size = AdaptivePager(self.endpoint, path, self.logger, adaptive=self.cassette is None).size
+        pages = max(1, -(-self.count_objects(path, params) // page_size))
+        partitions = max(1, min(partitions, pages))
+        bounds = [pages * k // partitions for k in range(partitions + 1)]
+        bounds[-1] = None
+
+        def fetch_range(k):
+            return list(self.fetch_objects(method, path, dict(params), page_size=page_size,
+                                           first_page=bounds[k], last_page=bounds[k + 1]))
+
+        with ThreadPoolExecutor(max_workers=partitions) as executor:
+            for objects in executor.map(fetch_range, range(partitions)):
+                yield from objects
+
+    def submit_search(self, entity: str, body: dict) -> str:
+        """
+        Submit a BrAPI v2 search (POST /search/{entity})
+        :return the searchResultsDbId of an asynchronous search, None when the endpoint answered with the results
+        """
+        url = url_path_join(self.endpoint, 'search', entity)
+        self.logger.debug("POSTing %s %s", url, body)
+        r = self._request('POST', url, json_body=body)
+        if r.status_code not in (requests.codes.ok, requests.codes.accepted):
+            self.logger.error("problem with request: " + str(r))
+            raise RuntimeError("Non-200 status code")
+        result = loads(r.content).get('result') or {}
+        return result.get('searchResultsDbId')
+
+    def wait_search(self, entity: str, search_id: str, timeout: float = SEARCH_TIMEOUT):
+        """Poll the results of an asynchronous search until the endpoint stops answering 202 Accepted"""
+        url = url_path_join(self.endpoint, 'search', entity, search_id)
+        delay = SEARCH_POLL_INTERVAL
+        deadline = time.time() + timeout
+        while True:
+            r = self._request('GET', url, params={'page': 0, 'pageSize': 1})
+            if r.status_code == requests.codes.ok:
+                return
+            elif r.status_code != requests.codes.accepted:
                 self.logger.error("problem with request: " + str(r))
                 raise RuntimeError("Non-200 status code")
-            maxcount = int(r.json()['metadata']['pagination']['totalPages'])
+            elif time.time() > deadline:
+                raise RuntimeError(f"Search {search_id} of {entity} not ready after {timeout} seconds")
+            self._sleep(min(parse_retry_after(r.headers.get('Retry-After'), delay), SEARCH_MAX_POLL_INTERVAL))
+            delay = min(delay * 2, SEARCH_MAX_POLL_INTERVAL)
 
-            for data in r.json()['result']['data']:
-                yield data
+    def search(self, entity: str, body: dict) -> Iterable:
+        """
+        Run a BrAPI v2 search and return its results, paged like fetch_objects
+        :param entity searched entity (ex 'germplasm', 'observationunits', 'variables')
+        :param body search parameters
+        """
+        search_id = self.submit_search(entity, body)
+        if search_id is None:
+            # synchronous search, the results are paged by POSTing the search again
+            yield from self.fetch_objects('POST', f'/search/{entity}', data=body)
+        else:
+            self.wait_search(entity, search_id)
+            yield from self.fetch_objects('GET', f'/search/{entity}/{search_id}')
 
-            page += 1
+    def search_many(self, searches: dict, workers: int = SEARCH_WORKERS) -> dict:
+        """
+        Run several v2 searches at once. At most `workers` searches are submitted and polled at the same time,
+        then each search streams its pages from a background thread, buffering up to SEARCH_BUFFER objects.
+        :param searches dict of key -> (entity, body)
+        :return dict of key -> iterable of the search results (errors are raised when iterating)
+        """
+        slots = threading.Semaphore(workers)
+        results = {}
+        for key, (entity, body) in searches.items():
+            buffer = queue.Queue(maxsize=SEARCH_BUFFER)
+            threading.Thread(target=self._run_search, args=(entity, body, buffer, slots), daemon=True).start()
+            results[key] = self._drain(buffer)
+        return results
+
+    def _run_search(self, entity: str, body: dict, buffer: queue.Queue, slots: threading.Semaphore):
+        try:
+            with slots:
+                search_id = self.submit_search(entity, body)
+                if search_id is not None:
+                    self.wait_search(entity, search_id)
+            # the slot is released before streaming, a full buffer must not hold back other searches
+            if search_id is None:
+                objects = self.fetch_objects('POST', f'/search/{entity}', data=body)
+            else:
+                objects = self.fetch_objects('GET', f'/search/{entity}/{search_id}')
+            for obj in objects:
+                buffer.put(obj)
+            buffer.put(_END)
+        except Exception as e:
+            buffer.put(e)
+
+    @staticmethod
+    def _drain(buffer: queue.Queue) -> Iterable:
+        while True:
+            item = buffer.get()
+            if item is _END:
+                return
+            elif isinstance(item, Exception):
+                raise item
+            yield item
+
+    def prefetch_studies(self, study_ids: List[str]) -> bool:
+        """
+        On BrAPI v2 endpoints offering the search calls, fetch the germplasm, observation units and variables
+        of several studies with concurrent searches instead of study by study. The per study methods then
+        serve the prefetched results.
+        :return True when the studies were prefetched
+        """
+        if not is_brapi_v2(self.endpoint) or not study_ids:
+            return False
+        calls = self.calls_index()
+        if not all(calls.supports(f'search/{entity}', 'POST') for entity in ('germplasm', 'observationunits',
+                                                                               'variables')):
+            return False
+        searches = {('observationunits', None): ('observationunits', {'studyDbIds': list(study_ids),
+                                                                      'includeObservations': True})}
+        for study_id in study_ids:
+            searches[('germplasm', study_id)] = ('germplasm', {'studyDbIds': [study_id]})
+            searches[('variables', study_id)] = ('variables', {'studyDbId': [study_id]})
+        results = self.search_many(searches)
+
+        # the observation units of all the studies come from a single search
+        units = {study_id: [] for study_id in study_ids}
+        for unit in results.pop(('observationunits', None)):
+            units.setdefault(str(unit.get('studyDbId')), []).append(unit)
+        for study_id in study_ids:
+            self._prefetched[('observationunits', study_id)] = units[study_id]
+        self._prefetched.update(results)
+        return True
 
     def get_taxonId(self, genus, species):
         scientific_name = '%20'.join([genus,species])
+        link = "https://www.ebi.ac.uk/ena/taxonomy/rest/any-name/{}".format(scientific_name)
         if scientific_name in self.taxon:
+            self.metrics.add(link, 'cache_hits')
             return self.taxon[scientific_name]
         
-        link = "https://www.ebi.ac.uk/ena/taxonomy/rest/any-name/{}".format(scientific_name)
-        self.logger.debug('GET ' + link)
-        r = requests.get(link)
+        taxonId = self.taxon[scientific_name] = self._shared(link, lambda: self._fetch_taxonId(link))
+        return taxonId
+
+    def _fetch_taxonId(self, link):
+        self.logger.debug('GET %s', link)
+        r = self._request('GET', link)
         if r.status_code != requests.codes.ok:
             self.logger.error("problem with request: " + str(r))
             raise RuntimeError("Non-200 status code")
         else:
-            taxonId = r.json()[0]['taxId']
-            self.taxon[scientific_name] = taxonId
-            return taxonId
+            return r.json()[0]['taxId']
     
     def get_ontologies(self):
-        ont = {}
         link = 'http://www.obofoundry.org/registry/ontologies.jsonld'
-        self.logger.debug('GET ' + link)
-        r = requests.get(link)
+        return self._shared(link, lambda: self._fetch_ontologies(link))
+
+    def _fetch_ontologies(self, link):
+        ont = {}
+        self.logger.debug('GET %s', link)
+        r = self._request('GET', link)
         if r.status_code != requests.codes.ok:
             self.logger.error("problem with request: " + str(r))
             raise RuntimeError("Non-200 status code")
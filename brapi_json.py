@@ -0,0 +1,113 @@
+import json
+import time
+
+# Optional faster JSON backends, the standard library is used when they are not installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+DATA_PREFIX = 'result.data.item'
+PAGINATION_PREFIX = 'metadata.pagination.'
+
+
+def loads(content):
+    """Decode a JSON document (bytes or str) with the fastest available backend"""
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+class _CountingReader:
+    """File-like wrapper counting the bytes read and the time spent reading them"""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.nbytes = 0
+        self.elapsed = 0.0
+
+    def read(self, size=-1):
+        start = time.time()
+        chunk = self.raw.read(size)
+        self.elapsed += time.time() - start
+        self.nbytes += len(chunk)
+        return chunk
+
+
+class BrapiPage:
+    """ One page of a paginated BrAPI response, decoded in a single pass
+
+    Iterating over the page yields the `result.data` objects. With ijson installed they are parsed
+    incrementally from the response stream as they arrive, otherwise the body is decoded once.
+    `pagination`, `nbytes` and `elapsed` are complete once the iteration is over.
+    """
+
+    def __init__(self, response, streaming: bool = None):
+        self.response = response
+        self.streaming = ijson is not None if streaming is None else streaming
+        self.pagination = {}
+        self.nbytes = 0
+        # time spent reading and decoding, excluding the time spent by the consumer of the objects
+        self.elapsed = 0.0
+
+    @property
+    def total_pages(self) -> int:
+        return int(self.pagination['totalPages'])
+
+    def __iter__(self):
+        if self.streaming:
+            yield from self._iter_stream()
+        else:
+            yield from self._iter_buffered()
+
+    def _iter_buffered(self):
+        start = time.time()
+        content = self.response.content
+        body = loads(content)
+        self.nbytes = len(content)
+        self.elapsed = time.time() - start
+        self.pagination = body['metadata']['pagination']
+        yield from body['result']['data']
+
+    def _iter_stream(self):
+        raw = self.response.raw
+        # let urllib3 undo the content encoding (gzip, deflate)
+        raw.decode_content = True
+        reader = _CountingReader(raw)
+        events = ijson.parse(reader, use_float=True)
+        builder = None
+        depth = 0
+        start = time.time()
+        consumer_time = 0.0
+        for prefix, event, value in events:
+            if builder is not None:
+                builder.event(event, value)
+                if event in ('start_map', 'start_array'):
+                    depth += 1
+                elif event in ('end_map', 'end_array'):
+                    depth -= 1
+                    if depth == 0:
+                        obj, builder = builder.value, None
+                        pause = time.time()
+                        yield obj
+                        consumer_time += time.time() - pause
+            elif prefix == DATA_PREFIX:
+                if event in ('start_map', 'start_array'):
+                    builder = ijson.ObjectBuilder()
+                    builder.event(event, value)
+                    depth = 1
+                else:
+                    pause = time.time()
+                    yield value
+                    consumer_time += time.time() - pause
+            elif prefix.startswith(PAGINATION_PREFIX) and event in ('number', 'string', 'boolean', 'null'):
+                self.pagination[prefix[len(PAGINATION_PREFIX):]] = value
+        self.nbytes = reader.nbytes
+        self.elapsed = time.time() - start - consumer_time
+        if 'totalPages' not in self.pagination:
+            raise KeyError('totalPages')
@@ -0,0 +1,92 @@
+import atexit
+import logging
+import logging.handlers
+import multiprocessing.util
+import os
+import queue
+import sys
+import threading
+from collections import Counter
+
+# One out of SAMPLE_RATE sampled messages (per page, per request...) is logged, all of them at DEBUG level
+SAMPLE_RATE = 100
+# the sampled records name the caller of Sampler.log rather than Sampler.log, stacklevel is only known from Python 3.8
+_CALLER = {'stacklevel': 2} if sys.version_info >= (3, 8) else {}
+
+# queue handler and listener of the loggers written in the background, by process and logger name: a forked
+# process (service worker...) inherits the entries of its parent but not their listener threads
+_listeners = {}
+
+
+def start_async(logger: logging.Logger, *handlers: logging.Handler):
+    """
+    Route the records of logger to handlers through a queue: the callers only enqueue the records,
+    the handlers (file writes...) run in a background thread
+    """
+    stop_async(logger)
+    _forget_inherited(logger)
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    queue_handler = logging.handlers.QueueHandler(records)
+    logger.addHandler(queue_handler)
+    listener.start()
+    if not any(pid == os.getpid() for pid, _ in _listeners):
+        # the processes started by multiprocessing leave without running the atexit functions
+        multiprocessing.util.Finalize(None, _stop_all, exitpriority=0)
+    _listeners[(os.getpid(), logger.name)] = (queue_handler, listener)
+
+
+def _forget_inherited(logger: logging.Logger):
+    """Detach the queues of logger inherited from a parent process, nothing reads them in this process"""
+    for key in [key for key in _listeners if key[1] == logger.name and key[0] != os.getpid()]:
+        logger.removeHandler(_listeners.pop(key)[0])
+
+
+def async_handlers(logger: logging.Logger) -> tuple:
+    """The handlers run in the background for logger, empty when it is not logged asynchronously"""
+    entry = _listeners.get((os.getpid(), logger.name))
+    return entry[1].handlers if entry else ()
+
+
+def stop_async(logger: logging.Logger):
+    """Write the records still queued for logger and detach its queue"""
+    entry = _listeners.pop((os.getpid(), logger.name), None)
+    if entry is None:
+        return
+    queue_handler, listener = entry
+    logger.removeHandler(queue_handler)
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+
+
+@atexit.register
+def _stop_all():
+    for pid, name in list(_listeners):
+        if pid == os.getpid():
+            stop_async(logging.getLogger(name))
+
+
+class Sampler:
+    """ Log one out of `rate` messages of a kind, for the messages repeated on every page or request """
+
+    def __init__(self, rate: int = SAMPLE_RATE):
+        self.rate = rate
+        self._counts = Counter()
+        self._lock = threading.Lock()
+
+    def log(self, logger: logging.Logger, level: int, kind: str, msg: str, *args):
+        if not logger.isEnabledFor(level):
+            return
+        if self.rate > 1 and not logger.isEnabledFor(logging.DEBUG):
+            with self._lock:
+                count = self._counts[kind]
+                self._counts[kind] = count + 1
+            if count % self.rate:
+                return
+            msg += " (1 out of %d logged)"
+            args += (self.rate,)
+        logger.log(level, msg, *args, **_CALLER)
+
+
+sampled = Sampler()
@@ -0,0 +1,142 @@
+import json
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from urllib.parse import urlparse
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+PROMETHEUS_FILE = 'brapi2isa.prom'
+JSON_FILE = 'brapi2isa_metrics.json'
+# Counters of a call type, with their Prometheus name and help
+COUNTERS = {
+    'response_bytes': ('brapi2isa_response_bytes_total', "Bytes of the BrAPI response bodies"),
+    'pages': ('brapi2isa_pages_total', "Pages read from paged BrAPI calls"),
+    'page_seconds': ('brapi2isa_page_read_seconds_total', "Time spent downloading and decoding the pages"),
+    'server_error_retries': ('brapi2isa_server_error_retries_total', "Requests retried after a 500 error"),
+    'throttled_retries': ('brapi2isa_throttled_retries_total', "Requests retried after a 429 or 503 response"),
+    'page_size_downgrades': ('brapi2isa_page_size_downgrades_total', "Page sizes shrunk after a 504 error"),
+    'cache_hits': ('brapi2isa_cache_hits_total', "Requests served from the run caches instead of the endpoint"),
+    'rate_limited_seconds': ('brapi2isa_rate_limited_seconds_total',
+                             "Time spent waiting for the rate limit shared by the processes of the host"),
+    'hedged_requests': ('brapi2isa_hedged_requests_total', "Slow GET requests sent a second time"),
+    'hedge_wins': ('brapi2isa_hedge_wins_total', "Hedged requests answered first by the second request"),
+    'shared_cache_hits': ('brapi2isa_shared_cache_hits_total',
+                          "Requests served from the cache shared by the worker processes of the run"),
+}
+
+
+def call_type(endpoint: str, url: str) -> str:
+    """
+    Call of a request with its identifiers replaced, ex 'studies/{id}/germplasm', 'search/germplasm/{id}'
+    :param url requested URL or URL path relative to the endpoint, requests to other hosts are named by host
+    """
+    if url.startswith(endpoint):
+        url = url[len(endpoint):]
+    elif '://' in url:
+        return urlparse(url).netloc
+    parts = [part for part in url.split('?')[0].split('/') if part]
+    if parts[:1] == ['search']:
+        return '/'.join(parts[:2] + ['{id}'] * len(parts[2:3]))
+    return '/'.join(part if i % 2 == 0 else '{id}' for i, part in enumerate(parts))
+
+
+def _labels(**labels) -> str:
+    escaped = (key + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+               for key, value in labels.items())
+    return '{' + ','.join(escaped) + '}'
+
+
+class ClientMetrics:
+    """ HTTP metrics of the calls of a BrapiClient, by call type
+
+    Requests are counted by status code with a histogram of their latency (time to the response headers, the
+    download of the pages is counted apart in page_seconds), next to the COUNTERS.
+    """
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._statuses = defaultdict(Counter)
+        self._buckets = defaultdict(lambda: [0] * len(LATENCY_BUCKETS))
+        self._latency = defaultdict(float)
+        self._counters = defaultdict(Counter)
+
+    def request(self, url: str, seconds: float, status: int):
+        call = call_type(self.endpoint, url)
+        with self._lock:
+            self._statuses[call][status] += 1
+            self._latency[call] += seconds
+            buckets = self._buckets[call]
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    buckets[i] += 1
+
+    def add(self, url: str, counter: str, value=1):
+        """Add value to one of the COUNTERS of the call of url"""
+        call = call_type(self.endpoint, url)
+        with self._lock:
+            self._counters[call][counter] += value
+
+    def summary(self, run: dict = None) -> dict:
+        """Metrics by call type, with the figures of the run (duration, studies...) when given"""
+        with self._lock:
+            calls = {}
+            for call in sorted(set(self._statuses) | set(self._counters)):
+                count = sum(self._statuses[call].values())
+                calls[call] = dict({'requests': count,
+                                    'statuses': {str(status): n for status, n in sorted(self._statuses[call].items())},
+                                    'latency_seconds': self._latency[call],
+                                    'latency_buckets': dict(zip([str(bound) for bound in LATENCY_BUCKETS],
+                                                                self._buckets[call])) if count else {}},
+                                   **{counter: self._counters[call][counter] for counter in COUNTERS})
+        return {'endpoint': self.endpoint, 'run': dict(run or {}), 'calls': calls}
+
+    def prometheus(self, run: dict = None) -> str:
+        """The metrics in the Prometheus text format, run figures are exported as brapi2isa_run_<name> gauges"""
+        summary = self.summary(run)
+        endpoint = self.endpoint
+        lines = ["# HELP brapi2isa_requests_total BrAPI HTTP requests by call and status code",
+                 "# TYPE brapi2isa_requests_total counter"]
+        for call, metrics in summary['calls'].items():
+            for status, n in metrics['statuses'].items():
+                lines.append('brapi2isa_requests_total' + _labels(endpoint=endpoint, call=call, status=status)
+                             + ' ' + str(n))
+        lines += ["# HELP brapi2isa_request_duration_seconds Time to the response headers of the BrAPI requests",
+                  "# TYPE brapi2isa_request_duration_seconds histogram"]
+        for call, metrics in summary['calls'].items():
+            if not metrics['requests']:
+                continue
+            for bound, n in metrics['latency_buckets'].items():
+                lines.append('brapi2isa_request_duration_seconds_bucket'
+                             + _labels(endpoint=endpoint, call=call, le=bound) + ' ' + str(n))
+            lines.append('brapi2isa_request_duration_seconds_bucket' + _labels(endpoint=endpoint, call=call, le='+Inf')
+                         + ' ' + str(metrics['requests']))
+            lines.append('brapi2isa_request_duration_seconds_sum' + _labels(endpoint=endpoint, call=call)
+                         + ' ' + repr(metrics['latency_seconds']))
+            lines.append('brapi2isa_request_duration_seconds_count' + _labels(endpoint=endpoint, call=call)
+                         + ' ' + str(metrics['requests']))
+        for counter, (name, help_text) in COUNTERS.items():
+            lines += ["# HELP " + name + " " + help_text, "# TYPE " + name + " counter"]
+            for call, metrics in summary['calls'].items():
+                if metrics[counter]:
+                    lines.append(name + _labels(endpoint=endpoint, call=call) + ' ' + str(metrics[counter]))
+        for key, value in summary['run'].items():
+            name = 'brapi2isa_run_' + key
+            lines += ["# TYPE " + name + " gauge", name + _labels(endpoint=endpoint) + ' ' + str(value)]
+        return '\n'.join(lines) + '\n'
+
+    def write(self, directory: str, run: dict = None):
+        """
+        Write the Prometheus textfile and the JSON summary in directory.
+        The files are replaced atomically, the directory can be read by the node exporter textfile collector.
+        """
+        os.makedirs(directory, exist_ok=True)
+        for filename, content in ((PROMETHEUS_FILE, self.prometheus(run)),
+                                  (JSON_FILE, json.dumps(self.summary(run), indent=4))):
+            path = os.path.join(directory, filename)
+            with open(path + '.tmp', 'w', encoding="utf-8") as fh:
+                fh.write(content)
+            os.replace(path + '.tmp', path)
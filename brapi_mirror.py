@@ -0,0 +1,353 @@
+import argparse
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections.abc import Iterable
+from typing import List
+
+from brapi_client import BrapiClient, filter_observations
+from brapi_json import loads
+from brapi_metrics import ClientMetrics
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS trials (trialDbId TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS studies (studyDbId TEXT PRIMARY KEY, trialDbId TEXT, lastUpdate TEXT,
+                                    harvested REAL, data TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS studies_trial ON studies (trialDbId);
+CREATE TABLE IF NOT EXISTS study_germplasm (studyDbId TEXT, position INTEGER, germplasmDbId TEXT,
+                                            data TEXT NOT NULL, PRIMARY KEY (studyDbId, position));
+CREATE INDEX IF NOT EXISTS study_germplasm_germplasm ON study_germplasm (germplasmDbId);
+CREATE TABLE IF NOT EXISTS germplasm (germplasmDbId TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS observation_units (studyDbId TEXT, position INTEGER, observationUnitDbId TEXT,
+                                              germplasmDbId TEXT, observationLevel TEXT, digest TEXT,
+                                              data TEXT NOT NULL, PRIMARY KEY (studyDbId, position));
+CREATE INDEX IF NOT EXISTS observation_units_germplasm ON observation_units (germplasmDbId);
+CREATE INDEX IF NOT EXISTS observation_units_level ON observation_units (studyDbId, observationLevel);
+CREATE TABLE IF NOT EXISTS study_variables (studyDbId TEXT, position INTEGER, observationVariableDbId TEXT,
+                                            data TEXT NOT NULL, PRIMARY KEY (studyDbId, position));
+CREATE TABLE IF NOT EXISTS resources (name TEXT PRIMARY KEY, data TEXT NOT NULL);
+"""
+
+
+def _dumps(obj) -> str:
+    return json.dumps(obj, sort_keys=True, separators=(',', ':'))
+
+
+def _digest(text: str) -> str:
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def observation_level(unit: dict) -> str:
+    """Observation level of a BrAPI v1 or v2 observation unit"""
+    level = unit.get('observationLevel')
+    if not level:
+        position = unit.get('observationUnitPosition') or {}
+        level = (position.get('observationLevel') or {}).get('levelName')
+    return level.lower() if isinstance(level, str) else None
+
+
+class Mirror:
+    """ Local SQLite copy of the BrAPI objects of an endpoint
+
+    Objects are stored as JSON documents with their BrAPI order, and indexed by study, germplasm
+    and observation level.
+    """
+
+    def __init__(self, path: str, endpoint: str = None):
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self.db:
+            self.db.executescript(SCHEMA)
+        stored = self.get_meta('endpoint')
+        if endpoint and stored and stored != endpoint:
+            raise ValueError(f"The mirror {path} holds {stored}, not {endpoint}")
+        self.endpoint = endpoint or stored
+        if endpoint and not stored:
+            self.set_meta('endpoint', endpoint)
+
+    def close(self):
+        self.db.close()
+
+    def get_meta(self, key: str):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str):
+        with self._lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+
+    def _one(self, query: str, params: tuple):
+        row = self.db.execute(query, params).fetchone()
+        return loads(row[0]) if row else None
+
+    def _many(self, query: str, params: tuple) -> Iterable:
+        for row in self.db.execute(query, params):
+            yield loads(row[0])
+
+    # ---- reading ----
+
+    def trial(self, trial_id: str):
+        return self._one("SELECT data FROM trials WHERE trialDbId = ?", (trial_id,))
+
+    def trials(self) -> Iterable:
+        yield from self._many("SELECT data FROM trials ORDER BY rowid", ())
+
+    def study(self, study_id: str):
+        return self._one("SELECT data FROM studies WHERE studyDbId = ?", (study_id,))
+
+    def study_last_update(self, study_id: str):
+        row = self.db.execute("SELECT lastUpdate, harvested FROM studies WHERE studyDbId = ?", (study_id,)).fetchone()
+        return row if row else (None, None)
+
+    def study_germplasms(self, study_id: str) -> Iterable:
+        yield from self._many("SELECT data FROM study_germplasm WHERE studyDbId = ? ORDER BY position",
+                              (study_id,))
+
+    def germplasm(self, germplasm_id: str):
+        return self._one("SELECT data FROM germplasm WHERE germplasmDbId = ?", (germplasm_id,))
+
+    def observation_units(self, study_id: str, level: str = None) -> Iterable:
+        if level is None:
+            yield from self._many("SELECT data FROM observation_units WHERE studyDbId = ? ORDER BY position",
+                                  (study_id,))
+        else:
+            yield from self._many("SELECT data FROM observation_units WHERE studyDbId = ? AND observationLevel = ?"
+                                  " ORDER BY position", (study_id, level.lower()))
+
+    def study_variables(self, study_id: str) -> Iterable:
+        yield from self._many("SELECT data FROM study_variables WHERE studyDbId = ? ORDER BY position",
+                              (study_id,))
+
+    def count_study(self, study_id: str) -> dict:
+        """Number of observation units, germplasm and variables of a study"""
+        return {kind: self.db.execute(f"SELECT COUNT(*) FROM {table} WHERE studyDbId = ?", (study_id,)).fetchone()[0]
+                for kind, table in (('observation_units', 'observation_units'), ('germplasm', 'study_germplasm'),
+                                    ('variables', 'study_variables'))}
+
+    def resource(self, name: str):
+        return self._one("SELECT data FROM resources WHERE name = ?", (name,))
+
+    # ---- writing ----
+
+    def put_trial(self, trial: dict):
+        with self._lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO trials VALUES (?, ?)", (str(trial['trialDbId']), _dumps(trial)))
+
+    def put_germplasm(self, germplasm: dict):
+        with self._lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO germplasm VALUES (?, ?)",
+                            (str(germplasm['germplasmDbId']), _dumps(germplasm)))
+
+    def put_resource(self, name: str, data):
+        with self._lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO resources VALUES (?, ?)", (name, _dumps(data)))
+
+    def put_study(self, study: dict, trial_id: str, last_update: str, germplasms: list, units: Iterable,
+                  variables: list) -> dict:
+        """
+        Store a study and its objects in one transaction, rewriting only the observation units that changed
+        :return counts of the 'unchanged', 'changed' and 'deleted' observation units
+        """
+        study_id = str(study['studyDbId'])
+        counts = {'unchanged': 0, 'changed': 0, 'deleted': 0}
+        with self._lock, self.db:
+            digests = dict(self.db.execute("SELECT position, digest FROM observation_units WHERE studyDbId = ?",
+                                           (study_id,)))
+            position = -1
+            for position, unit in enumerate(units):
+                text = _dumps(unit)
+                digest = _digest(text)
+                if digests.get(position) == digest:
+                    counts['unchanged'] += 1
+                    continue
+                counts['changed'] += 1
+                self.db.execute("INSERT OR REPLACE INTO observation_units VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                (study_id, position, unit.get('observationUnitDbId'), unit.get('germplasmDbId'),
+                                 observation_level(unit), digest, text))
+            counts['deleted'] = self.db.execute("DELETE FROM observation_units WHERE studyDbId = ? AND position > ?",
+                                                (study_id, position)).rowcount
+            self.db.execute("DELETE FROM study_germplasm WHERE studyDbId = ?", (study_id,))
+            self.db.executemany("INSERT INTO study_germplasm VALUES (?, ?, ?, ?)",
+                                [(study_id, i, g.get('germplasmDbId'), _dumps(g)) for i, g in enumerate(germplasms)])
+            self.db.execute("DELETE FROM study_variables WHERE studyDbId = ?", (study_id,))
+            self.db.executemany("INSERT INTO study_variables VALUES (?, ?, ?, ?)",
+                                [(study_id, i, v.get('observationVariableDbId'), _dumps(v))
+                                 for i, v in enumerate(variables)])
+            self.db.execute("INSERT OR REPLACE INTO studies VALUES (?, ?, ?, ?, ?)",
+                            (study_id, trial_id, last_update, time.time(), _dumps(study)))
+        return counts
+
+
+def last_update(study: dict):
+    """Version stamp of a BrAPI study (v1 and v2 `lastUpdate`), None when the endpoint does not provide it"""
+    stamp = study.get('lastUpdate')
+    return _dumps(stamp) if stamp else None
+
+
+def harvest(client: BrapiClient, mirror: Mirror, trial_ids: List[str], refresh: bool = False) -> dict:
+    """
+    Copy trials and their studies, germplasm, observation units and variables into a mirror.
+    Studies whose `lastUpdate` did not change since the last harvest are skipped (unless `refresh`),
+    germplasm details and taxa already in the mirror are not fetched again.
+    :return harvest statistics
+    """
+    stats = {'trials': 0, 'studies': 0, 'skipped_studies': 0, 'germplasm': 0, 'unchanged': 0, 'changed': 0,
+             'deleted': 0}
+    for trial in client.get_trials(trial_ids):
+        mirror.put_trial(trial)
+        stats['trials'] += 1
+        for trial_study in trial.get('studies') or []:
+            study_id = str(trial_study['studyDbId'])
+            study = client.get_study(study_id)
+            stamp = last_update(study)
+            stored_stamp, harvested = mirror.study_last_update(study_id)
+            if not refresh and harvested and stamp and stamp == stored_stamp:
+                client.logger.info("Study %s did not change since the last harvest", study_id)
+                stats['skipped_studies'] += 1
+                continue
+            germplasms = list(client.get_study_germplasms(study_id))
+            variables = list(client.get_study_observed_variables(study_id))
+            counts = mirror.put_study(study, str(trial['trialDbId']), stamp, germplasms,
+                                      client.get_study_observation_units(study_id), variables)
+            for key, count in counts.items():
+                stats[key] += count
+            stats['studies'] += 1
+            for germplasm in germplasms:
+                stats['germplasm'] += _harvest_germplasm(client, mirror, germplasm, refresh)
+    if mirror.resource('ontologies') is None or refresh:
+        mirror.put_resource('ontologies', client.get_ontologies())
+    client.logger.info("Harvest finished: %s", stats)
+    return stats
+
+
+def _harvest_germplasm(client: BrapiClient, mirror: Mirror, germplasm: dict, refresh: bool) -> int:
+    """Store the details and the taxon of a germplasm when they are not in the mirror yet"""
+    germplasm_id = str(germplasm['germplasmDbId'])
+    details = mirror.germplasm(germplasm_id)
+    fetched = 0
+    if details is None or refresh:
+        details = client.get_germplasm(germplasm_id)
+        mirror.put_germplasm(details)
+        fetched = 1
+    for attributes in (germplasm, details):
+        genus, species = attributes.get('genus'), attributes.get('species')
+        name = 'taxon:' + '%20'.join([str(genus), str(species)])
+        if genus and mirror.resource(name) is None:
+            try:
+                mirror.put_resource(name, client.get_taxonId(genus, species))
+            except (RuntimeError, LookupError, ValueError) as e:
+                client.logger.warning("No taxon found for %s %s: %s", genus, species, e)
+    return fetched
+
+
+class MirrorClient:
+    """ BrapiClient reading a harvested mirror instead of querying the endpoint """
+
+    def __init__(self, mirror: Mirror, logger: logging.Logger):
+        self.mirror = mirror
+        self.endpoint = mirror.endpoint
+        self.logger = logger
+        self.begin_run()
+
+    def _missing(self, what: str):
+        self.logger.error("%s is not in the mirror %s", what, self.mirror.path)
+        return RuntimeError(f"{what} is not in the mirror")
+
+    def get_study(self, study_id: str) -> dict:
+        study = self.mirror.study(str(study_id))
+        if study is None:
+            raise self._missing(f"Study {study_id}")
+        return study
+
+    def get_study_germplasms(self, study_id: str) -> Iterable:
+        yield from self.mirror.study_germplasms(str(study_id))
+
+    def get_study_observation_units(self, study_id: str, partitions: int = 1) -> Iterable:
+        # a local read, the pages are not partitioned
+        yield from self.mirror.observation_units(str(study_id))
+
+    def get_study_observations(self, study_id: str, start: str = None, end: str = None, level: str = None,
+                               variable_ids: List[str] = None) -> Iterable:
+        units = self.mirror.observation_units(str(study_id), level)
+        yield from filter_observations(units, start, end, None, variable_ids)
+
+    def get_germplasm(self, germplasm_id: str) -> dict:
+        germplasm = self.mirror.germplasm(str(germplasm_id))
+        if germplasm is None:
+            raise self._missing(f"Germplasm {germplasm_id}")
+        return germplasm
+
+    def get_study_observed_variables(self, study_id: str, observed: Iterable[str] = None) -> Iterable:
+        yield from self.mirror.study_variables(str(study_id))
+
+    def count_study(self, study_id: str, kinds: tuple = ('observation_units', 'germplasm', 'variables')) -> dict:
+        counts = self.mirror.count_study(str(study_id))
+        return {kind: counts[kind] for kind in kinds}
+
+    def get_trials(self, trial_ids: List[str] = None) -> Iterable:
+        if not trial_ids:
+            self.logger.info("Not enough parameters, provide TRIAL or STUDY IDs")
+            exit(1)
+        elif trial_ids == ["all"]:
+            yield from self.mirror.trials()
+        else:
+            for trial_id in trial_ids:
+                trial = self.mirror.trial(str(trial_id))
+                if trial is None:
+                    raise self._missing(f"Trial {trial_id}")
+                yield trial
+
+    def prefetch_studies(self, study_ids: List[str]) -> bool:
+        return False
+
+    def begin_run(self):
+        # no HTTP call is made, only the figures of the run are exported
+        self.metrics = ClientMetrics(self.endpoint)
+
+    def identity_report(self) -> dict:
+        # the mirror is local, nothing to save
+        return {}
+
+    def shared_cache_report(self) -> dict:
+        return {}
+
+    def get_taxonId(self, genus, species):
+        taxon = self.mirror.resource('taxon:' + '%20'.join([str(genus), str(species)]))
+        if taxon is None:
+            raise self._missing(f"Taxon of {genus} {species}")
+        return taxon
+
+    def get_ontologies(self):
+        ontologies = self.mirror.resource('ontologies')
+        if ontologies is None:
+            raise self._missing("The ontologies registry")
+        return ontologies
+
+    def close(self):
+        self.mirror.close()
+
+
+if __name__ == '__main__':
+    harvest_parser = argparse.ArgumentParser(description="Harvest BrAPI trials into a local mirror")
+    harvest_parser.add_argument('-e', '--endpoint', help="a BrAPi server endpoint", type=str, required=True)
+    harvest_parser.add_argument('-t', '--trials', help="comma separated list of trial Ids. 'all' to get all trials",
+                                type=str, action='append', required=True)
+    harvest_parser.add_argument('-m', '--mirror', help="SQLite file of the mirror", type=str, required=True)
+    harvest_parser.add_argument('--refresh', help="harvest every study again, even unchanged ones",
+                                action="store_true")
+    args = harvest_parser.parse_args()
+
+    import brapi_to_isa
+    brapi_to_isa.setup_logging()
+    harvest_client = BrapiClient(args.endpoint, brapi_to_isa.logger)
+    harvest_mirror = Mirror(args.mirror, args.endpoint)
+    try:
+        print(json.dumps(harvest(harvest_client, harvest_mirror, args.trials, args.refresh), indent=4))
+    finally:
+        harvest_client.close()
+        harvest_mirror.close()
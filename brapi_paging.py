@@ -0,0 +1,235 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+import brapi_calls
+
+# Page sizes used when nothing is known about an endpoint call
+DEFAULT_PAGE_SIZE = 1000
+MIN_PAGE_SIZE = 10
+MAX_PAGE_SIZE = 1000
+# A page should come back well before the usual gateway timeouts (30 to 60 seconds)
+TARGET_LATENCY = 10.0
+# and without buffering huge bodies
+TARGET_PAGE_BYTES = 16 * 1024 * 1024
+# Throttling (429/503) handling
+MAX_THROTTLE_RETRIES = 5
+MAX_RETRY_AFTER = 120.0
+# Weight of the last observation in the latency/size moving averages
+EWMA_WEIGHT = 0.3
+
+
+def call_key(path: str) -> str:
+    """
+    Name of the BrAPI call of a path, the identifiers are left out ('/studies/1/germplasm' -> 'germplasm')
+    The results of a search are named by entity ('/search/studies/<searchResultsDbId>' -> 'search/studies')
+    """
+    segments = [s for s in path.split('?')[0].strip('/').split('/') if s]
+    if len(segments) >= 2 and segments[0].lower() == 'search':
+        return 'search/' + segments[1].lower()
+    return segments[-1].lower() if segments else ''
+
+
+def _profile_file(endpoint: str) -> str:
+    digest = hashlib.sha1(endpoint.encode('utf-8')).hexdigest()
+    return os.path.join(brapi_calls.CACHE_DIR, 'profiles', digest + '.json')
+
+
+def parse_retry_after(value, default: float) -> float:
+    """Seconds to wait according to a Retry-After header (only the delay-seconds form is supported)"""
+    if value and re.match(r'^\s*\d+(\.\d+)?\s*$', str(value)):
+        return min(float(value), MAX_RETRY_AFTER)
+    return default
+
+
+class EndpointProfile:
+    """ Latency, payload and error statistics of the calls of a BrAPI endpoint
+
+    The profile is shared by all the pagers of an endpoint and persisted so that later runs start
+    with the page sizes that worked.
+    """
+
+    _registry = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(self, endpoint: str, calls: dict = None):
+        self.endpoint = endpoint
+        self.calls = calls or {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_endpoint(cls, endpoint: str) -> 'EndpointProfile':
+        with cls._registry_lock:
+            profile = cls._registry.get(endpoint)
+            if profile is None:
+                profile = cls(endpoint, cls._load(endpoint))
+                cls._registry[endpoint] = profile
+            return profile
+
+    @classmethod
+    def clear(cls):
+        with cls._registry_lock:
+            cls._registry.clear()
+
+    @staticmethod
+    def _load(endpoint: str) -> dict:
+        try:
+            with open(_profile_file(endpoint), 'r', encoding='utf-8') as fh:
+                cached = json.load(fh)
+        except (OSError, ValueError):
+            return {}
+        return cached.get('calls', {}) if cached.get('endpoint') == endpoint else {}
+
+    def save(self, logger: logging.Logger = None):
+        path = _profile_file(self.endpoint)
+        with self._lock:
+            content = {'endpoint': self.endpoint, 'calls': self.calls}
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = path + '.' + str(os.getpid())
+                with open(tmp_path, 'w', encoding='utf-8') as fh:
+                    json.dump(content, fh)
+                os.replace(tmp_path, path)
+            except OSError as oserror:
+                if logger:
+                    logger.warning("Could not persist endpoint profile: %s", oserror)
+
+    def get(self, call: str) -> dict:
+        with self._lock:
+            return dict(self.calls.get(call, {}))
+
+    def record_page(self, call: str, page_size: int, latency: float, nbytes: int, nobjects: int):
+        with self._lock:
+            stats = self.calls.setdefault(call, {'errors': {}})
+            stats['page_size'] = page_size
+            stats['pages'] = stats.get('pages', 0) + 1
+            stats['latency'] = _ewma(stats.get('latency'), latency)
+            if nobjects:
+                stats['bytes_per_object'] = _ewma(stats.get('bytes_per_object'), nbytes / nobjects)
+                stats['seconds_per_object'] = _ewma(stats.get('seconds_per_object'), latency / nobjects)
+
+    def record_error(self, call: str, status_code: int):
+        with self._lock:
+            errors = self.calls.setdefault(call, {'errors': {}}).setdefault('errors', {})
+            errors[str(status_code)] = errors.get(str(status_code), 0) + 1
+
+    def record_max_page_size(self, call: str, max_page_size: int):
+        with self._lock:
+            self.calls.setdefault(call, {'errors': {}})['max_page_size'] = max_page_size
+
+
+def _ewma(previous, value):
+    if previous is None:
+        return value
+    return (1 - EWMA_WEIGHT) * previous + EWMA_WEIGHT * value
+
+
+class AdaptivePager:
+    """ Choose the page and page size of the successive requests of a paginated BrAPI call
+
+    The page size grows while pages come back fast and small, shrinks when they get slow or large and
+    drops sharply on gateway timeouts. Sizes are only changed to divisors or multiples of the current
+    size so that the object offset always falls on a page boundary.
+    A pager that is not adaptive only reacts to the responses status and content, never to timings,
+    and neither reads nor updates the persisted endpoint profile.
+    """
+
+    def __init__(self, endpoint: str, path: str, logger: logging.Logger, profile: EndpointProfile = None,
+                 adaptive: bool = True, sleep=None):
+        self.logger = logger
+        self.call = call_key(path)
+        self.adaptive = adaptive
+        self._sleep = sleep or time.sleep
+        if adaptive:
+            self.profile = profile or EndpointProfile.for_endpoint(endpoint)
+        else:
+            self.profile = EndpointProfile(endpoint)
+        stats = self.profile.get(self.call)
+        self.max_size = int(stats.get('max_page_size', MAX_PAGE_SIZE))
+        self.size = max(MIN_PAGE_SIZE, min(int(stats.get('page_size', DEFAULT_PAGE_SIZE)), self.max_size))
+        self.offset = 0
+        self.throttle_retries = 0
+        self._desired = self.size
+
+    @property
+    def page(self) -> int:
+        return self.offset // self.size
+
+    def observe(self, latency: float, nbytes: int, nobjects: int):
+        """Record a successful page and choose the size of the next ones"""
+        self.throttle_retries = 0
+        self.profile.record_page(self.call, self.size, latency, nbytes, nobjects)
+        self._desired = self.size
+        if not self.adaptive or nobjects < self.size:
+            # short page: last page, or the endpoint caps the page size
+            return
+        if latency > TARGET_LATENCY or nbytes > TARGET_PAGE_BYTES:
+            ratio = min(TARGET_LATENCY / max(latency, 1e-6), TARGET_PAGE_BYTES / max(nbytes, 1))
+            self._desired = int(self.size * ratio)
+        elif latency < TARGET_LATENCY / 2 and nbytes < TARGET_PAGE_BYTES / 2:
+            self._desired = self.size * 2
+
+    def advance(self, nobjects: int, total_pages: int) -> bool:
+        """Move to the next page, return False when the last page was reached"""
+        last_page = not nobjects or self.page + 1 >= total_pages
+        if not last_page and nobjects < self.size:
+            self.logger.info("Endpoint caps %s pages to %d objects", self.call, nobjects)
+            if self.offset % nobjects:
+                self.logger.warning("Page size cap of %s is not aligned with the objects already fetched",
+                                    self.call)
+            self.size = self.max_size = nobjects
+            if nobjects >= MIN_PAGE_SIZE:
+                self.profile.record_max_page_size(self.call, nobjects)
+        self.offset += nobjects
+        if last_page:
+            return False
+        if self._desired < self.size:
+            self._shrink(self._desired)
+        elif self._desired > self.size:
+            self._grow(self._desired)
+        return True
+
+    def timed_out(self) -> bool:
+        """Shrink the page size after a gateway timeout, return False when it can not shrink anymore"""
+        self.profile.record_error(self.call, 504)
+        previous = self.size
+        self._shrink(self.size // 4)
+        if self.size == previous:
+            return False
+        self.logger.info("504 Gateway Timeout Error, testing with pagesize = %d", self.size)
+        return True
+
+    def throttled(self, response) -> bool:
+        """Wait as requested by a 429/503 response, return False when the retries are exhausted"""
+        self.profile.record_error(self.call, response.status_code)
+        if self.throttle_retries >= MAX_THROTTLE_RETRIES:
+            return False
+        delay = parse_retry_after(response.headers.get('Retry-After'), min(2 ** self.throttle_retries, MAX_RETRY_AFTER))
+        self.throttle_retries += 1
+        self.logger.info("%d from endpoint, retrying %s in %.1f seconds", response.status_code, self.call, delay)
+        self._sleep(delay)
+        return True
+
+    def _shrink(self, target: int):
+        # divisors of the current size keep the offset aligned on a page boundary
+        divisors = [size for size in range(MIN_PAGE_SIZE, self.size) if self.size % size == 0]
+        fitting = [size for size in divisors if size <= target]
+        if fitting:
+            self.size = max(fitting)
+        elif divisors:
+            self.size = min(divisors)
+
+    def _grow(self, target: int):
+        # multiples of the current size dividing the offset keep it aligned on a page boundary
+        for size in range(min(target, self.max_size) // self.size * self.size, self.size, -self.size):
+            if self.offset % size == 0:
+                self.size = size
+                return
+
+    def save(self):
+        if self.adaptive:
+            self.profile.save(self.logger)
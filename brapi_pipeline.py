@@ -0,0 +1,85 @@
+import queue
+import threading
+from collections.abc import Iterable
+from typing import Callable, List
+
+_END = object()
+# Seconds between two checks of the stop flag by a stage blocked on a queue
+_POLL = 0.1
+
+
+class Pipeline:
+    """ Items processed by consecutive stages running in their own thread
+
+    The stages are connected by bounded queues: a stage runs ahead of the next one by at most `maxsize`
+    items, then waits for it (backpressure). Items keep their order. When a stage fails, the other stages
+    stop and the error is raised by `run`.
+    """
+
+    def __init__(self, stages: List[Callable], maxsize: int = 1):
+        self.stages = stages
+        self.maxsize = maxsize
+        self._stop = threading.Event()
+        self._errors = []
+
+    def _put(self, out: queue.Queue, item) -> bool:
+        while not self._stop.is_set():
+            try:
+                out.put(item, timeout=_POLL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, source: queue.Queue):
+        while not self._stop.is_set():
+            try:
+                return source.get(timeout=_POLL)
+            except queue.Empty:
+                pass
+        return _END
+
+    def _feed(self, items: Iterable, out: queue.Queue):
+        try:
+            for item in items:
+                if not self._put(out, item):
+                    return
+            self._put(out, _END)
+        except Exception as e:
+            self._fail(e)
+
+    def _work(self, stage: Callable, source: queue.Queue, out: queue.Queue):
+        try:
+            while True:
+                item = self._get(source)
+                if item is _END:
+                    self._put(out, _END)
+                    return
+                if not self._put(out, stage(item)):
+                    return
+        except Exception as e:
+            self._fail(e)
+
+    def _fail(self, error: Exception):
+        self._errors.append(error)
+        self._stop.set()
+
+    def run(self, items: Iterable) -> list:
+        """Run the items through the stages, return the results of the last stage"""
+        queues = [queue.Queue(maxsize=self.maxsize) for _ in range(len(self.stages) + 1)]
+        threads = [threading.Thread(target=self._feed, args=(items, queues[0]), daemon=True)]
+        for i, stage in enumerate(self.stages):
+            threads.append(threading.Thread(target=self._work, args=(stage, queues[i], queues[i + 1]), daemon=True))
+        for thread in threads:
+            thread.start()
+        results = []
+        while True:
+            result = self._get(queues[-1])
+            if result is _END:
+                break
+            results.append(result)
+        for thread in threads:
+            thread.join()
+        if self._errors:
+            raise self._errors[0]
+        return results
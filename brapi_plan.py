@@ -0,0 +1,201 @@
+import math
+import sys
+import threading
+import time
+
+from brapi_paging import DEFAULT_PAGE_SIZE, EndpointProfile
+
+# Costs measured on benchmark studies of 1000 to 20000 observation units holding 6 observations each, used when
+# the endpoint profile (see brapi_paging) has no figure for a call yet
+BYTES_PER_OBJECT = {'observation_units': 1800, 'germplasm': 1000, 'variables': 1500}
+# latency of a page or of a single object request
+REQUEST_SECONDS = 0.5
+# compact observation units of a study in the pipeline, and the ISA objects kept until the investigation is dumped
+UNIT_BYTES = 1850
+ISA_BYTES_PER_UNIT = 3500
+# decoding the units and building the ISA graph and the data files
+CPU_SECONDS_PER_UNIT = 0.0004
+# isatools writes the assay tables in a time growing with the square of the number of units of a study
+DUMP_SECONDS_PER_SQUARED_UNIT = 6.5e-7
+# Profile calls of each kind of objects, by preference
+PROFILE_CALLS = {'observation_units': ('observationunits', 'phenotypes-search'), 'germplasm': ('germplasm',),
+                 'variables': ('observationvariables', 'variables')}
+# Seconds between two progress lines on a terminal, and in a file
+PROGRESS_INTERVAL = 1.0
+PROGRESS_FILE_INTERVAL = 30.0
+
+
+def _call_stats(profile: EndpointProfile, kind: str) -> dict:
+    for call in PROFILE_CALLS[kind]:
+        stats = profile.get(call)
+        if stats.get('pages'):
+            return stats
+    return {}
+
+
+def estimate_study(counts: dict, profile: EndpointProfile = None, pipelined: int = 1) -> dict:
+    """
+    Requests, bytes, memory and time of the conversion of a study
+    :param counts number of observation_units, germplasm and variables of the study, None when unknown
+    :param profile statistics of the endpoint calls, the benchmark figures are used without it
+    :param pipelined number of studies held by the pipeline besides the one being built
+    """
+    requests = 1
+    nbytes = 0
+    seconds = REQUEST_SECONDS
+    for kind in PROFILE_CALLS:
+        count = counts.get(kind) or 0
+        stats = _call_stats(profile, kind) if profile is not None else {}
+        pages = max(1, math.ceil(count / int(stats.get('page_size', DEFAULT_PAGE_SIZE))))
+        requests += pages
+        nbytes += count * stats.get('bytes_per_object', BYTES_PER_OBJECT[kind])
+        seconds += pages * stats.get('latency', REQUEST_SECONDS)
+    # at most one request per germplasm for the attributes missing from the study germplasm
+    germplasm = counts.get('germplasm') or 0
+    requests += germplasm
+    seconds += germplasm * REQUEST_SECONDS
+    units = counts.get('observation_units') or 0
+    return {'requests': requests, 'bytes': int(nbytes), 'fetch_seconds': seconds,
+            'cpu_seconds': units * CPU_SECONDS_PER_UNIT + units ** 2 * DUMP_SECONDS_PER_SQUARED_UNIT,
+            'memory_bytes': units * (UNIT_BYTES * (pipelined + 1) + ISA_BYTES_PER_UNIT)}
+
+
+def plan_trial(client, trial: dict, study_ids: list, remote: bool = True, pipelined: int = 1) -> dict:
+    """
+    Count the objects of the studies of a trial with single object pages and estimate the cost of its conversion
+    :param remote False when the client reads a mirror: no request is made
+    :return the trial plan, with its studies and totals
+    """
+    profile = EndpointProfile.for_endpoint(client.endpoint) if remote else None
+    studies = []
+    for study_id in study_ids:
+        try:
+            counts = client.count_study(study_id)
+        except Exception as e:
+            client.logger.warning("Could not count the objects of study %s: %s", study_id, e)
+            counts = {kind: None for kind in PROFILE_CALLS}
+        estimate = estimate_study(counts, profile, pipelined)
+        if not remote:
+            estimate.update(requests=0, bytes=0, fetch_seconds=0.0)
+        studies.append(dict(counts, study_id=study_id, **estimate))
+    totals = {key: sum(study[key] or 0 for study in studies)
+              for key in ('observation_units', 'germplasm', 'variables', 'requests', 'bytes', 'fetch_seconds',
+                          'cpu_seconds')}
+    # the ISA objects of every study stay in memory until the trial is dumped
+    largest = max([study['observation_units'] or 0 for study in studies] or [0])
+    totals['memory_bytes'] = (totals['observation_units'] * ISA_BYTES_PER_UNIT
+                              + largest * UNIT_BYTES * (pipelined + 1))
+    totals['seconds'] = totals['fetch_seconds'] + totals['cpu_seconds']
+    return {'trial_id': trial['trialDbId'], 'trial_name': trial['trialName'], 'studies': studies, 'totals': totals}
+
+
+def _duration(seconds: float) -> str:
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return "{}h{:02d}m".format(seconds // 3600, seconds % 3600 // 60)
+    if seconds >= 60:
+        return "{}m{:02d}s".format(seconds // 60, seconds % 60)
+    return "{}s".format(seconds)
+
+
+def _count(value) -> str:
+    return '?' if value is None else str(value)
+
+
+def format_plan(plans: list) -> str:
+    """Table of the studies of the trial plans, with the totals of each trial"""
+    lines = []
+    row = "{:<20} {:>10} {:>10} {:>10} {:>9} {:>10} {:>10} {:>10}"
+    for plan in plans:
+        totals = plan['totals']
+        lines += ["Trial {} ({}): {} studies".format(plan['trial_id'], plan['trial_name'], len(plan['studies'])),
+                  row.format('study', 'units', 'germplasm', 'variables', 'requests', 'MiB', 'memory MiB',
+                             'time')]
+        for study in plan['studies'] + [dict(totals, study_id='total')]:
+            lines.append(row.format(study['study_id'], _count(study['observation_units']),
+                                    _count(study['germplasm']), _count(study['variables']), study['requests'],
+                                    "{:.1f}".format(study['bytes'] / 2 ** 20),
+                                    "{:.1f}".format(study['memory_bytes'] / 2 ** 20),
+                                    _duration(study['fetch_seconds'] + study['cpu_seconds'])))
+        lines.append('')
+    return '\n'.join(lines)
+
+
+class Progress:
+    """ Progress of the conversion of a trial with its expected end time
+
+    The work is measured in observation units: each unit is fetched (counted page by page, see BrapiClient.on_page,
+    or study by study) then built. The ETA assumes the remaining units go as fast as the previous ones.
+    """
+
+    def __init__(self, name: str, studies: int, units: int, stream=None, interval: float = None):
+        self.name = name
+        self.studies = studies
+        self.units = units
+        self.stream = stream or sys.stderr
+        self.tty = self.stream.isatty()
+        if interval is None:
+            interval = PROGRESS_INTERVAL if self.tty else PROGRESS_FILE_INTERVAL
+        self.interval = interval
+        self.started = time.time()
+        self.paged_units = 0
+        self.fetched_units = 0
+        self.built_units = 0
+        self.done_studies = 0
+        self._rendered = 0.0
+        self._lock = threading.Lock()
+
+    def page(self, path: str, count: int):
+        """BrapiClient.on_page callback"""
+        segments = [segment.lower() for segment in path.split('/')]
+        if 'observationunits' in segments or 'phenotypes-search' in segments:
+            with self._lock:
+                self.paged_units += count
+            self.render()
+
+    def fetched(self, units: int):
+        with self._lock:
+            self.fetched_units += units
+        self.render()
+
+    def built(self, units: int):
+        with self._lock:
+            self.built_units += units
+        self.render()
+
+    def written(self):
+        with self._lock:
+            self.done_studies += 1
+        self.render()
+
+    def eta(self):
+        """Seconds to the end of the trial, None before any unit was fetched or when the units are unknown"""
+        with self._lock:
+            fetched = min(max(self.paged_units, self.fetched_units), self.units)
+            done = (fetched + min(self.built_units, self.units)) / (2 * self.units) if self.units else 0
+        if not done:
+            return None
+        return (time.time() - self.started) * (1 - done) / done
+
+    def line(self) -> str:
+        eta = self.eta()
+        return "{}: {}/{} studies, {}/{} observation units fetched, {} built, ETA {}".format(
+            self.name, self.done_studies, self.studies, min(max(self.paged_units, self.fetched_units), self.units),
+            self.units, min(self.built_units, self.units), '?' if eta is None else _duration(eta))
+
+    def render(self, force: bool = False):
+        now = time.time()
+        if not force and now - self._rendered < self.interval:
+            return
+        self._rendered = now
+        if self.tty:
+            self.stream.write('\r' + self.line() + '\x1b[K')
+        else:
+            self.stream.write(self.line() + '\n')
+        self.stream.flush()
+
+    def close(self):
+        self.render(force=True)
+        if self.tty:
+            self.stream.write('\n')
+            self.stream.flush()
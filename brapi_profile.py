@@ -0,0 +1,156 @@
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import tracemalloc
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+# Paths of a collapsed stack carrying less time (seconds) are left out
+MIN_STACK_TIME = 1e-5
+# Lines in the allocation table of a stage
+TOP_ALLOCATIONS = 25
+# From Python 3.12 cProfile runs on sys.monitoring: a single profile can be enabled at a time in the process, and it
+# records the calls of every thread
+_PROCESS_WIDE = sys.version_info >= (3, 12)
+
+
+def _label(func):
+    filename, line, name = func
+    if filename == '~':
+        return name
+    return "{}:{}:{}".format(os.path.basename(filename), line, name)
+
+
+def collapsed_stacks(stats: pstats.Stats, root: str):
+    """
+    Collapsed stacks (flamegraph.pl, speedscope) estimated from the call graph of a profile.
+    cProfile only records caller/callee pairs: the time of a function called along several paths is split
+    between them in proportion of the time spent in each call.
+    :param stats profile of a stage
+    :param root name of the frame at the bottom of the stacks
+    :return Counter of microseconds by ';' separated stack
+    """
+    callees = defaultdict(dict)
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+        for caller, edge in callers.items():
+            callees[caller][func] = edge[3]
+    stacks = Counter()
+
+    def walk(func, stack, on_stack, share):
+        cc, nc, tt, ct, callers = stats.stats[func]
+        stack = stack + [_label(func)]
+        if tt * share >= MIN_STACK_TIME:
+            stacks[';'.join(stack)] += int(tt * share * 1e6)
+        for callee, time in callees[func].items():
+            time *= share
+            if callee not in on_stack and time >= MIN_STACK_TIME and stats.stats[callee][3]:
+                walk(callee, stack, on_stack | {callee}, time / stats.stats[callee][3])
+
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+        if not callers:
+            walk(func, [root], {func}, 1.0)
+    return stacks
+
+
+class StageProfiler:
+    """ CPU profiles and, optionally, allocations of the stages of a conversion
+
+    A stage is profiled on its own: the profile of an enclosing stage is paused while a nested stage runs.
+    A stage running in several threads gets a profile per thread, merged when written. From Python 3.12, only one
+    thread at a time is profiled: the stages another thread starts meanwhile are counted but not profiled, and the
+    profile of a stage includes the calls the other threads make while it runs.
+    The allocations of a stage are the difference between tracemalloc snapshots taken when it starts and ends,
+    they include the nested stages and, as tracemalloc is process wide, the stages running concurrently.
+    """
+
+    def __init__(self, memory=False):
+        self.memory = memory
+        self._profiles = defaultdict(list)
+        self._allocations = defaultdict(Counter)
+        self._calls = Counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # thread whose stages are profiled, with _PROCESS_WIDE
+        self._owner = None
+        self._tracing = memory and not tracemalloc.is_tracing()
+        if self._tracing:
+            tracemalloc.start()
+
+    def _profile(self, name):
+        """Profile of the stage in this thread, None when another thread is profiled"""
+        ident = threading.get_ident()
+        with self._lock:
+            if _PROCESS_WIDE:
+                if self._owner not in (None, ident):
+                    return None
+                self._owner = ident
+            for thread, profile in self._profiles[name]:
+                if thread == ident:
+                    return profile
+            profile = cProfile.Profile()
+            self._profiles[name].append((ident, profile))
+            return profile
+
+    def _snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+
+    @contextmanager
+    def stage(self, name):
+        stack = self._local.__dict__.setdefault('stack', [])
+        if stack and stack[-1] is not None:
+            stack[-1].disable()
+        before = self._snapshot() if self.memory else None
+        profile = self._profile(name)
+        stack.append(profile)
+        if profile is not None:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            stack.pop()
+            with self._lock:
+                self._calls[name] += 1
+                if self._owner == threading.get_ident() and all(outer is None for outer in stack):
+                    self._owner = None
+            if before is not None:
+                allocations = self._snapshot().compare_to(before, 'lineno')
+                with self._lock:
+                    for statistic in allocations:
+                        self._allocations[name][str(statistic.traceback[0])] += statistic.size_diff
+            if stack and stack[-1] is not None:
+                stack[-1].enable()
+
+    def write(self, directory, logger):
+        """ Write profile_<stage>.prof (pstats), profile.collapsed (all the stages) and, with memory,
+        profile_allocations.txt in directory, then start over
+        """
+        stacks = Counter()
+        for name, profiles in self._profiles.items():
+            stats = pstats.Stats(*[profile for thread, profile in profiles])
+            stats.dump_stats(os.path.join(directory, 'profile_' + name + '.prof'))
+            stacks.update(collapsed_stacks(stats, name))
+            logger.info("Profile of " + name + ": " + str(self._calls[name]) + " calls, "
+                        + "{:.3f}".format(stats.total_tt) + " s")
+        with open(os.path.join(directory, 'profile.collapsed'), 'w', encoding="utf-8") as fh:
+            for stack, microseconds in sorted(stacks.items()):
+                if microseconds:
+                    fh.write(stack + ' ' + str(microseconds) + '\n')
+        if self.memory:
+            with open(os.path.join(directory, 'profile_allocations.txt'), 'w', encoding="utf-8") as fh:
+                for name, allocations in self._allocations.items():
+                    fh.write("{} ({} calls): {:+.1f} KiB\n".format(name, self._calls[name],
+                                                                   sum(allocations.values()) / 1024))
+                    for line, size in allocations.most_common(TOP_ALLOCATIONS):
+                        fh.write("    {:+12.1f} KiB  {}\n".format(size / 1024, line))
+        logger.info("Profiles written in " + directory)
+        self._profiles.clear()
+        self._allocations.clear()
+        self._calls.clear()
+
+    def close(self):
+        if self._tracing:
+            tracemalloc.stop()
@@ -0,0 +1,168 @@
+import hashlib
+import logging
+import os
+import struct
+import threading
+import time
+from collections import Counter, defaultdict, deque
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover (Windows)
+    fcntl = None
+
+import brapi_calls
+
+# A full bucket holds BURST_SECONDS of requests
+BURST_SECONDS = 1.0
+# Hedged GET requests: percentile of the latency of a call after which a duplicate request is sent, share of the
+# requests that may be duplicated, and latencies kept by call (hedging starts after HEDGE_MIN_SAMPLES of them)
+HEDGE_PERCENTILE = 95.0
+HEDGE_BUDGET = 0.05
+HEDGE_MIN_SAMPLES = 20
+HEDGE_WINDOW = 200
+# responses faster than this are never hedged
+HEDGE_MIN_SECONDS = 0.1
+# tokens and time of the last update of a bucket
+_STATE = struct.Struct('<dd')
+
+logger = logging.getLogger('brapi_converter')
+
+
+def _bucket_file(endpoint: str) -> str:
+    digest = hashlib.sha1(endpoint.encode('utf-8')).hexdigest()
+    return os.path.join(brapi_calls.CACHE_DIR, 'ratelimits', digest)
+
+
+class RateLimiter:
+    """ Token bucket of the requests sent to an endpoint by all the processes of the host
+
+    The bucket is kept in a small file of the cache directory, updated under an exclusive lock, so that the
+    conversions, workers and service processes of a host share `rate` requests per second. Without fcntl
+    (Windows) or a writable cache directory, the bucket is only shared by the threads of the process.
+    """
+
+    _registry = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(self, endpoint: str, rate: float, burst: float = None, path: str = None, clock=time.time,
+                 sleep=time.sleep):
+        if rate <= 0:
+            raise ValueError("The rate limit must be positive")
+        self.endpoint = endpoint
+        self.rate = rate
+        self.burst = burst or max(1.0, rate * BURST_SECONDS)
+        self._clock = clock
+        self._sleep = sleep
+        # flock does not exclude the threads of a process
+        self._lock = threading.Lock()
+        self._fd = None
+        self._state = (self.burst, clock())
+        if fcntl is not None:
+            path = path or _bucket_file(endpoint)
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            except OSError as e:
+                logger.warning("Rate limit of %s not shared with the other processes: %s", endpoint, e)
+
+    @classmethod
+    def for_endpoint(cls, endpoint: str, rate: float) -> 'RateLimiter':
+        """Limiter of an endpoint shared by the clients of the process"""
+        with cls._registry_lock:
+            limiter = cls._registry.get((endpoint, rate))
+            if limiter is None:
+                limiter = cls._registry[(endpoint, rate)] = cls(endpoint, rate)
+            return limiter
+
+    def _read(self) -> tuple:
+        if self._fd is None:
+            return self._state
+        data = os.pread(self._fd, _STATE.size, 0)
+        return _STATE.unpack(data) if len(data) == _STATE.size else (self.burst, self._clock())
+
+    def _write(self, tokens: float, updated: float):
+        if self._fd is None:
+            self._state = (tokens, updated)
+        else:
+            os.pwrite(self._fd, _STATE.pack(tokens, updated), 0)
+
+    def _take(self) -> float:
+        """Take a token, return 0 or the seconds to wait for the next one when the bucket is empty"""
+        with self._lock:
+            if self._fd is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                tokens, updated = self._read()
+                now = self._clock()
+                tokens = min(self.burst, tokens + max(0.0, now - updated) * self.rate)
+                wait = 0.0
+                if tokens >= 1:
+                    tokens -= 1
+                else:
+                    wait = (1 - tokens) / self.rate
+                self._write(tokens, now)
+                return wait
+            finally:
+                if self._fd is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def acquire(self) -> float:
+        """Wait for a token, return the seconds waited"""
+        waited = 0.0
+        wait = self._take()
+        while wait:
+            self._sleep(wait)
+            waited += wait
+            wait = self._take()
+        return waited
+
+    def try_acquire(self) -> bool:
+        """Take a token if one is available right away"""
+        return not self._take()
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class HedgePolicy:
+    """ When to send a duplicate of a slow idempotent request
+
+    A GET still waiting for its response after the `percentile` latency of its call is sent a second time and
+    the first response wins. At most `budget` of the requests are duplicated, so that hedging trims the tail
+    latency without doubling the load of a slow endpoint.
+    """
+
+    def __init__(self, percentile: float = HEDGE_PERCENTILE, budget: float = HEDGE_BUDGET,
+                 min_samples: int = HEDGE_MIN_SAMPLES, window: int = HEDGE_WINDOW):
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self._latencies = defaultdict(lambda: deque(maxlen=window))
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.hedged = Counter()
+
+    def delay(self, call: str):
+        """Count a request of call, return the seconds after which it is hedged or None when it is not"""
+        with self._lock:
+            self.requests += 1
+            latencies = sorted(self._latencies[call])
+        if len(latencies) < self.min_samples:
+            return None
+        return max(HEDGE_MIN_SECONDS, latencies[min(len(latencies) - 1, int(len(latencies) * self.percentile / 100))])
+
+    def spend(self, call: str) -> bool:
+        """Take a hedge from the budget"""
+        with self._lock:
+            if sum(self.hedged.values()) + 1 > self.budget * self.requests:
+                return False
+            self.hedged[call] += 1
+            return True
+
+    def observe(self, call: str, seconds: float):
+        """Record the time to the response of a request of call"""
+        with self._lock:
+            self._latencies[call].append(seconds)
@@ -0,0 +1,245 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import brapi_to_isa
+from brapi_client import BrapiClient
+from brapi_shared_cache import shared_cache_file
+from brapi_to_isa_converter import BrapiToIsaConverter
+
+logger = logging.getLogger('brapi_converter')
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+FINISHED = (DONE, FAILED)
+# Seconds an events stream waits for a change before repeating the current state
+EVENTS_KEEPALIVE = 30
+
+
+class QueueFull(Exception):
+    pass
+
+
+def job_arguments(job: dict) -> list:
+    """Translate a conversion job into brapi_to_isa command line arguments"""
+    endpoint = job.get('endpoint')
+    if not isinstance(endpoint, str) or not endpoint:
+        raise ValueError("A job needs an endpoint")
+    argv = ['-e', endpoint]
+    for option, name in (('-t', 'trials'), ('-s', 'studies')):
+        ids = job.get(name) or []
+        if isinstance(ids, str):
+            ids = ids.split(',')
+        argv += [arg for db_id in ids for arg in (option, str(db_id))]
+    if '-t' not in argv and '-s' not in argv:
+        raise ValueError("A job needs trials or studies")
+    if not job.get('json', True):
+        argv.append('-J')
+    if not job.get('validator', True):
+        argv.append('-V')
+    if job.get('flatten', False):
+        argv.append('-F')
+    if 'validator_engine' in job:
+        argv += ['--validator-engine', job['validator_engine']]
+    return argv
+
+
+# Worker process state: the warm client and converter of each endpoint, the status events queue and the file of
+# the cache shared by the workers
+_warm = {}
+_events = None
+_shared_cache = None
+
+
+def init_worker(events, shared_cache: str = None):
+    """Prepare a worker process, paying the isatools import once rather than once per job"""
+    global _events, _shared_cache
+    _events = events
+    _shared_cache = shared_cache
+    from isatools import isatab, model  # noqa: F401
+
+
+def warm_pair(endpoint: str) -> tuple:
+    """Return the client and converter of an endpoint, created on the first job of the worker"""
+    if endpoint not in _warm:
+        client = BrapiClient(endpoint, logger, shared_cache=_shared_cache)
+        _warm[endpoint] = (client, BrapiToIsaConverter(logger, endpoint, client))
+    return _warm[endpoint]
+
+
+def run_job(job_id: str, endpoint: str, argv: list) -> list:
+    """Run a conversion job in a worker process, return the absolute paths of its output directories"""
+    if _events is not None:
+        _events.put((job_id, RUNNING))
+    client, converter = warm_pair(endpoint)
+    return [os.path.abspath(path) for path in brapi_to_isa.main(argv, client=client, converter=converter)]
+
+
+class ConversionService:
+    """ Conversion jobs run by a pool of warm worker processes
+
+    Each worker keeps one BrapiClient and BrapiToIsaConverter per endpoint, so the calls, ontologies,
+    germplasm and taxon caches survive from one job to the next. With `shared_cache`, the germplasm, taxon ids,
+    ontologies and calls decisions downloaded by a worker are read by the others from that file (see
+    SharedCache). At most `max_queue` jobs are queued or running, further submissions are refused.
+    """
+
+    def __init__(self, workers: int = 2, max_queue: int = 64, executor=None, events=None, shared_cache: str = None):
+        self.max_queue = max_queue
+        self.jobs = {}
+        self._condition = threading.Condition()
+        self._events = events if events is not None else multiprocessing.Queue()
+        self.executor = executor or ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                                        initargs=(self._events, shared_cache))
+        self._listener = threading.Thread(target=self._listen, daemon=True)
+        self._listener.start()
+
+    def _update(self, job_id: str, **changes):
+        with self._condition:
+            job = self.jobs[job_id]
+            if job['status'] in FINISHED:
+                return
+            job.update(changes, version=job['version'] + 1, updated=time.time())
+            self._condition.notify_all()
+
+    def _listen(self):
+        while True:
+            event = self._events.get()
+            if event is None:
+                return
+            job_id, status = event
+            self._update(job_id, status=status)
+
+    def _finished(self, job_id: str, future):
+        try:
+            self._update(job_id, status=DONE, outputs=future.result())
+        except Exception as e:
+            logger.exception("Conversion job %s failed", job_id)
+            self._update(job_id, status=FAILED, error=str(e))
+
+    def submit(self, job: dict) -> dict:
+        """Queue a conversion job, raise ValueError for an invalid job and QueueFull when the queue is full"""
+        argv = job_arguments(job)
+        with self._condition:
+            pending = sum(1 for j in self.jobs.values() if j['status'] not in FINISHED)
+            if pending >= self.max_queue:
+                raise QueueFull(f"{pending} jobs are already queued or running")
+            job_id = uuid.uuid4().hex
+            self.jobs[job_id] = {'id': job_id, 'endpoint': job['endpoint'], 'status': QUEUED, 'outputs': [],
+                                 'error': None, 'version': 0, 'updated': time.time()}
+            state = dict(self.jobs[job_id])
+        future = self.executor.submit(run_job, job_id, job['endpoint'], argv)
+        future.add_done_callback(lambda f: self._finished(job_id, f))
+        return state
+
+    def status(self, job_id: str) -> dict:
+        with self._condition:
+            return dict(self.jobs[job_id])
+
+    def wait(self, job_id: str, version: int = -1, timeout: float = None) -> dict:
+        """Return the state of a job once it is newer than `version` (or once the timeout is over)"""
+        with self._condition:
+            self._condition.wait_for(lambda: self.jobs[job_id]['version'] > version, timeout)
+            return dict(self.jobs[job_id])
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+        self._events.put(None)
+        self._listener.join()
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """ HTTP interface of the conversion service
+
+    POST /jobs                  queue a job: {"endpoint": ..., "trials": [...] or "studies": [...],
+                                "json": bool, "validator": bool, "flatten": bool, "validator_engine": ...}
+    GET  /jobs/<id>             state of a job (status, outputs, error)
+    GET  /jobs/<id>/events      JSON lines stream of the job states until it is finished
+    """
+
+    def _send_json(self, code: int, body: dict, headers: dict = None):
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/jobs':
+            self._send_json(404, {'error': 'Not found'})
+            return
+        try:
+            job = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            self._send_json(202, self.server.service.submit(job))
+        except (ValueError, AttributeError) as e:
+            self._send_json(400, {'error': str(e)})
+        except QueueFull as e:
+            self._send_json(503, {'error': str(e)}, {'Retry-After': '10'})
+
+    def do_GET(self):
+        match = re.fullmatch(r'/jobs/(\w+)(/events)?/?', self.path)
+        if not match or match.group(1) not in self.server.service.jobs:
+            self._send_json(404, {'error': 'Not found'})
+            return
+        job_id = match.group(1)
+        if not match.group(2):
+            self._send_json(200, self.server.service.status(job_id))
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        version = -1
+        while True:
+            state = self.server.service.wait(job_id, version, EVENTS_KEEPALIVE)
+            self.wfile.write(json.dumps(state).encode('utf-8') + b'\n')
+            self.wfile.flush()
+            if state['status'] in FINISHED:
+                return
+            version = state['version']
+
+    def log_message(self, format, *args):
+        logger.info("%s - %s", self.address_string(), format % args)
+
+
+def serve(host: str, port: int, service: ConversionService):
+    server = ThreadingHTTPServer((host, port), ServiceHandler)
+    server.service = service
+    logger.info("Conversion service listening on %s:%s", host, port)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        service.shutdown()
+
+
+if __name__ == '__main__':
+    service_parser = argparse.ArgumentParser(description="BrAPI to ISA conversion service")
+    service_parser.add_argument('--host', help="address to listen on", type=str, default='127.0.0.1')
+    service_parser.add_argument('--port', help="port to listen on", type=int, default=8080)
+    service_parser.add_argument('--workers', help="number of concurrent conversions", type=int, default=2)
+    service_parser.add_argument('--queue', help="maximum number of queued or running jobs", type=int, default=64)
+    service_parser.add_argument('--shared-cache', help="file of the cache shared by the workers, removed on exit "
+                                                       "when not given", type=str)
+    args = service_parser.parse_args()
+    brapi_to_isa.setup_logging()
+    shared_cache = args.shared_cache or shared_cache_file('service-' + str(os.getpid()))
+    try:
+        serve(args.host, args.port, ConversionService(args.workers, args.queue, shared_cache=shared_cache))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if not args.shared_cache and os.path.exists(shared_cache):
+            os.remove(shared_cache)
@@ -0,0 +1,184 @@
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import Counter
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover (Windows)
+    fcntl = None
+
+import brapi_calls
+
+# Time (in seconds) a cached value stays valid, and size of the file after which nothing is added anymore
+SHARED_CACHE_TTL = 3600
+SHARED_CACHE_MAX_BYTES = 256 * 2 ** 20
+# values longer than this are compressed
+COMPRESS_MIN_BYTES = 512
+# key length, value length, time stored and flags of a record, followed by the key and the value
+_RECORD = struct.Struct('<IIdB')
+_COMPRESSED = 1
+
+logger = logging.getLogger('brapi_converter')
+
+
+def shared_cache_file(name: str) -> str:
+    """File of a shared cache in the cache directory"""
+    return os.path.join(brapi_calls.CACHE_DIR, 'shared', name)
+
+
+def _encode(value) -> tuple:
+    data = json.dumps(value, separators=(',', ':')).encode('utf-8')
+    if len(data) > COMPRESS_MIN_BYTES:
+        return zlib.compress(data, 1), _COMPRESSED
+    return data, 0
+
+
+def _decode(data: bytes, flags: int):
+    if flags & _COMPRESSED:
+        data = zlib.decompress(data)
+    return json.loads(data)
+
+
+class SharedCache:
+    """ Append-only key-value file shared by the processes of a run
+
+    The values (germplasm, taxon ids, ontologies registry, calls decisions) are appended as compact JSON, zlib
+    compressed when long, under an exclusive lock. Each process maps the file in memory and indexes the offsets
+    of the records appended by any process since its last look, so a value downloaded by one worker is read by
+    the others. The last record of a key wins, records older than `ttl` are misses. Without fcntl (Windows) or a
+    writable file, the values are only cached in the process.
+    """
+
+    _registry = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(self, path: str, ttl: float = SHARED_CACHE_TTL, max_bytes: int = SHARED_CACHE_MAX_BYTES):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # offset of the last record of each key, and end of the records indexed so far
+        self._index = {}
+        self._indexed = 0
+        self._map = None
+        self._local = {}
+        self._full = False
+        self.hits = Counter()
+        self.misses = Counter()
+        self._fd = None
+        if fcntl is not None:
+            try:
+                os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+                self._fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+            except OSError as e:
+                logger.warning("Cache %s not shared with the other processes: %s", path, e)
+
+    @classmethod
+    def for_path(cls, path: str) -> 'SharedCache':
+        """Cache of a file shared by the clients of the process"""
+        with cls._registry_lock:
+            key = (path, os.getpid())
+            cache = cls._registry.get(key)
+            if cache is None:
+                cache = cls._registry[key] = cls(path)
+            return cache
+
+    def _refresh(self):
+        """Index the records appended since the last refresh"""
+        size = os.fstat(self._fd).st_size
+        if size <= self._indexed:
+            return
+        if self._map is not None:
+            self._map.close()
+        self._map = mmap.mmap(self._fd, size, access=mmap.ACCESS_READ)
+        offset = self._indexed
+        while offset + _RECORD.size <= size:
+            key_length, value_length, _, _ = _RECORD.unpack_from(self._map, offset)
+            end = offset + _RECORD.size + key_length + value_length
+            if end > size:
+                break
+            key = self._map[offset + _RECORD.size:offset + _RECORD.size + key_length].decode('utf-8')
+            self._index[key] = offset
+            offset = end
+        self._indexed = offset
+
+    def _record(self, key: str):
+        """Stored time, value data and flags of the last record of key indexed, None when there is none"""
+        offset = self._index.get(key)
+        if offset is None:
+            return None
+        key_length, value_length, stored, flags = _RECORD.unpack_from(self._map, offset)
+        start = offset + _RECORD.size + key_length
+        return stored, self._map[start:start + value_length], flags
+
+    def _read(self, key: str):
+        record = self._local.get(key) if self._fd is None else self._record(key)
+        if self._fd is not None and (record is None or time.time() - record[0] > self.ttl):
+            # another process may have stored (or refreshed) it since the last look
+            fcntl.flock(self._fd, fcntl.LOCK_SH)
+            try:
+                self._refresh()
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            record = self._record(key)
+        return record
+
+    def get(self, key: str, default=None, kind: str = ''):
+        """
+        Return the value of key, or default when it is missing or expired
+        :param kind name the hit rates are reported by (ex 'germplasm/{id}')
+        """
+        with self._lock:
+            record = self._read(key)
+            if record is None or time.time() - record[0] > self.ttl:
+                self.misses[kind] += 1
+                return default
+            self.hits[kind] += 1
+        return _decode(record[1], record[2])
+
+    def put(self, key: str, value):
+        """Append the value of key, values which are not JSON serializable are not cached"""
+        try:
+            data, flags = _encode(value)
+        except (TypeError, ValueError) as e:
+            logger.debug("Value of %s not cached: %s", key, e)
+            return
+        encoded_key = key.encode('utf-8')
+        record = _RECORD.pack(len(encoded_key), len(data), time.time(), flags) + encoded_key + data
+        with self._lock:
+            if self._fd is None:
+                self._local[key] = (time.time(), data, flags)
+                return
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(self._fd).st_size + len(record) > self.max_bytes:
+                    if not self._full:
+                        logger.warning("Shared cache %s is full, new values are not cached", self.path)
+                    self._full = True
+                    return
+                # a single write of the whole record, the readers never see a part of it under their lock
+                os.write(self._fd, record)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def report(self) -> dict:
+        """Hits, misses and hit rate of the lookups of this process, by kind"""
+        with self._lock:
+            return {kind: {'hits': self.hits[kind], 'misses': self.misses[kind],
+                           'hit_rate': self.hits[kind] / (self.hits[kind] + self.misses[kind])}
+                    for kind in sorted(set(self.hits) | set(self.misses))}
+
+    def close(self):
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
@@ -1,12 +1,10 @@
-from isatools.model import Investigation, OntologyAnnotation, OntologySource, Assay, Study, Characteristic, Source, \
-    Sample, Comment, Person
-
-from pycountry_convert import country_alpha3_to_country_alpha2 as a3a2
+# NOTE: isatools and pycountry_convert are heavy to import, the methods using them import them when first called
 import copy
 from collections import defaultdict
 from brapi_client import BrapiClient
 import re
 import platform
+import sys
 
 def att_test(dictionary, attribute, NA=""):
     if attribute in dictionary and dictionary[attribute]:
@@ -24,6 +22,144 @@ PAR_NAinBrAPI = "NA in BrAPI"
 PAR_defaultObsLvl = "plant"
 PAR_suppObsLvl = ['study', 'block', 'sub-block', 'plot', 'sub-plot', 'pot', 'plant']
 
+class _Record:
+    """ Read-only mapping over the slots of a record projected from a BrAPI JSON object, unset slots are missing keys
+
+    The converter reads the records like the JSON dicts they replace (`key in record`, `record[key]`, att_test).
+    """
+    __slots__ = ()
+    # slots whose string values are interned, they repeat across the records of a study
+    _interned = ()
+
+    @classmethod
+    def project(cls, fields):
+        record = cls()
+        for key in cls.__slots__:
+            if key in fields:
+                value = fields[key]
+                if key in cls._interned and isinstance(value, str):
+                    value = sys.intern(value)
+                setattr(record, key, value)
+        return record
+
+    def __getitem__(self, key):
+        if key in self.__slots__ and hasattr(self, key):
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.__slots__ and hasattr(self, key)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return [key for key in self.__slots__ if hasattr(self, key)]
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def __repr__(self):
+        return type(self).__name__ + repr({key: self[key] for key in self.keys()})
+
+
+class Observation(_Record):
+    __slots__ = ('observationVariableDbId', 'observationVariableName', 'observationTimeStamp', 'season', 'value')
+    _interned = ('observationVariableDbId', 'observationVariableName', 'season')
+
+
+class Treatment(_Record):
+    __slots__ = ('factor', 'modality')
+    _interned = __slots__
+
+
+class Xref(_Record):
+    __slots__ = ('source', 'id')
+    _interned = ('source',)
+
+
+class ObsUnit(_Record):
+    """ Observation unit holding only the fields read by the converter, see compact_obs_units """
+    __slots__ = ('observationUnitDbId', 'observationUnitName', 'observationLevel', 'observationLevels',
+                 'observationUnitXref', 'X', 'Y', 'blockNumber', 'plotNumber', 'plantNumber', 'replicate',
+                 'germplasmDbId', 'germplasmName', 'treatments', 'observations')
+    _interned = ('observationLevel', 'observationLevels', 'germplasmDbId', 'germplasmName')
+    # list fields and the records of their items
+    _items = {'observations': Observation, 'treatments': Treatment, 'observationUnitXref': Xref}
+
+    @classmethod
+    def project(cls, fields):
+        record = super().project(fields)
+        for key, item_class in cls._items.items():
+            items = record.get(key)
+            if isinstance(items, list):
+                setattr(record, key, tuple(item_class.project(item) if isinstance(item, dict) else item for item in items))
+        return record
+
+
+def compact_obs_units(obs_units):
+    """
+    Project BrAPI observation units on compact ObsUnit records, the JSON objects are not kept
+    :param obs_units iterable of observation unit dicts as returned by BrapiClient.get_study_observation_units
+    :return generator of ObsUnit
+    """
+    for obs_unit in obs_units:
+        yield ObsUnit.project(obs_unit)
+
+
+class ObsUnitsByLevel:
+    """ Read-only view of the observation units of a study indexed by their (lowered) observation level
+
+    The units of a level keep their order in the study, as create_isa_obs_data_from_obsvars would select them.
+    """
+
+    def __init__(self, obs_units):
+        self.units = tuple(obs_units)
+        self._by_level = defaultdict(list)
+        for obs_unit in self.units:
+            if 'observationLevel' in obs_unit and obs_unit['observationLevel']:
+                self._by_level[obs_unit['observationLevel'].lower()].append(obs_unit)
+
+    def of_level(self, level):
+        # the data file of the default level holds every unit
+        if level == PAR_defaultObsLvl:
+            return self.units
+        return tuple(self._by_level.get(level, ()))
+
+
+class VariableRegistry:
+    """ Trait Definition File rows of the observation variables seen during a run
+
+    The row of a variable (accession numbers checked against the ontologies, names and descriptions) is computed
+    once and reused by every study sharing the variable. A row lists the (column, value) it appends to the table:
+    like the original per study table, a column can be left without a value for some variables.
+    """
+
+    def __init__(self, converter):
+        self.converter = converter
+        self._rows = {}
+        self.hits = 0
+
+    @staticmethod
+    def key(obs_var):
+        """The attributes of a variable its row depends on"""
+        trait, method, scale = obs_var['trait'], obs_var['method'], obs_var['scale']
+        synonyms = tuple(obs_var['synonyms']) if att_test(obs_var, 'synonyms') else None
+        return (att_test(obs_var, 'observationVariableDbId'), att_test(obs_var, 'name'), synonyms,
+                att_test(trait, 'traitDbId'), att_test(trait, 'name'), att_test(trait, 'description'),
+                att_test(method, 'methodDbId'), att_test(method, 'name'), att_test(method, 'description'),
+                att_test(method, 'reference'), att_test(scale, 'name'))
+
+    def tdf_row(self, obs_var):
+        key = self.key(obs_var)
+        row = self._rows.get(key)
+        if row is None:
+            row = self._rows[key] = tuple(self.converter.create_tdf_row(obs_var))
+        else:
+            self.hits += 1
+        return row
+
+
 class BrapiToIsaConverter:
     """ Converter json coming out of the BRAPI to ISA object
 
@@ -34,11 +170,19 @@ class BrapiToIsaConverter:
         - create_materials()
     """
 
-    def __init__(self, logger, endpoint):
+    def __init__(self, logger, endpoint, client: BrapiClient = None):
         self.logger = logger
         self.endpoint = endpoint
-        self._brapi_client = BrapiClient(self.endpoint, self.logger)
-        self.ontologies = self._brapi_client.get_ontologies()
+        self._brapi_client = client or BrapiClient(self.endpoint, self.logger)
+        self._ontologies = None
+        self.variable_registry = VariableRegistry(self)
+
+    @property
+    def ontologies(self):
+        """OBO ontologies registry, downloaded when first needed"""
+        if self._ontologies is None:
+            self._ontologies = self._brapi_client.get_ontologies()
+        return self._ontologies
 
     
     def filename_checker(self, filename):
@@ -137,6 +281,8 @@ class BrapiToIsaConverter:
 
     def create_isa_study(self, brapi_study_id, investigation, obs_levels_in_study):
         """Returns an ISA study given a BrAPI endpoints and a BrAPI study identifier."""
+        from isatools.model import OntologyAnnotation, Assay, Study, Comment, Person
+        from pycountry_convert import country_alpha3_to_country_alpha2 as a3a2
 
         brapi_study = self._brapi_client.get_study(brapi_study_id)
         
@@ -242,12 +388,51 @@ class BrapiToIsaConverter:
 
     def create_isa_characteristic(self, my_category, my_value):
         """Given a pair of category and value, return an ISA Characteristics element """
+        from isatools.model import Characteristic, OntologyAnnotation
         this_characteristic = Characteristic(category=OntologyAnnotation(term=str(my_category)),
                                              value=OntologyAnnotation(term=str(my_value), term_source="",
                                                                       term_accession=""))
 
         return this_characteristic
 
+    def create_tdf_row(self, obs_var):
+        """Return the (column, value) pairs of an observation variable in the Trait Definition File"""
+        row = []
+        obs_var_id = re.search('([a-zA-Z]*):[0-9]*', att_test(obs_var, 'observationVariableDbId'))
+        obs_var_name = att_test(obs_var, 'name')
+        obs_var_trait_id = re.search('([a-zA-Z]*):[0-9]*', att_test(obs_var['trait'], 'traitDbId'))
+        obs_var_method_id = re.search('([a-zA-Z]*):[0-9]*', att_test(obs_var['method'], 'methodDbId'))
+
+        row.append(('Variable ID', re.sub('[\s]+', '_', obs_var_name)))
+
+        if obs_var_id and obs_var_id.group(1).lower() in self.ontologies:
+            if att_test(obs_var, 'synonyms'):
+                row.append(('Variable Name', '; '.join(obs_var['synonyms'])))
+
+            row.append(('Variable Accession Number', obs_var_id.group(0).upper()))
+
+        else:
+            if att_test(obs_var, 'synonyms'):
+                row.append(('Variable Name', '; '.join(obs_var['synonyms']) + ' (BrAPI variableDbId: ' + att_test(obs_var, 'observationVariableDbId', PAR_NAinData) + ')'))
+            else:
+                row.append(('Variable Name', '(BrAPI variableDbId: ' + att_test(obs_var, 'observationVariableDbId', PAR_NAinData) + ')'))
+
+        row.append(('Trait', att_test(obs_var['trait'], 'name')))
+
+        if obs_var_trait_id and obs_var_trait_id.group(1).lower() in self.ontologies:
+            row.append(('Trait Accession Number', obs_var_trait_id.group(0).upper()))
+
+        row.append(('Method', att_test(obs_var['method'], 'name', att_test(obs_var, 'name', PAR_NAinData))))
+
+        row.append(('Method Description', att_test(obs_var['method'], 'description', att_test(obs_var['trait'], 'description', PAR_NAinData))))
+
+        if obs_var_method_id and obs_var_method_id.group(1).lower() in self.ontologies:
+            row.append(('Method Accession Number', obs_var_method_id.group(0).upper()))
+
+        row.append(('Reference Associated to the Method', att_test(obs_var['method'], 'reference')))
+        row.append(('Scale', att_test(obs_var['scale'], 'name', PAR_NAinData)))
+        return row
+
     def create_isa_tdf_from_obsvars(self, obsvars):
         records = []
         elements = {
@@ -263,41 +448,10 @@ class BrapiToIsaConverter:
             "Scale": []
         }
 
-        # decorating dictionairy
+        # decorating dictionairy, with the rows of the variables already seen in the run
         for obs_var in obsvars:
-            obs_var_id = re.search('([a-zA-Z]*):[0-9]*', att_test(obs_var, 'observationVariableDbId'))
-            obs_var_name = att_test(obs_var, 'name')
-            obs_var_trait_id = re.search('([a-zA-Z]*):[0-9]*', att_test(obs_var['trait'], 'traitDbId'))
-            obs_var_method_id = re.search('([a-zA-Z]*):[0-9]*', att_test(obs_var['method'], 'methodDbId'))
-
-            elements['Variable ID'].append(re.sub('[\s]+', '_', obs_var_name))
-            
-            if obs_var_id and obs_var_id.group(1).lower() in self.ontologies:
-                if att_test(obs_var, 'synonyms'):  
-                    elements['Variable Name'].append('; '.join(obs_var['synonyms']))
-
-                elements['Variable Accession Number'].append(obs_var_id.group(0).upper())
-
-            else:
-                if att_test(obs_var, 'synonyms'):  
-                    elements['Variable Name'].append('; '.join(obs_var['synonyms']) + ' (BrAPI variableDbId: ' + att_test(obs_var, 'observationVariableDbId', PAR_NAinData) + ')')
-                else: 
-                     elements['Variable Name'].append('(BrAPI variableDbId: ' + att_test(obs_var, 'observationVariableDbId', PAR_NAinData) + ')')
-
-            elements['Trait'].append(att_test(obs_var['trait'], 'name'))
-
-            if obs_var_trait_id and obs_var_trait_id.group(1).lower() in self.ontologies:
-                elements['Trait Accession Number'].append(obs_var_trait_id.group(0).upper())
-
-            elements['Method'].append(att_test(obs_var['method'], 'name', att_test(obs_var, 'name', PAR_NAinData)))
-            
-            elements['Method Description'].append(att_test(obs_var['method'], 'description', att_test(obs_var['trait'], 'description', PAR_NAinData)))
-            
-            if obs_var_method_id and obs_var_method_id.group(1).lower() in self.ontologies:
-                elements['Method Accession Number'].append(obs_var_method_id.group(0).upper())
-
-            elements['Reference Associated to the Method'].append(att_test(obs_var['method'], 'reference'))
-            elements['Scale'].append(att_test(obs_var['scale'], 'name', PAR_NAinData))
+            for column, value in self.variable_registry.tdf_row(obs_var):
+                elements[column].append(value)
 
         # Deleting empty columns
         data_elements = []
@@ -317,7 +471,8 @@ class BrapiToIsaConverter:
 
         return records
 
-    def create_isa_obs_data_from_obsvars(self, obs_units, obs_variables, level, germplasminfo, obs_levels, FLATTEN_boolean):
+    @staticmethod
+    def create_isa_obs_data_from_obsvars(obs_units, obs_variables, level, germplasminfo, obs_levels, FLATTEN_boolean):
         data_records = []
         data_records_flat = []
         obs_levels_header = []
@@ -415,3 +570,45 @@ class BrapiToIsaConverter:
                         data_records_flat.append('\t'.join(lines))
 
         return data_records, data_records_flat
+
+    def merge_obs_data(self, records, delta_records, flat=False):
+        """
+        Merge the data file records of an observation delta into the records of a previous export.
+        Rows are identified by their observation unit columns, time stamp and (unless flat) variable column:
+        the rows of the delta replace the matching rows, the others are appended.
+        :param records, delta_records lists of data file lines, header first, as returned by create_isa_obs_data_from_obsvars
+        :return the merged list of records
+        """
+        header = records[0].split('\t')
+        if delta_records[0].split('\t') != header:
+            raise ValueError("The delta and the data file do not have the same columns")
+        season = header.index("season")
+        time_stamp = header.index("observationTimeStamp")
+        variables = range(time_stamp + 1, len(header))
+
+        def row_key(row):
+            key = tuple(row[:season]) + (row[time_stamp],)
+            if not flat:
+                key += tuple(i for i in variables if row[i] != '')
+            return key
+
+        rows = [line.split('\t') for line in records[1:]]
+        index = {row_key(row): i for i, row in enumerate(rows)}
+        replaced = appended = 0
+        for line in delta_records[1:]:
+            row = line.split('\t')
+            key = row_key(row)
+            if key not in index:
+                index[key] = len(rows)
+                rows.append(row)
+                appended += 1
+            elif flat:
+                # the delta may only hold some of the variables of a time stamp
+                old = rows[index[key]]
+                rows[index[key]] = [new if new != '' else previous for new, previous in zip(row, old)]
+                replaced += 1
+            else:
+                rows[index[key]] = row
+                replaced += 1
+        self.logger.info("Merged observation delta: " + str(replaced) + " rows updated, " + str(appended) + " rows added")
+        return [records[0]] + ['\t'.join(row) for row in rows]
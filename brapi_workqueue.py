@@ -0,0 +1,376 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import pickle
+import shutil
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import brapi_to_isa
+from brapi_shared_cache import shared_cache_file
+from brapi_to_isa_converter import BrapiToIsaConverter
+
+logger = logging.getLogger('brapi_converter')
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+# Seconds a worker holds a study before it is given to another worker, the lease is renewed while converting
+LEASE_SECONDS = 600
+# Leases of a study before it is failed, a study crashing its workers is not retried forever
+MAX_ATTEMPTS = 3
+# Seconds an idle worker waits for the studies leased by other workers
+POLL_SECONDS = 10
+# Directory of the trial output directory holding the converted studies until the trial is assembled
+PARTS_DIR = '.brapi2isa_parts'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS trials (endpoint TEXT, trialDbId TEXT, data TEXT NOT NULL, argv TEXT NOT NULL,
+                                   output_directory TEXT NOT NULL, assembled REAL,
+                                   PRIMARY KEY (endpoint, trialDbId));
+CREATE TABLE IF NOT EXISTS items (id INTEGER PRIMARY KEY, endpoint TEXT, trialDbId TEXT, position INTEGER,
+                                  studyDbId TEXT, status TEXT NOT NULL, owner TEXT, lease_expires REAL,
+                                  attempts INTEGER NOT NULL DEFAULT 0, error TEXT, part TEXT,
+                                  UNIQUE (endpoint, trialDbId, studyDbId));
+CREATE INDEX IF NOT EXISTS items_status ON items (status, lease_expires);
+"""
+
+
+def worker_name() -> str:
+    """Lease owner name of this process, unique across the nodes"""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class WorkQueue:
+    """ Study conversions shared by the workers of several nodes, in a SQLite file on shared storage
+
+    A study is leased by one worker at a time until its lease expires: the study of a crashed worker is
+    leased again by another one, up to MAX_ATTEMPTS times. Leases are taken in a write transaction, so
+    the file system must support the POSIX locks SQLite relies on (the default rollback journal is used,
+    the WAL mode needs the processes to share memory) and the clocks of the nodes must be synchronized.
+    """
+
+    def __init__(self, path: str, max_attempts: int = MAX_ATTEMPTS):
+        self.path = path
+        self.max_attempts = max_attempts
+        # transactions are opened explicitly, BEGIN IMMEDIATE takes the write lock before reading the items
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._transaction():
+            for statement in SCHEMA.split(';'):
+                if statement.strip():
+                    self.db.execute(statement)
+
+    def close(self):
+        self.db.close()
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.db
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+    def enqueue(self, endpoint: str, trial: dict, study_ids: list, argv: list, output_directory: str) -> int:
+        """
+        Add the studies of a trial, a trial already queued is left as it is
+        :param argv brapi_to_isa arguments the studies and the trial are converted with
+        :return number of studies added
+        """
+        with self._transaction() as db:
+            if not db.execute("INSERT OR IGNORE INTO trials VALUES (?, ?, ?, ?, ?, NULL)",
+                              (endpoint, str(trial['trialDbId']), json.dumps(trial), json.dumps(argv),
+                               output_directory)).rowcount:
+                return 0
+            added = 0
+            for position, study_id in enumerate(study_ids):
+                added += db.execute("INSERT OR IGNORE INTO items (endpoint, trialDbId, position, studyDbId, status)"
+                                    " VALUES (?, ?, ?, ?, ?)",
+                                    (endpoint, str(trial['trialDbId']), position, study_id, PENDING)).rowcount
+        return added
+
+    def lease(self, owner: str, seconds: float = LEASE_SECONDS):
+        """Lease the next pending study, or a study whose lease expired, None when there is none"""
+        now = time.time()
+        with self._transaction() as db:
+            db.execute("UPDATE items SET status = ?, owner = NULL, error = 'lease expired' "
+                       "WHERE status = ? AND lease_expires < ? AND attempts >= ?",
+                       (FAILED, LEASED, now, self.max_attempts))
+            row = db.execute("SELECT items.*, trials.argv, trials.output_directory FROM items "
+                             "JOIN trials USING (endpoint, trialDbId) "
+                             "WHERE status = ? OR (status = ? AND lease_expires < ?) ORDER BY id LIMIT 1",
+                             (PENDING, LEASED, now)).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE items SET status = ?, owner = ?, lease_expires = ?, attempts = attempts + 1 "
+                       "WHERE id = ?", (LEASED, owner, now + seconds, row['id']))
+        item = dict(row)
+        item.update(argv=json.loads(item['argv']), owner=owner, attempts=item['attempts'] + 1)
+        return item
+
+    def renew(self, item: dict, seconds: float = LEASE_SECONDS) -> bool:
+        """Extend the lease of an item, False when it was lost (expired and leased by another worker)"""
+        with self._transaction() as db:
+            return db.execute("UPDATE items SET lease_expires = ? WHERE id = ? AND owner = ? AND status = ?",
+                              (time.time() + seconds, item['id'], item['owner'], LEASED)).rowcount == 1
+
+    def complete(self, item: dict, part: str) -> bool:
+        """
+        Record the converted study of an item
+        :param part file of the pickled ISA study
+        :return False when the lease was lost, the study is then left to the worker holding it
+        """
+        with self._transaction() as db:
+            return db.execute("UPDATE items SET status = ?, part = ?, error = NULL, lease_expires = NULL "
+                              "WHERE id = ? AND owner = ? AND status = ?",
+                              (DONE, part, item['id'], item['owner'], LEASED)).rowcount == 1
+
+    def fail(self, item: dict, error: str):
+        """Give back an item whose conversion failed, it is retried until MAX_ATTEMPTS"""
+        status = FAILED if item['attempts'] >= self.max_attempts else PENDING
+        with self._transaction() as db:
+            db.execute("UPDATE items SET status = ?, owner = NULL, lease_expires = NULL, error = ? "
+                       "WHERE id = ? AND owner = ? AND status = ?",
+                       (status, error, item['id'], item['owner'], LEASED))
+
+    def active(self) -> int:
+        """Number of studies pending or leased"""
+        with self._lock:
+            return self.db.execute("SELECT COUNT(*) FROM items WHERE status IN (?, ?)",
+                                   (PENDING, LEASED)).fetchone()[0]
+
+    def claim_trials(self) -> list:
+        """
+        Claim the trials whose studies are all done or failed, so that a single worker assembles each of them
+        :return the claimed trials, with their items in the trial order
+        """
+        trials = []
+        with self._transaction() as db:
+            rows = db.execute("SELECT * FROM trials WHERE assembled IS NULL AND NOT EXISTS "
+                              "(SELECT 1 FROM items WHERE items.endpoint = trials.endpoint "
+                              "AND items.trialDbId = trials.trialDbId AND status IN (?, ?))",
+                              (PENDING, LEASED)).fetchall()
+            for row in rows:
+                db.execute("UPDATE trials SET assembled = ? WHERE endpoint = ? AND trialDbId = ?",
+                           (time.time(), row['endpoint'], row['trialDbId']))
+                items = db.execute("SELECT * FROM items WHERE endpoint = ? AND trialDbId = ? ORDER BY position",
+                                   (row['endpoint'], row['trialDbId'])).fetchall()
+                trials.append(dict(row, trial=json.loads(row['data']), argv=json.loads(row['argv']),
+                                   items=[dict(item) for item in items]))
+        return trials
+
+    def release_trial(self, trial: dict):
+        """Give back a claimed trial whose assembly failed"""
+        with self._transaction() as db:
+            db.execute("UPDATE trials SET assembled = NULL WHERE endpoint = ? AND trialDbId = ?",
+                       (trial['endpoint'], trial['trialDbId']))
+
+    def status(self) -> dict:
+        """Number of studies by status and of trials assembled"""
+        counts = {status: 0 for status in (PENDING, LEASED, DONE, FAILED)}
+        with self._lock:
+            counts.update(self.db.execute("SELECT status, COUNT(*) FROM items GROUP BY status").fetchall())
+            trials = self.db.execute("SELECT COUNT(*), COUNT(assembled) FROM trials").fetchone()
+        counts.update(trials=trials[0], assembled=trials[1])
+        return counts
+
+
+def enqueue(queue: WorkQueue, argv: list) -> int:
+    """
+    Coordinator: queue the studies of the trials selected by brapi_to_isa arguments (-e, -t or -s...)
+    :return number of studies added
+    """
+    brapi_to_isa.parse_arguments(argv)
+    if brapi_to_isa.SINCE or brapi_to_isa.UNTIL:
+        raise ValueError("--since and --until merge into a previous export, run them with brapi_to_isa.py")
+    client = brapi_to_isa.open_client()
+    added = 0
+    try:
+        for trial in brapi_to_isa.get_trials(client):
+            output_directory = os.path.abspath(
+                brapi_to_isa.get_output_path(brapi_to_isa.filenameFormat(trial['trialName']))) + os.sep
+            study_ids = brapi_to_isa.trial_study_ids(trial)
+            added += queue.enqueue(brapi_to_isa.SERVER, trial, study_ids, argv, output_directory)
+            logger.info("Queued %d studies of trial %s", len(study_ids), trial['trialDbId'])
+    finally:
+        client.close()
+    return added
+
+
+class Worker:
+    """ Convert the studies leased from a WorkQueue, then assemble the trials whose studies are all converted
+
+    The converted ISA study is pickled in the PARTS_DIR of the trial output directory, its trait definition and
+    data files are written in the output directory as by brapi_to_isa.py. The client and converter of an endpoint
+    are kept from one study to the next. With `shared_cache`, the germplasm, taxon ids, ontologies and calls
+    decisions are shared with the other workers using that file (see SharedCache).
+    """
+
+    def __init__(self, queue: WorkQueue, owner: str = None, lease_seconds: float = LEASE_SECONDS,
+                 shared_cache: str = None):
+        self.queue = queue
+        self.owner = owner or worker_name()
+        self.lease_seconds = lease_seconds
+        self.shared_cache = shared_cache
+        self._warm = {}
+
+    def _pair(self):
+        key = (brapi_to_isa.SERVER, brapi_to_isa.MIRROR_FILE, brapi_to_isa.RECORD_DIR, brapi_to_isa.REPLAY_DIR)
+        if key not in self._warm:
+            client = brapi_to_isa.open_client(self.shared_cache)
+            self._warm[key] = (client, BrapiToIsaConverter(logger, brapi_to_isa.SERVER, client))
+        return self._warm[key]
+
+    def close(self):
+        for client, converter in self._warm.values():
+            for kind, counts in client.shared_cache_report().items():
+                logger.info("Shared cache of %s, %s: %d hits, %d misses (%.0f%% hit rate)", self.owner, kind,
+                            counts['hits'], counts['misses'], 100 * counts['hit_rate'])
+            client.close()
+        self._warm.clear()
+
+    def _heartbeat(self, item: dict, stop: threading.Event):
+        while not stop.wait(self.lease_seconds / 3):
+            if not self.queue.renew(item, self.lease_seconds):
+                logger.warning("Lease of study %s lost by %s", item['studyDbId'], self.owner)
+                return
+
+    def convert(self, item: dict) -> str:
+        """Convert the study of an item, return the file of the pickled ISA study"""
+        from isatools.model import Investigation
+
+        brapi_to_isa.parse_arguments(item['argv'])
+        client, converter = self._pair()
+        client.begin_run()
+        output_directory = item['output_directory']
+        investigation = Investigation()
+        downloaded = brapi_to_isa.download_study(client, item['studyDbId'])
+        built = brapi_to_isa.build_study(client, converter, investigation, downloaded)
+        brapi_to_isa.write_study(output_directory, built)
+        parts = os.path.join(output_directory, PARTS_DIR)
+        os.makedirs(parts, exist_ok=True)
+        part = os.path.join(parts, str(item['id']) + '.pickle')
+        # a worker whose lease expired may still be writing the same part
+        written = part + '.' + self.owner.replace(':', '_')
+        with open(written, 'wb') as fh:
+            pickle.dump(investigation.studies[0], fh, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(written, part)
+        return part
+
+    def run_item(self, item: dict) -> bool:
+        """Convert a leased item and record the outcome, False when it failed"""
+        logger.info("%s converts study %s of trial %s (attempt %d)", self.owner, item['studyDbId'],
+                    item['trialDbId'], item['attempts'])
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(item, stop), daemon=True)
+        heartbeat.start()
+        try:
+            part = self.convert(item)
+        except Exception as e:
+            logger.exception("Study %s failed", item['studyDbId'])
+            self.queue.fail(item, str(e))
+            return False
+        finally:
+            stop.set()
+            heartbeat.join()
+        if not self.queue.complete(item, part):
+            logger.warning("Study %s was converted after its lease expired, its other conversion is kept",
+                           item['studyDbId'])
+        return True
+
+    def run(self, once: bool = False, poll: float = POLL_SECONDS) -> int:
+        """
+        Convert studies until none is pending or leased, assembling the trials as they are complete
+        :param once return as soon as no study can be leased, rather than waiting for the studies of other workers
+        :return number of studies converted
+        """
+        converted = 0
+        while True:
+            item = self.queue.lease(self.owner, self.lease_seconds)
+            if item is not None:
+                converted += self.run_item(item)
+                continue
+            assemble(self.queue)
+            if once or not self.queue.active():
+                return converted
+            time.sleep(poll)
+
+
+def assemble(queue: WorkQueue) -> list:
+    """
+    Write the investigation of the trials whose studies are all converted, then convert it to ISA-JSON and
+    validate it as set by the trial arguments. The failed studies are left out of the investigation, a trial
+    whose assembly fails is given back to be assembled again.
+    :return the output directories of the trials assembled
+    """
+    assembled = []
+    for trial in queue.claim_trials():
+        try:
+            brapi_to_isa.parse_arguments(trial['argv'])
+            output_directory = trial['output_directory']
+            investigation = brapi_to_isa.create_investigation(trial['trial'])
+            for item in trial['items']:
+                if item['status'] != DONE:
+                    logger.warning("Study %s of trial %s is left out: %s", item['studyDbId'], trial['trialDbId'],
+                                   item['error'])
+                    continue
+                with open(item['part'], 'rb') as fh:
+                    investigation.studies.append(pickle.load(fh))
+            brapi_to_isa.dump_investigation(investigation, output_directory)
+            brapi_to_isa.convert_and_validate(trial['trial'], output_directory)
+        except Exception:
+            logger.exception("Assembly of trial %s failed", trial['trialDbId'])
+            queue.release_trial(trial)
+            continue
+        shutil.rmtree(os.path.join(output_directory, PARTS_DIR), ignore_errors=True)
+        logger.info("Trial %s assembled in %s", trial['trialDbId'], output_directory)
+        assembled.append(output_directory)
+    return assembled
+
+
+if __name__ == '__main__':
+    queue_parser = argparse.ArgumentParser(description="Convert BrAPI trials with workers on several nodes")
+    queue_parser.add_argument('command', choices=['enqueue', 'work', 'assemble', 'status'],
+                              help="enqueue: queue the studies of the trials selected by the brapi_to_isa.py "
+                                   "options, work: convert queued studies, assemble: write the trials whose "
+                                   "studies are converted, status: count the studies by status")
+    queue_parser.add_argument('-q', '--queue', help="SQLite file of the work queue, on storage shared by the nodes",
+                              type=str, required=True)
+    queue_parser.add_argument('--lease', help="seconds a worker holds a study without renewing its lease",
+                              type=float, default=LEASE_SECONDS)
+    queue_parser.add_argument('--once', help="stop working when no study can be leased", action="store_true")
+    queue_parser.add_argument('--shared-cache', help="file of the cache shared by the workers of the node, in the "
+                                                     "cache directory by default", type=str)
+    args, conversion_argv = queue_parser.parse_known_args()
+
+    brapi_to_isa.setup_logging()
+    work_queue = WorkQueue(args.queue)
+    try:
+        if args.command == 'enqueue':
+            print(enqueue(work_queue, conversion_argv), "studies queued")
+        elif args.command == 'work':
+            shared_cache = args.shared_cache or shared_cache_file(
+                'queue-' + hashlib.sha1(os.path.abspath(args.queue).encode('utf-8')).hexdigest() + '-'
+                + socket.gethostname())
+            worker = Worker(work_queue, lease_seconds=args.lease, shared_cache=shared_cache)
+            try:
+                print(worker.run(once=args.once), "studies converted")
+            finally:
+                worker.close()
+        elif args.command == 'assemble':
+            print('\n'.join(assemble(work_queue)))
+        print(json.dumps(work_queue.status(), indent=4))
+    finally:
+        work_queue.close()
@@ -0,0 +1,399 @@
+import csv
+import os
+
+import numpy
+from isatools import isatab
+from isatools.constants import HEADER, SYNONYMS
+from isatools.model import DataFile, Material, OntologyAnnotation, Process, Sample, Source, load_protocol_types_info
+
+# Builtin writer of the ISA-Tab files of the investigations built by brapi_to_isa.
+#
+# The study and assay tables have a fixed shape: source -> growth -> sample in the study,
+# sample -> phenotyping -> raw data file -> data transformation -> derived data file in the assays. Their rows are
+# read straight from the process sequences, one row per observation unit, instead of enumerating the paths of the
+# process graphs and building DataFrames as isatab.dump does.
+# The files are the ones written by isatab.dump: same columns, same rows, same order. The assay tables are compared
+# with the ones isatab.dump writes once the links from the phenotyping processes to the growth processes of the
+# study are cut (isatools 0.14 fails on them); these links, outside the assay, are not written anyway.
+# isatab.dump sorts the rows on their first column with an unstable sort, the rows are given in the order of the
+# graph paths of isatools and sorted the same way. Nothing is streamed: the rows of a table are all kept in memory
+# (as tuples of cells) until it is sorted and written, which is still much less than the DataFrames of isatab.dump.
+
+
+def _term_source(term_source) -> str:
+    if not term_source:
+        return ''
+    return term_source if isinstance(term_source, str) else term_source.name or ''
+
+
+def _value_columns(label, x) -> list:
+    """Columns of the value of a characteristic, factor value or parameter value, as isatools names them"""
+    if isinstance(x.value, (int, float)) and x.unit:
+        if isinstance(x.unit, OntologyAnnotation):
+            return [label, label + '.Unit', label + '.Unit.Term Source REF', label + '.Unit.Term Accession Number']
+        return [label, label + '.Unit']
+    if isinstance(x.value, OntologyAnnotation):
+        return [label, label + '.Term Source REF', label + '.Term Accession Number']
+    return [label]
+
+
+def _value_cells(label, x) -> dict:
+    """Cells of the value of a characteristic, factor value or parameter value"""
+    cells = {}
+    if isinstance(x.value, (int, float)) and x.unit:
+        cells[label] = x.value
+        if isinstance(x.unit, OntologyAnnotation):
+            cells[label + '.Unit'] = x.unit.term
+            cells[label + '.Unit.Term Source REF'] = _term_source(x.unit.term_source)
+            cells[label + '.Unit.Term Accession Number'] = x.unit.term_accession
+        else:
+            cells[label + '.Unit'] = x.unit
+    elif isinstance(x.value, OntologyAnnotation):
+        if x.unit and isinstance(x.unit, OntologyAnnotation):
+            cells[label + '.Unit'] = x.unit.term
+            cells[label + '.Unit.Term Source REF'] = _term_source(x.unit.term_source)
+        cells[label] = x.value.term
+        if x.value.term_source:
+            cells[label + '.Term Source REF'] = _term_source(x.value.term_source)
+        if x.value.term_accession and not x.unit:
+            cells[label + '.Term Accession Number'] = x.value.term_accession
+    elif isinstance(x.value, str) and len(x.value) == 0 and x.unit:
+        cells[label] = x.value
+        cells[label + '.Term Source REF'] = ''
+    else:
+        cells[label] = x.value
+    return cells
+
+
+def _category(characteristic) -> str:
+    term = characteristic.category.term
+    return term if isinstance(term, str) else term['annotationValue']
+
+
+class _Cells:
+    """ Columns and cells of a row, with the length isatools uses to choose the path giving the header """
+
+    def __init__(self):
+        self.columns = []
+        self.cells = {}
+        self.length = 0
+
+    def value(self, label, x):
+        self.columns += _value_columns(label, x)
+        self.cells.update(_value_cells(label, x))
+
+    def characteristics(self, label, node):
+        for characteristic in node.characteristics:
+            if characteristic and characteristic.category:
+                self.value('{0}.Characteristics[{1}]'.format(label, _category(characteristic)), characteristic)
+
+    def factor_values(self, label, node):
+        for factor_value in node.factor_values:
+            self.value('{0}.Factor Value[{1}]'.format(label, factor_value.factor_name.name), factor_value)
+
+    def comments(self, label, node):
+        for comment in node.comments:
+            self.columns.append('{0}.Comment[{1}]'.format(label, comment.name))
+            self.cells[self.columns[-1]] = comment.value
+
+    def process(self, label, process):
+        self.columns.append(label)
+        self.cells[label] = process.executes_protocol.name
+        if process.date is not None:
+            self.columns.append(label + '.Date')
+            self.cells[label + '.Date'] = process.date
+        if process.performer is not None:
+            self.columns.append(label + '.Performer')
+            self.cells[label + '.Performer'] = process.performer
+
+    def parameter_values(self, label, process):
+        for parameter_value in process.parameter_values:
+            if not parameter_value.category:
+                raise ValueError("Protocol Value has no valid parameter_name")
+            self.value('{0}.Parameter Value[{1}]'.format(label, parameter_value.category.parameter_name.term),
+                       parameter_value)
+
+    def count(self, node):
+        self.length += 1 + len(node.comments or [])
+        if isinstance(node, Source):
+            self.length += len(node.characteristics)
+        elif isinstance(node, Sample):
+            self.length += len(node.characteristics) + len(node.factor_values)
+        elif isinstance(node, Material):
+            self.length += len(node.characteristics)
+        elif isinstance(node, Process):
+            self.length += len([output for output in node.outputs if isinstance(output, DataFile)])
+            self.length += (node.date is not None) + (node.performer is not None) + (node.name != '')
+
+
+class Table:
+    """ Rows of an ISA-Tab table, written as isatab.dump writes them
+
+    The header is the one of the row with the most attributes, the rows are sorted on the first column, the
+    duplicated rows and the empty columns are dropped: all the rows are kept until the table is written, as tuples
+    of cells with the columns shared by the rows of the same shape.
+    """
+
+    def __init__(self, rename):
+        self.rename = rename
+        self._shapes = {}
+        self._rows = []
+        self._longest = (0, None)
+
+    def add(self, row: _Cells):
+        columns = tuple(row.columns)
+        shape = self._shapes.setdefault(columns, len(self._shapes))
+        self._rows.append((shape, tuple(row.cells.get(column, '') for column in columns)))
+        if row.length > self._longest[0]:
+            self._longest = (row.length, columns)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def write(self, path: str):
+        columns = list(self._longest[1])
+        # columns the longest row lacks (isatools fails on such tables)
+        for shape in self._shapes:
+            columns += [column for column in shape if column not in columns]
+        shapes = {index: [columns.index(column) for column in shape] for shape, index in self._shapes.items()}
+        rows = []
+        for shape, cells in self._rows:
+            row = [''] * len(columns)
+            for position, cell in zip(shapes[shape], cells):
+                row[position] = cell
+            rows.append(tuple(row))
+        # the sort of pandas DataFrame.sort_values, unstable: the rows of the same first cell are ordered as isatools
+        # orders them
+        order = numpy.array([row[0] for row in rows], dtype=object).argsort(kind='quicksort')
+        seen = set()
+        sorted_rows = []
+        for index in order:
+            row = rows[index]
+            if row not in seen:
+                seen.add(row)
+                sorted_rows.append(row)
+        kept = [position for position in range(len(columns))
+                if any(row[position] not in ('', None) for row in sorted_rows)]
+        header = self.rename(columns)
+        with open(path, 'w', encoding='utf-8', newline='') as fh:
+            writer = csv.writer(fh, delimiter='\t', lineterminator='\n')
+            writer.writerow([header[position] for position in kept])
+            for row in sorted_rows:
+                writer.writerow(['' if row[position] is None else row[position] for position in kept])
+
+
+def _duplicated(columns, separator) -> list:
+    columns = list(columns)
+    for duplicate in set(column for column in columns if columns.count(column) > 1):
+        for j, position in enumerate([i for i, column in enumerate(columns) if column == duplicate]):
+            columns[position] = separator.join([duplicate, str(j)]) if separator else duplicate + str(j)
+    return columns
+
+
+def study_header(columns) -> list:
+    """Header names of the columns of a study table (see isatools write_study_table_files)"""
+    columns = _duplicated(columns, '')
+    for i, column in enumerate(columns):
+        if 'Comment[' in column:
+            columns[i] = column[column.rindex('.') + 1:]
+        elif column.endswith('Term Source REF'):
+            columns[i] = 'Term Source REF'
+        elif column.endswith('Term Accession Number'):
+            columns[i] = 'Term Accession Number'
+        elif column.endswith('Unit'):
+            columns[i] = 'Unit'
+        elif 'Characteristics[' in column:
+            columns[i] = 'Material Type' if 'material type' in column.lower() else column[column.rindex('.') + 1:]
+        elif 'Factor Value[' in column or 'Parameter Value[' in column:
+            columns[i] = column[column.rindex('.') + 1:]
+        elif column.endswith('Date'):
+            columns[i] = 'Date'
+        elif column.endswith('Performer'):
+            columns[i] = 'Performer'
+        elif 'Protocol REF' in column:
+            columns[i] = 'Protocol REF'
+        elif column.startswith('Sample Name.'):
+            columns[i] = 'Sample Name'
+    return columns
+
+
+def assay_header(columns) -> list:
+    """Header names of the columns of an assay table (see isatools write_assay_table_files)"""
+    columns = _duplicated(columns, '.')
+    for i, column in enumerate(columns):
+        if column.endswith('Term Source REF'):
+            columns[i] = 'Term Source REF'
+        elif column.endswith('Term Accession Number'):
+            columns[i] = 'Term Accession Number'
+        elif column.endswith('Unit'):
+            columns[i] = 'Unit'
+        elif 'Characteristics[' in column:
+            if 'material type' in column.lower():
+                columns[i] = 'Material Type'
+            elif 'label' in column.lower():
+                columns[i] = 'Label'
+            else:
+                columns[i] = column[column.rindex('.') + 1:]
+        elif 'Factor Value[' in column or 'Parameter Value[' in column:
+            columns[i] = column[column.rindex('.') + 1:]
+        elif column.endswith('Date'):
+            columns[i] = 'Date'
+        elif column.endswith('Performer'):
+            columns[i] = 'Performer'
+        elif 'Comment[' in column:
+            columns[i] = column[column.rindex('.') + 1:]
+        elif 'Protocol REF' in column:
+            columns[i] = 'Protocol REF'
+        elif '.' in column:
+            columns[i] = column[:column.rindex('.')]
+    return columns
+
+
+def _single(nodes, what):
+    if len(nodes) != 1:
+        raise NotImplementedError("The builtin ISA-Tab writer only writes linear process sequences, found "
+                                  + str(len(nodes)) + " " + what)
+    return nodes[0]
+
+
+def study_paths(study):
+    """(source, growth process, sample) of the rows of a study table, in the order of the isatools graph paths"""
+    by_source = {}
+    for process in study.process_sequence:
+        for source in process.inputs:
+            if isinstance(source, Source):
+                by_source.setdefault(id(source), (source, []))[1].append(process)
+    for source, processes in by_source.values():
+        # the graph descendants of the source: its processes then their samples, in a set of sequence identifiers
+        samples = {}
+        for process in processes:
+            for output in process.outputs:
+                if not isinstance(output, DataFile):
+                    samples.setdefault(output.sequence_identifier, []).append((process, output))
+        descendants = {identifier for identifier in [process.sequence_identifier for process in processes]
+                       + [identifier for identifier in samples]}
+        for identifier in descendants:
+            for process, sample in samples.get(identifier, ()):
+                yield source, process, sample
+
+
+def study_rows(study):
+    """Cells of the rows of a study table, one per observation unit"""
+    for source, process, sample in study_paths(study):
+        row = _Cells()
+        row.columns.append('Source Name')
+        row.cells['Source Name'] = source.name
+        row.characteristics('Source Name', source)
+        row.comments('Source Name', source)
+        row.process('Protocol REF.0', process)
+        row.parameter_values('Protocol REF.0', process)
+        row.comments('Protocol REF.0', process)
+        row.columns.append('Sample Name.0')
+        row.cells['Sample Name.0'] = sample.name
+        row.characteristics('Sample Name.0', sample)
+        row.comments('Sample Name.0', sample)
+        row.factor_values('Sample Name.0', sample)
+        for node in (source, process, sample):
+            row.count(node)
+        yield row
+
+
+def assay_chains(assay):
+    """Process chains of an assay, in the order of the isatools paths. The links to processes of the study are
+    left out: the growth processes are written in the study table"""
+    processes = {id(process) for process in assay.process_sequence}
+    chains = {}
+    for process in assay.process_sequence:
+        chain = [process]
+        while chain[-1].next_process is not None and id(chain[-1].next_process) in processes:
+            chain.append(chain[-1].next_process)
+        while chain[0].prev_process is not None and id(chain[0].prev_process) in processes:
+            chain.insert(0, chain[0].prev_process)
+        chains.setdefault(tuple(p.sequence_identifier for p in chain), chain)
+    for identifiers in set(chains):
+        yield chains[identifiers]
+
+
+def assay_rows(assay, protocol_types: dict):
+    """Cells of the rows of an assay table, one per observation unit"""
+    for chain in assay_chains(assay):
+        row = _Cells()
+        sample = _single(chain[0].inputs, "inputs")
+        row.columns.append('Sample Name')
+        row.cells['Sample Name'] = sample.name
+        row.comments('Sample Name', sample)
+        row.count(sample)
+        names = {}
+        outputs = {}
+        for k, process in enumerate(chain):
+            label = 'Protocol REF.' + str(k)
+            row.process(label, process)
+            row.parameter_values(label, process)
+            protocol_type = process.executes_protocol.protocol_type
+            if protocol_type:
+                protocol_type = (protocol_type.term if isinstance(protocol_type, OntologyAnnotation)
+                                 else protocol_type).lower()
+                if protocol_type in protocol_types and protocol_types[protocol_type][HEADER]:
+                    name_label = protocol_types[protocol_type][HEADER]
+                    row.columns.append(name_label + '.' + str(names.get(name_label, 0)))
+                    row.cells[row.columns[-1]] = process.name
+                    names[name_label] = names.get(name_label, 0) + 1
+                    if protocol_type in protocol_types['nucleic acid hybridization'][SYNONYMS]:
+                        row.columns.append('Array Design REF')
+                        row.cells['Array Design REF'] = process.array_design_ref
+            row.comments(label, process)
+            row.count(process)
+            if k + 1 < len(chain):
+                inputs = {id(node) for node in chain[k + 1].inputs}
+                data = [output for output in process.outputs if id(output) in inputs]
+            else:
+                data = process.outputs
+            data_file = _single(data, "outputs")
+            data_label = data_file.label + '.' + str(outputs.get(data_file.label, 0))
+            outputs[data_file.label] = outputs.get(data_file.label, 0) + 1
+            row.columns.append(data_label)
+            row.cells[data_label] = data_file.filename
+            row.comments(data_label, data_file)
+            row.count(data_file)
+        yield row
+
+
+def protocol_types() -> dict:
+    """Protocol types of isatools with their synonyms"""
+    types = {}
+    for protocol, attributes in load_protocol_types_info().items():
+        types[protocol] = attributes
+        for synonym in attributes[SYNONYMS]:
+            types[synonym] = attributes
+    return types
+
+
+def write_study_table(study, output_directory: str):
+    table = Table(study_header)
+    for row in study_rows(study):
+        table.add(row)
+    if len(table):
+        table.write(os.path.join(output_directory, study.filename))
+
+
+def write_assay_table(assay, output_directory: str, types: dict = None):
+    table = Table(assay_header)
+    for row in assay_rows(assay, types or protocol_types()):
+        table.add(row)
+    if len(table):
+        table.write(os.path.join(output_directory, assay.filename))
+
+
+def dump(investigation, output_directory: str, i_file_name: str = 'i_investigation.txt'):
+    """
+    Write the investigation file and the study and assay tables of an investigation, as isatab.dump does
+    :param output_directory existing directory the files are written in
+    """
+    # the investigation file only holds the sections of the studies, isatools writes it quickly
+    isatab.dump(isa_obj=investigation, output_path=output_directory, i_file_name=i_file_name, skip_dump_tables=True)
+    types = protocol_types()
+    for study in investigation.studies:
+        write_study_table(study, output_directory)
+        for assay in study.assays:
+            write_assay_table(assay, output_directory, types)
+    return investigation
@@ -0,0 +1,332 @@
+import csv
+import glob
+import hashlib
+import logging
+import os
+import pickle
+import re
+import xml.etree.ElementTree as ET
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import brapi_calls
+
+logger = logging.getLogger('brapi_converter')
+
+CONFIG_NS = '{http://www.ebi.ac.uk/bii/isatab_configuration#}'
+INVESTIGATION_CONFIG = ('[investigation]', '')
+STUDY_CONFIG = ('[sample]', '')
+# Tables are validated in worker processes only above this total size, below it process start up costs more
+PARALLEL_MIN_BYTES = 4 * 1024 * 1024
+
+INVESTIGATION_SECTIONS = ['ONTOLOGY SOURCE REFERENCE', 'INVESTIGATION', 'INVESTIGATION PUBLICATIONS',
+                          'INVESTIGATION CONTACTS']
+STUDY_SECTIONS = ['STUDY', 'STUDY DESIGN DESCRIPTORS', 'STUDY PUBLICATIONS', 'STUDY FACTORS', 'STUDY ASSAYS',
+                  'STUDY PROTOCOLS', 'STUDY CONTACTS']
+DATA_FILE_HEADERS = ['Raw Data File', 'Derived Data File']
+
+FieldRule = namedtuple('FieldRule', ['header', 'data_type', 'required', 'list_values'])
+TableRules = namedtuple('TableRules', ['table_name', 'fields'])
+
+
+def _signature(config_dir: str) -> str:
+    """Identify the content of a configuration directory by its files names, sizes and modification times"""
+    digest = hashlib.sha1(os.path.abspath(config_dir).encode('utf-8'))
+    for path in sorted(glob.glob(os.path.join(config_dir, '*.xml'))):
+        stat = os.stat(path)
+        digest.update(f'{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}'.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def compile_rules(config_dir: str) -> dict:
+    """
+    Compile the ISA configuration XMLs of a directory
+    :return dict of TableRules keyed by lowered (measurement type, technology type), as in the isatools validator
+    """
+    rules = {}
+    for path in sorted(glob.glob(os.path.join(config_dir, '*.xml'))):
+        for configuration in ET.parse(path).getroot().iter(CONFIG_NS + 'isatab-configuration'):
+            measurement = configuration.find(CONFIG_NS + 'measurement').get('term-label', '')
+            technology = configuration.find(CONFIG_NS + 'technology').get('term-label', '')
+            fields = []
+            for field in configuration.iter(CONFIG_NS + 'field'):
+                list_values = field.findtext(CONFIG_NS + 'list-values') or ''
+                fields.append(FieldRule(header=field.get('header'),
+                                        data_type=field.get('data-type', '').lower().strip(),
+                                        required=field.get('is-required') == 'true',
+                                        list_values=frozenset(v.lower() for v in list_values.split(','))))
+            rules[(measurement.lower(), technology.lower())] = TableRules(configuration.get('table-name'),
+                                                                         tuple(fields))
+    return rules
+
+
+_compiled = {}
+
+
+def load_rules(config_dir: str) -> dict:
+    """Return the compiled rules of a configuration directory, compiled once and cached on disk"""
+    signature = _signature(config_dir)
+    if signature in _compiled:
+        return _compiled[signature]
+    cache_path = os.path.join(brapi_calls.CACHE_DIR, 'validator', signature + '.pickle')
+    try:
+        with open(cache_path, 'rb') as fh:
+            rules = pickle.load(fh)
+    except (OSError, pickle.PickleError, EOFError, AttributeError):
+        rules = compile_rules(config_dir)
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            with open(cache_path, 'wb') as fh:
+                pickle.dump(rules, fh)
+        except OSError as oserror:
+            logger.warning("Could not persist validation rules: %s", oserror)
+    _compiled[signature] = rules
+    return rules
+
+
+class Report:
+    """Validation messages, in the layout of the isatools validation report"""
+
+    def __init__(self):
+        self.errors = []
+        self.warnings = []
+        self.info = []
+
+    def add_error(self, code: int, message: str, supplemental: str):
+        self.errors.append({"message": message, "supplemental": supplemental, "code": code})
+
+    def add_warning(self, code: int, message: str, supplemental: str):
+        self.warnings.append({"message": message, "supplemental": supplemental, "code": code})
+
+    def extend(self, other: 'Report'):
+        self.errors += other.errors
+        self.warnings += other.warnings
+        self.info += other.info
+
+    def as_dict(self, validated: bool) -> dict:
+        return {"errors": self.errors, "warnings": self.warnings, "info": self.info,
+                "validation_finished": validated}
+
+
+def read_investigation(path: str) -> tuple:
+    """
+    Read an investigation file section by section
+    :return (investigation sections, list of study sections), sections are dicts of label -> list of values
+    """
+    sections = {}
+    studies = []
+    current = None
+    with open(path, 'r', encoding='utf-8', newline='') as fh:
+        for row in csv.reader(fh, delimiter='\t'):
+            if not row or not row[0].strip():
+                continue
+            label = row[0].strip()
+            if len(row) == 1 and label in INVESTIGATION_SECTIONS + STUDY_SECTIONS:
+                if label == 'STUDY':
+                    studies.append({})
+                current = {}
+                (studies[-1] if label in STUDY_SECTIONS else sections)[label] = current
+            elif current is not None:
+                current[label] = row[1:]
+    return sections, studies
+
+
+def _check_required_properties(report, section, required, index=0):
+    """Rule 4003, on the properties of an investigation file section"""
+    for label, values in section.items():
+        if label not in required:
+            continue
+        for x, value in enumerate(values):
+            if value == '':
+                if index > 0:
+                    spl = "A property value in {}.{} of investigation file at column {} is required"
+                    spl = spl.format(label, index + 1, x + 1)
+                else:
+                    spl = "A property value in {} of investigation file at column {} is required".format(label, x + 1)
+                report.add_error(message="A required property is missing", supplemental=spl, code=4003)
+
+
+def _valid_value(value: str, rule: FieldRule) -> bool:
+    data_type = rule.data_type
+    if data_type == 'boolean':
+        return value.strip() in ('true', 'false')
+    if data_type == 'integer':
+        try:
+            int(value)
+        except ValueError:
+            return False
+    elif data_type == 'double':
+        try:
+            float(value)
+        except ValueError:
+            return False
+    elif data_type == 'list':
+        return value.lower() in rule.list_values
+    elif data_type == 'date':
+        return re.match(r'^\d{4}(-\d{2}(-\d{2}([T ][\d:.]+(Z|[+-][\d:]+)?)?)?)?$', value.strip()) is not None
+    return True
+
+
+def validate_table(path: str, rules: TableRules, ignored_files: tuple = ()) -> tuple:
+    """
+    Validate a study or assay table row by row against its configuration
+    :return (Report, set of the table sample names)
+    """
+    report = Report()
+    filename = os.path.basename(path)
+    directory = os.path.dirname(path)
+    samples = set()
+    with open(path, 'r', encoding='utf-8', newline='') as fh:
+        reader = csv.reader(fh, delimiter='\t')
+        header = next(reader, [])
+
+        # required columns (rules 4010 and 4013)
+        for rule in rules.fields:
+            if rule.required:
+                found = [h for h in header if h.lower() == rule.header.lower()]
+                if not found:
+                    spl = "Required field '{}' not found in the file '{}'".format(rule.header, filename)
+                    report.add_warning(message="A required column in assay table is not present",
+                                       supplemental=spl, code=4010)
+                elif len(found) > 1:
+                    spl = "Field '{}' cannot have multiple values in the file '{}'".format(rule.header, filename)
+                    report.add_warning(message="Multiple columns found", supplemental=spl, code=4013)
+
+        # the cell checks only depend on the column, they are resolved once
+        by_header = {rule.header: rule for rule in rules.fields}
+        checked_columns = []
+        for icol, column in enumerate(header):
+            if column in by_header and column not in header[:icol]:
+                rule = by_header[column]
+                if rule.required or rule.data_type not in ('', 'string', 'ontology-term', 'ontology term'):
+                    checked_columns.append((icol, rule))
+        factor_columns = [(icol, column) for icol, column in enumerate(header)
+                          if column.lower().startswith('factor value')]
+        file_columns = [icol for icol, column in enumerate(header) if column in DATA_FILE_HEADERS]
+        sample_column = header.index('Sample Name') if 'Sample Name' in header else None
+        missing_files = set()
+
+        for irow, row in enumerate(reader):
+            if len(row) < len(header):
+                row += [''] * (len(header) - len(row))
+            for icol, rule in checked_columns:
+                value = row[icol]
+                if value.strip() == '':
+                    if rule.required:
+                        spl = "Missing value for the required field '{}' in the file '{}'".format(rule.header,
+                                                                                                   filename)
+                        report.add_warning(message="A required cell value is missing", supplemental=spl, code=4012)
+                elif not _valid_value(value, rule):
+                    spl = "Invalid value '{}' for type '{}' of the field '{}'".format(value, rule.data_type,
+                                                                                     rule.header)
+                    report.add_warning(message="A value does not correspond to the correct data type",
+                                       supplemental=spl, code=4011)
+            for icol, column in factor_columns:
+                if row[icol] == '':
+                    spl = "Missing value for '{}' at row {} in {}".format(column, irow, filename)
+                    report.add_warning(message="A required node factor value is missing value",
+                                       supplemental=spl, code=4007)
+            for icol in file_columns:
+                data_file = row[icol]
+                if data_file and data_file not in ignored_files and data_file not in missing_files \
+                        and not os.path.exists(os.path.join(directory, data_file)):
+                    missing_files.add(data_file)
+                    # code 7 follows the numbering of the isatools table files checks (6 and 8)
+                    spl = "Data File {} referenced in {} does not appear to exist".format(data_file, filename)
+                    report.add_warning(message="Missing data file(s)", supplemental=spl, code=7)
+            if sample_column is not None:
+                samples.add(row[sample_column])
+    return report, samples
+
+
+def validate(investigation_path: str, config_dir: str, ignored_files: tuple = (), workers: int = None) -> dict:
+    """
+    Validate an ISA-Tab investigation and its study and assay tables against ISA configurations.
+    This is a streaming subset of the isatools validator rules, reported in the same layout.
+    :param investigation_path path of the i_investigation.txt file
+    :param config_dir directory of the ISA configuration XMLs
+    :param ignored_files data file names not checked for existence (placeholders)
+    :param workers maximum number of processes validating tables, the tables are validated in parallel when large
+    :return a dictionary of the validation results (errors, warnings, info and validation_finished)
+    """
+    report = Report()
+    directory = os.path.dirname(investigation_path)
+    try:
+        rules = load_rules(config_dir)
+    except (OSError, ET.ParseError) as e:
+        rules = {}
+        logger.error("Could not compile configurations: %s", e)
+    if not rules:
+        report.add_error(message="Configurations could not be loaded", supplemental="On loading {}".format(config_dir),
+                         code=4001)
+        return report.as_dict(False)
+
+    sections, studies = read_investigation(investigation_path)
+    required = set()
+    if INVESTIGATION_CONFIG in rules:
+        required = {field.header for field in rules[INVESTIGATION_CONFIG].fields if field.required}
+    for name in INVESTIGATION_SECTIONS[1:]:
+        _check_required_properties(report, sections.get(name, {}), required)
+
+    # (study path, study rules, [(assay path, assay rules)]) of the tables to validate
+    tables = []
+    for i, study in enumerate(studies):
+        for name in STUDY_SECTIONS:
+            _check_required_properties(report, study.get(name, {}), required, i)
+        study_filename = (study.get('STUDY', {}).get('Study File Name') or [''])[0]
+        if study_filename == '':
+            report.add_warning(message="Missing Study File Name", supplemental="STUDY.{}".format(i), code=3005)
+        elif not os.path.exists(os.path.join(directory, study_filename)):
+            spl = "Study File {} does not appear to exist".format(study_filename)
+            report.add_error(message="Missing study tab file(s)", supplemental=spl, code=6)
+            study_filename = ''
+        assays_section = study.get('STUDY ASSAYS', {})
+        assays = []
+        filenames = assays_section.get('Study Assay File Name', [])
+        measurements = assays_section.get('Study Assay Measurement Type', [])
+        technologies = assays_section.get('Study Assay Technology Type', [])
+        for x, assay_filename in enumerate(filenames):
+            if assay_filename == '':
+                report.add_warning(message="Missing assay file name",
+                                   supplemental="STUDY.{}, STUDY ASSAY.{}".format(i, x), code=3005)
+                continue
+            if not os.path.exists(os.path.join(directory, assay_filename)):
+                spl = "Assay File {} does not appear to exist".format(assay_filename)
+                report.add_error(message="Missing assay tab file(s)", supplemental=spl, code=8)
+                continue
+            measurement = measurements[x] if x < len(measurements) else ''
+            technology = technologies[x] if x < len(technologies) else ''
+            assay_rules = rules.get((measurement.lower(), technology.lower()))
+            if assay_rules is None:
+                spl = "Measurement {}/technology {}, STUDY.{}, STUDY ASSAY.{}".format(measurement, technology, i, x)
+                report.add_error(message="Measurement/technology type invalid", supplemental=spl, code=4002)
+                continue
+            assays.append((os.path.join(directory, assay_filename), assay_rules))
+        if study_filename and STUDY_CONFIG in rules:
+            tables.append((os.path.join(directory, study_filename), rules[STUDY_CONFIG], assays))
+
+    jobs = []
+    for study_path, study_rules, assays in tables:
+        jobs.append((study_path, study_rules))
+        jobs.extend(assays)
+    total_size = sum(os.path.getsize(path) for path, _ in jobs)
+    if workers != 1 and len(jobs) > 1 and total_size >= PARALLEL_MIN_BYTES:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(validate_table, path, table_rules, ignored_files)
+                       for path, table_rules in jobs]
+            results = iter([future.result() for future in futures])
+    else:
+        results = iter([validate_table(path, table_rules, ignored_files) for path, table_rules in jobs])
+
+    # merged in file order, whatever the completion order
+    for study_path, _, assays in tables:
+        study_report, study_samples = next(results)
+        report.extend(study_report)
+        for assay_path, _ in assays:
+            assay_report, assay_samples = next(results)
+            report.extend(assay_report)
+            for sample in sorted(assay_samples - study_samples):
+                spl = "{} is a Sample Name in {}, but it is not defined in the Study Sample File {}.".format(
+                    sample, os.path.basename(assay_path), os.path.basename(study_path))
+                report.add_warning(message="Missing Sample", supplemental=spl, code=1003)
+    return report.as_dict(True)
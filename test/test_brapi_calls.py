@@ -0,0 +1,89 @@
+import logging
+import tempfile
+import unittest
+
+import mock
+import requests_mock
+
+import brapi_calls
+import mock_data
+from brapi_calls import CallsIndex
+from brapi_client import BrapiClient
+
+logger = logging.getLogger()
+
+mock_calls = [
+    {"call": "studies/{studyDbId}", "methods": ["GET"], "versions": ["1.3"]},
+    {"call": "studies/{studyDbId}/observationunits", "methods": ["GET"], "versions": ["1.3"]},
+    {"call": "studies/{studyDbId}/observationvariables", "methods": ["GET"], "versions": ["1.3"]},
+]
+
+
+class CallsIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.endpoint = 'http://foo/'
+        self.cache_dir = tempfile.TemporaryDirectory()
+        patcher = mock.patch.object(brapi_calls, 'CACHE_DIR', self.cache_dir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.cache_dir.cleanup)
+        CallsIndex.clear()
+        self.addCleanup(CallsIndex.clear)
+
+    @requests_mock.Mocker()
+    def test_discovery_shared_by_clients(self, mock_requests):
+        req = mock_requests.get(self.endpoint + 'calls', json=mock_data.mock_brapi_results(mock_calls))
+
+        client1 = BrapiClient(self.endpoint, logger)
+        client2 = BrapiClient(self.endpoint, logger)
+
+        assert client1._get_obs_unit_call() == 'observationunits'
+        assert client1._get_obs_var_call() == 'observationvariables'
+        assert client2._get_obs_unit_call() == 'observationunits'
+
+        # a single /calls request for both clients and both decisions
+        assert req.call_count == 1
+
+    @requests_mock.Mocker()
+    def test_discovery_pages_through_calls(self, mock_requests):
+        mock_requests.get(self.endpoint + 'calls', [
+            {"json": mock_data.mock_brapi_results(mock_calls[:1], total_pages=2)},
+            {"json": mock_data.mock_brapi_results(mock_calls[1:], total_pages=2, page=1)},
+        ])
+
+        index = CallsIndex.for_client(BrapiClient(self.endpoint, logger))
+
+        assert index.supports('/studies/{studyDbId}/observationunits/', 'get', '1.3')
+        assert not index.supports('studies/{studyDbId}/observationunits', 'POST')
+        assert not index.supports('studies/{studyDbId}/observationUnits')
+
+    @requests_mock.Mocker()
+    def test_persisted_index(self, mock_requests):
+        req = mock_requests.get(self.endpoint + 'calls', json=mock_data.mock_brapi_results(mock_calls))
+        CallsIndex.for_client(BrapiClient(self.endpoint, logger))
+
+        # a new process only has the persisted index
+        CallsIndex.clear()
+        index = CallsIndex.for_client(BrapiClient(self.endpoint, logger))
+        assert index.supports('studies/{studyDbId}/observationvariables')
+        assert req.call_count == 1
+
+        # an expired index is discovered again
+        CallsIndex.clear()
+        CallsIndex.for_client(BrapiClient(self.endpoint, logger), ttl=-1)
+        assert req.call_count == 2
+
+    @requests_mock.Mocker()
+    def test_serverinfo_on_v2(self, mock_requests):
+        endpoint = 'http://foo/brapi/v2/'
+        services = [{"service": "observationunits", "methods": ["GET", "POST"], "versions": ["2.0"]}]
+        mock_requests.get(endpoint + 'serverinfo', json=mock_data.mock_brapi_result({"calls": services}))
+
+        index = CallsIndex.for_client(BrapiClient(endpoint, logger))
+
+        assert index.supports('observationunits', 'POST', '2.0')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import logging
+import os
+import tempfile
+import unittest
+
+import mock
+import requests_mock
+
+import brapi_calls
+import mock_data
+from brapi_cassette import DATA_FILE, INDEX_FILE, request_key
+from brapi_client import BrapiClient
+
+logger = logging.getLogger()
+
+
+class CassetteTest(unittest.TestCase):
+
+    def setUp(self):
+        self.endpoint = 'http://foo/'
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.cassette_dir = os.path.join(self.directory.name, 'cassette')
+        patcher = mock.patch.object(brapi_calls, 'CACHE_DIR', os.path.join(self.directory.name, 'cache'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_request_key(self):
+        assert request_key('GET', 'http://foo/studies', {'page': 0, 'pageSize': 10}) == \
+            request_key('get', 'http://foo/studies', {'pageSize': 10, 'page': 0})
+        assert request_key('GET', 'http://foo/studies', {'page': 0}) != \
+            request_key('GET', 'http://foo/studies', {'page': 1})
+        assert request_key('POST', 'http://foo/search', json_body={'a': 1}) != \
+            request_key('POST', 'http://foo/search', json_body={'a': 2})
+
+    def test_record_and_replay(self):
+        calls = [{"call": "studies/{studyDbId}/observationunits", "methods": ["GET"]}]
+        with requests_mock.Mocker() as mock_requests:
+            mock_requests.get(self.endpoint + 'calls', json=mock_data.mock_brapi_results(calls))
+            mock_requests.get(self.endpoint + 'studies/1001', json=mock_data.mock_brapi_result(mock_data.mock_study))
+            mock_requests.get(self.endpoint + 'studies/1001/observationunits', [
+                {"status_code": 504},
+                {"json": mock_data.mock_brapi_results(mock_data.mock_observation_units)},
+            ])
+
+            client = BrapiClient(self.endpoint, logger, record=self.cassette_dir)
+            study = client.get_study('1001')
+            units = list(client.get_study_observation_units('1001'))
+            client.close()
+            assert mock_requests.call_count == 4
+
+        assert os.path.exists(os.path.join(self.cassette_dir, DATA_FILE))
+        assert os.path.exists(os.path.join(self.cassette_dir, INDEX_FILE))
+
+        # no endpoint available anymore: any live request would fail
+        with requests_mock.Mocker() as mock_requests:
+            client = BrapiClient(self.endpoint, logger, replay=self.cassette_dir)
+            assert client.get_study('1001') == study
+            assert list(client.get_study_observation_units('1001')) == units
+            self.assertRaises(RuntimeError, client.get_study, '1002')
+            client.close()
+            assert mock_requests.call_count == 0
+
+    def test_missing_cassette(self):
+        self.assertRaises(RuntimeError, BrapiClient, self.endpoint, logger, replay=self.cassette_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,15 @@
+import copy
 import logging
+import threading
+import time
 import unittest
+from unittest import mock
 
 import requests_mock
 
 import mock_data
-from brapi_client import BrapiClient
+from brapi_client import BrapiClient, IdentityMap
+from brapi_paging import EndpointProfile
 
 logger = logging.getLogger()
 
@@ -87,6 +92,264 @@ class BrapiClientTest(unittest.TestCase):
         assert len(actual_results) == 1
         assert actual_results[0] == mock_data.mock_study
 
+    @requests_mock.Mocker()
+    def test_get_study_observations_phenotypes_search(self, mock_requests):
+        # Mock: the endpoint ignores the filters, they are applied again by the client
+        units = copy.deepcopy(mock_data.mock_observation_units)
+        units[0]['observations'][0]['observationTimeStamp'] = '2012-06-14T22:03:51Z'
+        req = mock_requests.get(requests_mock.ANY, json=mock_data.mock_brapi_results(units))
+        calls = mock.Mock(supports=lambda call, *args, **kwargs: call == 'phenotypes-search')
+
+        # Init
+        client = BrapiClient(self.endpoint, logger)
+
+        # Call
+        with mock.patch.object(client, 'calls_index', return_value=calls):
+            delta = list(client.get_study_observations('1001', start='2013-01-01T00:00:00Z'))
+
+        # Assert
+        assert '/phenotypes-search' in req.last_request.url
+        assert req.last_request.qs['observationtimestamprangestart'] == ['2013-01-01t00:00:00z']
+        expected = [dict(unit, observations=[o for o in unit['observations']
+                                             if o['observationTimeStamp'] >= '2013'])
+                    for unit in units]
+        assert delta == [unit for unit in expected if unit['observations']]
+
+    @requests_mock.Mocker()
+    def test_get_study_observations_v2(self, mock_requests):
+        # Mock
+        observations = [dict(o, observationUnitDbId=unit['observationUnitDbId'],
+                             observationUnitName=unit['observationUnitName'])
+                        for unit in mock_data.mock_observation_units for o in unit['observations']]
+        req = mock_requests.get(requests_mock.ANY, json=mock_data.mock_brapi_results(observations))
+        calls = mock.Mock(supports=lambda call, *args, **kwargs: call == 'observations')
+
+        # Init
+        client = BrapiClient('http://foo/brapi/v2/', logger)
+
+        # Call
+        with mock.patch.object(client, 'calls_index', return_value=calls):
+            delta = list(client.get_study_observations('1001', end='2020-01-01', variable_ids=['MO_123:100002']))
+
+        # Assert
+        assert req.last_request.path == '/brapi/v2/observations'
+        assert req.last_request.qs['observationvariabledbid'] == ['mo_123:100002']
+        assert [unit['observationUnitDbId'] for unit in delta] == ['1']
+        assert all(o['observationVariableDbId'] == 'MO_123:100002' for unit in delta for o in unit['observations'])
+
+    @requests_mock.Mocker()
+    def test_post_paging_in_body(self, mock_requests):
+        # Mock
+        req = mock_requests.post(requests_mock.ANY, json=mock_data.mock_brapi_results([mock_data.mock_study]))
+
+        # Init
+        client = BrapiClient(self.endpoint, logger)
+
+        # Call
+        actual_results = list(client.fetch_objects('POST', '/search/studies', data={'studyDbIds': ['1001']}))
+
+        # Assert
+        assert actual_results == [mock_data.mock_study]
+        assert req.last_request.query == ''
+        assert req.last_request.json() == {'studyDbIds': ['1001'], 'page': 0, 'pageSize': 1000}
+
+    @requests_mock.Mocker()
+    def test_asynchronous_search(self, mock_requests):
+        # Mock: the results are not ready on the first poll
+        mock_requests.post('http://foo/brapi/v2/search/germplasm', status_code=202,
+                           json=mock_data.mock_brapi_result({'searchResultsDbId': 'abc'}))
+        results = mock_requests.get('http://foo/brapi/v2/search/germplasm/abc', [
+            {'status_code': 202, 'json': mock_data.mock_brapi_result({})},
+            {'json': mock_data.mock_brapi_results(mock_data.mock_germplasms)}])
+
+        # Init
+        client = BrapiClient('http://foo/brapi/v2/', logger)
+
+        # Call
+        with mock.patch.object(client, '_sleep') as sleep:
+            actual_results = list(client.search('germplasm', {'studyDbIds': ['1001']}))
+
+        # Assert
+        assert actual_results == mock_data.mock_germplasms
+        assert sleep.call_count == 1
+        assert results.call_count == 3
+
+    @requests_mock.Mocker()
+    def test_prefetch_studies(self, mock_requests):
+        # Mock: one synchronous search per entity
+        units = [dict(unit, studyDbId=study_id) for study_id, unit in zip(['1', '2'], mock_data.mock_observation_units)]
+        for entity, objects in (('observationunits', units), ('germplasm', mock_data.mock_germplasms),
+                                ('variables', mock_data.mock_variables)):
+            mock_requests.post('http://foo/brapi/v2/search/' + entity, json=mock_data.mock_brapi_results(objects))
+        calls = mock.Mock(supports=lambda call, *args, **kwargs: call.startswith('search/'))
+
+        # Init
+        client = BrapiClient('http://foo/brapi/v2/', logger)
+
+        # Call
+        with mock.patch.object(client, 'calls_index', return_value=calls):
+            assert client.prefetch_studies(['1', '2'])
+
+        # Assert: the per study methods serve the searches
+        assert list(client.get_study_observation_units('2')) == [units[1]]
+        assert list(client.get_study_germplasms('1')) == mock_data.mock_germplasms
+        assert list(client.get_study_observed_variables('2')) == mock_data.mock_variables
+        assert all(request.path.startswith('/brapi/v2/search/') for request in mock_requests.request_history)
+
+
+    @requests_mock.Mocker()
+    def test_metrics(self, mock_requests):
+        mock_requests.get('http://foo/studies/1', [{'status_code': 500}, {'json': mock_data.mock_brapi_result(mock_data.mock_study)}])
+        mock_requests.get('http://foo/trials', json=mock_data.mock_brapi_results(mock_data.mock_trials))
+
+        client = BrapiClient(self.endpoint, logger)
+        with mock.patch.object(client, '_sleep'):
+            client.get_study('1')
+        client.get_study('1')
+        list(client.fetch_objects('GET', '/trials'))
+
+        calls = client.metrics.summary()['calls']
+        assert calls['studies/{id}']['statuses'] == {'200': 1, '500': 1}
+        assert calls['studies/{id}']['server_error_retries'] == 1
+        assert calls['studies/{id}']['cache_hits'] == 1
+        assert calls['studies/{id}']['response_bytes'] > 0
+        assert calls['trials']['pages'] == 1
+        assert calls['trials']['response_bytes'] > 0
+
+    @requests_mock.Mocker()
+    def test_study_variables_v2(self, mock_requests):
+        mock_requests.get('http://foo/brapi/v2/variables', json=mock_data.mock_brapi_results(mock_data.mock_variables))
+        calls = mock.Mock(supports=lambda call, *args, **kwargs: call == 'variables', empty=False)
+
+        client = BrapiClient('http://foo/brapi/v2/', logger)
+        with mock.patch.object(client, 'calls_index', return_value=calls):
+            assert list(client.get_study_observed_variables('1')) == mock_data.mock_variables
+            assert list(client.get_study_observed_variables('1')) == mock_data.mock_variables
+
+        assert mock_requests.call_count == 1
+        assert mock_requests.last_request.qs['studydbid'] == ['1']
+        assert client.identity_report()['variables']['saved'] == 1
+
+    @requests_mock.Mocker()
+    def test_observed_variables_once_per_run(self, mock_requests):
+        mock_requests.get('http://foo/brapi/v2/variables', json=mock_data.mock_brapi_results(mock_data.mock_variables))
+        calls = mock.Mock(supports=lambda call, *args, **kwargs: call == 'variables', empty=False)
+        ids = [variable['observationVariableDbId'] for variable in mock_data.mock_variables]
+
+        client = BrapiClient('http://foo/brapi/v2/', logger)
+        with mock.patch.object(client, 'calls_index', return_value=calls):
+            assert list(client.get_study_observed_variables('1', ids[:2])) == mock_data.mock_variables[:2]
+            assert list(client.get_study_observed_variables('2', ids[1:])) == mock_data.mock_variables[1:]
+            assert mock_requests.call_count == 1 and 'studydbid' not in mock_requests.last_request.qs
+            # a variable missing from /variables: the variables of the study are fetched
+            assert list(client.get_study_observed_variables('3', ['other'])) == mock_data.mock_variables
+
+        assert mock_requests.call_count == 2
+        assert mock_requests.last_request.qs['studydbid'] == ['3']
+        # the variables of the endpoint were looked up again for the studies 2 and 3
+        assert client.identity_report()['variables']['saved'] == 2
+
+    @requests_mock.Mocker()
+    def test_count_study(self, mock_requests):
+        units = mock_data.mock_brapi_results(mock_data.mock_observation_units[:1], 1200, 1200)
+        # only totalCount is read when there is one
+        del units['metadata']['pagination']['totalPages']
+        mock_requests.get('http://foo/studies/1/observationunits', json=units)
+        # a server ignoring the page size
+        germplasm = mock_data.mock_brapi_results(mock_data.mock_germplasms[:1], 2, page_size=20)
+        del germplasm['metadata']['pagination']['totalCount']
+        mock_requests.get('http://foo/studies/1/germplasm', json=germplasm)
+        variables = mock_data.mock_brapi_results(mock_data.mock_variables[:1], 7)
+        del variables['metadata']['pagination']['totalCount']
+        mock_requests.get('http://foo/variables', json=variables)
+        calls = mock.Mock(supports=lambda call, *args, **kwargs: call in ('studies/{studyDbId}/observationunits',
+                                                                          'variables'), empty=False)
+
+        client = BrapiClient(self.endpoint, logger)
+        with mock.patch.object(client, 'calls_index', return_value=calls):
+            counts = client.count_study('1')
+
+        # without totalCount, the objects are counted from the pages and their size
+        assert counts == {'observation_units': 1200, 'germplasm': 40, 'variables': 7}
+        assert all(request.qs['pagesize'] == ['1'] and request.qs['page'] == ['0']
+                   for request in mock_requests.request_history)
+        assert mock_requests.last_request.qs['studydbid'] == ['1']
+
+    @requests_mock.Mocker()
+    def test_fetch_partitioned(self, mock_requests):
+        units = [{'observationUnitDbId': str(n)} for n in range(35)]
+
+        def page(request, context):
+            size, number = int(request.qs['pagesize'][0]), int(request.qs['page'][0])
+            return mock_data.mock_brapi_results(units[number * size:(number + 1) * size], -(-len(units) // size),
+                                                len(units), number, size)
+
+        mock_requests.get('http://foo/studies/1/observationunits', json=page)
+        client = BrapiClient(self.endpoint, logger)
+        calls = mock.Mock(supports=lambda call, *args, **kwargs: call == 'studies/{studyDbId}/observationunits',
+                          empty=False)
+        with mock.patch.object(client, 'calls_index', return_value=calls), \
+                mock.patch('brapi_paging.DEFAULT_PAGE_SIZE', 10), \
+                mock.patch.dict(EndpointProfile._registry, {self.endpoint: EndpointProfile(self.endpoint)}):
+            fetched = list(client.get_study_observation_units('1', partitions=3))
+
+        assert fetched == units
+        # a count, then pages 0 | 1 | 2, 3 with the last range going on to the last page
+        pages = sorted(request.qs['page'][0] for request in mock_requests.request_history
+                       if request.qs['pagesize'] == ['10'])
+        assert pages == ['0', '1', '2', '3']
+
+    @requests_mock.Mocker()
+    def test_objects_fetched_once_per_run(self, mock_requests):
+        mock_requests.get('http://foo/studies/1', json=mock_data.mock_brapi_result(mock_data.mock_study))
+        mock_requests.get('http://foo/germplasm/2', json=mock_data.mock_brapi_result(mock_data.mock_germplasms[0]))
+
+        client = BrapiClient(self.endpoint, logger)
+        assert client.get_study('1') is client.get_study('1')
+        client.get_germplasm('2')
+        client.get_germplasm('2')
+
+        assert mock_requests.call_count == 2
+        assert client.identity_report() == {'studies': {'sent': 1, 'saved': 1, 'coalesced': 0},
+                                            'germplasm': {'sent': 1, 'saved': 1, 'coalesced': 0}}
+        client.begin_run()
+        client.get_study('1')
+        assert mock_requests.call_count == 3
+
+    def test_identity_map_single_flight(self):
+        identity_map = IdentityMap()
+        release = threading.Event()
+        fetches = []
+
+        def fetch():
+            fetches.append(1)
+            release.wait(5)
+            return {'studyDbId': '1'}
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(identity_map.get('/studies/1', fetch))) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        while sum(identity_map.coalesced.values()) < 3:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        assert len(fetches) == 1
+        assert all(result is results[0] for result in results)
+        assert identity_map.report() == {'studies': {'sent': 1, 'saved': 3, 'coalesced': 3}}
+
+    def test_identity_map_failed_call_is_not_kept(self):
+        identity_map = IdentityMap()
+
+        def fail():
+            raise RuntimeError("Non-200 status code")
+
+        with self.assertRaises(RuntimeError):
+            identity_map.get('/trials/1', fail)
+        assert identity_map.get('/trials/1', lambda: {'trialDbId': '1'}) == {'trialDbId': '1'}
+
 
 if __name__ == '__main__':
     unittest.main()
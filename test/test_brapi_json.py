@@ -0,0 +1,50 @@
+import json
+import unittest
+
+import requests
+import requests_mock
+
+import brapi_json
+import mock_data
+from brapi_json import BrapiPage
+
+
+class BrapiPageTest(unittest.TestCase):
+
+    def get(self, body):
+        with requests_mock.Mocker() as mock_requests:
+            mock_requests.get('http://foo/studies', content=body)
+            return requests.get('http://foo/studies', stream=True)
+
+    def test_streaming_and_buffered_decoding(self):
+        body = json.dumps(mock_data.mock_brapi_results(mock_data.mock_observation_units, 3, 5)).encode('utf-8')
+
+        for streaming in (True, False):
+            page = BrapiPage(self.get(body), streaming=streaming)
+            assert list(page) == mock_data.mock_observation_units
+            assert page.total_pages == 3
+            assert page.pagination['totalCount'] == 5
+            assert page.nbytes == len(body)
+
+    @unittest.skipIf(brapi_json.ijson is None, "ijson is not installed")
+    def test_streaming_yields_before_end_of_body(self):
+        # pagination after the data, scalar and nested data items
+        body = b'{"result": {"data": [1, {"a": [{"b": 2}]}, "c"]}, "metadata": {"pagination": {"totalPages": 1}}}'
+
+        page = BrapiPage(self.get(body), streaming=True)
+        objects = iter(page)
+        assert next(objects) == 1
+        assert page.pagination == {}
+        assert list(objects) == [{"a": [{"b": 2}]}, "c"]
+        assert page.total_pages == 1
+
+    def test_missing_pagination(self):
+        body = json.dumps(mock_data.mock_brapi_result({"data": []})).encode('utf-8')
+
+        for streaming in (True, False):
+            with self.assertRaises(KeyError):
+                list(BrapiPage(self.get(body), streaming=streaming))
+
+
+if __name__ == '__main__':
+    unittest.main()
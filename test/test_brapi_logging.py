@@ -0,0 +1,65 @@
+import logging
+import threading
+import unittest
+
+import brapi_logging
+from brapi_logging import Sampler
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append((record.getMessage(), threading.current_thread()))
+
+
+class LoggingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = logging.getLogger('test_brapi_logging')
+        self.logger.propagate = False
+        self.handler = ListHandler()
+        self.addCleanup(brapi_logging.stop_async, self.logger)
+
+    def test_records_are_handled_in_the_background(self):
+        self.logger.setLevel(logging.INFO)
+        brapi_logging.start_async(self.logger, self.handler)
+        assert brapi_logging.async_handlers(self.logger) == (self.handler,)
+
+        self.logger.info("page %d", 1)
+        self.logger.debug("not created")
+        brapi_logging.stop_async(self.logger)
+
+        assert [message for message, thread in self.handler.records] == ["page 1"]
+        assert self.handler.records[0][1] is not threading.current_thread()
+        assert brapi_logging.async_handlers(self.logger) == ()
+
+    def test_sampler(self):
+        self.logger.addHandler(self.handler)
+        self.addCleanup(self.logger.removeHandler, self.handler)
+        sampler = Sampler(rate=10)
+
+        self.logger.setLevel(logging.INFO)
+        for page in range(25):
+            sampler.log(self.logger, logging.INFO, 'trials', "page %d", page)
+        sampler.log(self.logger, logging.INFO, 'studies', "page %d", 0)
+        assert [message for message, thread in self.handler.records] == \
+            ["page 0 (1 out of 10 logged)", "page 10 (1 out of 10 logged)", "page 20 (1 out of 10 logged)",
+             "page 0 (1 out of 10 logged)"]
+
+        # everything is logged at DEBUG level, nothing when the level is disabled
+        self.handler.records = []
+        self.logger.setLevel(logging.DEBUG)
+        for page in range(3):
+            sampler.log(self.logger, logging.INFO, 'trials', "page %d", page)
+        sampler.log(self.logger, logging.DEBUG, 'trials', "debug")
+        self.logger.setLevel(logging.WARNING)
+        sampler.log(self.logger, logging.INFO, 'trials', "page %d", 3)
+        assert [message for message, thread in self.handler.records] == ["page 0", "page 1", "page 2", "debug"]
+
+
+if __name__ == '__main__':
+    unittest.main()
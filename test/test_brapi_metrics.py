@@ -0,0 +1,62 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from brapi_metrics import ClientMetrics, call_type
+
+endpoint = 'http://foo/brapi/v1/'
+
+
+class ClientMetricsTest(unittest.TestCase):
+
+    def test_call_type(self):
+        assert call_type(endpoint, endpoint + 'studies/1001') == 'studies/{id}'
+        assert call_type(endpoint, '/studies/1001/germplasm') == 'studies/{id}/germplasm'
+        assert call_type(endpoint, endpoint + 'trials') == 'trials'
+        assert call_type(endpoint, '/variables?studyDbId=1') == 'variables'
+        assert call_type(endpoint, endpoint + 'search/germplasm/abc') == 'search/germplasm/{id}'
+        assert call_type(endpoint, endpoint + 'search/germplasm') == 'search/germplasm'
+        assert call_type(endpoint, 'https://www.ebi.ac.uk/ena/taxonomy/rest/any-name/Zea%20mays') == 'www.ebi.ac.uk'
+
+    def test_prometheus(self):
+        metrics = ClientMetrics(endpoint)
+        metrics.request(endpoint + 'studies/1', 0.07, 200)
+        metrics.request(endpoint + 'studies/2', 3, 500)
+        metrics.add('/studies/2', 'server_error_retries')
+        metrics.add('/studies/2', 'cache_hits', 2)
+
+        text = metrics.prometheus({'studies': 2})
+
+        lines = text.splitlines()
+        labels = 'endpoint="http://foo/brapi/v1/",call="studies/{id}"'
+        assert 'brapi2isa_requests_total{' + labels + ',status="500"} 1' in lines
+        assert 'brapi2isa_request_duration_seconds_bucket{' + labels + ',le="0.05"} 0' in lines
+        assert 'brapi2isa_request_duration_seconds_bucket{' + labels + ',le="0.1"} 1' in lines
+        assert 'brapi2isa_request_duration_seconds_bucket{' + labels + ',le="5"} 2' in lines
+        assert 'brapi2isa_request_duration_seconds_count{' + labels + '} 2' in lines
+        assert 'brapi2isa_server_error_retries_total{' + labels + '} 1' in lines
+        assert 'brapi2isa_cache_hits_total{' + labels + '} 2' in lines
+        assert 'brapi2isa_run_studies{endpoint="http://foo/brapi/v1/"} 2' in lines
+        assert '# TYPE brapi2isa_request_duration_seconds histogram' in lines
+
+    def test_write(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        metrics = ClientMetrics(endpoint)
+        metrics.request(endpoint + 'trials/1', 0.2, 200)
+        metrics.add(endpoint + 'trials/1', 'response_bytes', 120)
+
+        metrics.write(directory, {'trials': 1})
+
+        assert sorted(os.listdir(directory)) == ['brapi2isa.prom', 'brapi2isa_metrics.json']
+        with open(os.path.join(directory, 'brapi2isa_metrics.json')) as fh:
+            summary = json.load(fh)
+        assert summary['run'] == {'trials': 1}
+        assert summary['calls']['trials/{id}']['requests'] == 1
+        assert summary['calls']['trials/{id}']['response_bytes'] == 120
+
+
+if __name__ == '__main__':
+    unittest.main()
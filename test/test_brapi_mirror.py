@@ -0,0 +1,116 @@
+import copy
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock_data
+from brapi_mirror import Mirror, MirrorClient, harvest
+
+logger = logging.getLogger()
+
+
+class FakeClient:
+    """BrapiClient serving the mock data and counting the calls"""
+
+    def __init__(self):
+        self.logger = logger
+        self.study = dict(mock_data.mock_study, trialDbId='1', lastUpdate={'version': '1'})
+        self.units = copy.deepcopy(mock_data.mock_observation_units)
+        self.calls = []
+
+    def get_trials(self, trial_ids):
+        self.calls.append('trials')
+        yield dict(mock_data.mock_trials[0], trialDbId='1')
+
+    def get_study(self, study_id):
+        self.calls.append('study')
+        return self.study
+
+    def get_study_germplasms(self, study_id):
+        self.calls.append('germplasms')
+        yield from mock_data.mock_germplasms
+
+    def get_study_observation_units(self, study_id):
+        self.calls.append('units')
+        yield from self.units
+
+    def get_study_observed_variables(self, study_id):
+        self.calls.append('variables')
+        yield from mock_data.mock_variables
+
+    def get_germplasm(self, germplasm_id):
+        self.calls.append('germplasm')
+        return dict(next(g for g in mock_data.mock_germplasms if g['germplasmDbId'] == germplasm_id),
+                    genus='Zea', species='mays')
+
+    def get_taxonId(self, genus, species):
+        self.calls.append('taxon')
+        return '4577'
+
+    def get_ontologies(self):
+        self.calls.append('ontologies')
+        return {'co_322': ['Maize Ontology', 'http://purl.obolibrary.org/obo/co_322.owl']}
+
+
+class MirrorTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.mirror = Mirror(os.path.join(directory, 'mirror.sqlite'), 'http://foo/brapi/v1/')
+        self.addCleanup(self.mirror.close)
+        self.live = FakeClient()
+
+    def test_mirror_client_serves_the_harvest(self):
+        harvest(self.live, self.mirror, ['1'])
+        client = MirrorClient(self.mirror, logger)
+
+        assert [t['trialDbId'] for t in client.get_trials(['1'])] == ['1']
+        assert client.get_study('1001') == self.live.study
+        assert list(client.get_study_germplasms('1001')) == mock_data.mock_germplasms
+        assert list(client.get_study_observation_units('1001')) == self.live.units
+        assert list(client.get_study_observed_variables('1001')) == mock_data.mock_variables
+        assert client.get_germplasm('2')['genus'] == 'Zea'
+        assert client.get_taxonId('Zea', 'mays') == '4577'
+        assert 'co_322' in client.get_ontologies()
+        with self.assertRaises(RuntimeError):
+            client.get_study('1002')
+
+    def test_observation_units_by_level(self):
+        self.live.units[0]['observationLevel'] = 'Plot'
+        harvest(self.live, self.mirror, ['1'])
+
+        units = list(self.mirror.observation_units('1001', 'plot'))
+        assert units == [self.live.units[0]]
+
+    def test_unchanged_study_is_skipped(self):
+        harvest(self.live, self.mirror, ['1'])
+        self.live.calls = []
+
+        stats = harvest(self.live, self.mirror, ['1'])
+
+        assert stats['skipped_studies'] == 1
+        assert self.live.calls == ['trials', 'study']
+
+    def test_only_changed_units_are_rewritten(self):
+        harvest(self.live, self.mirror, ['1'])
+        self.live.study = dict(self.live.study, lastUpdate={'version': '2'})
+        self.live.units[0]['observations'][0]['value'] = '42'
+        del self.live.units[-1]
+        self.live.calls = []
+
+        stats = harvest(self.live, self.mirror, ['1'])
+
+        assert (stats['changed'], stats['unchanged'], stats['deleted']) == (1, len(self.live.units) - 1, 1)
+        assert 'germplasm' not in self.live.calls
+        assert list(MirrorClient(self.mirror, logger).get_study_observation_units('1001')) == self.live.units
+
+    def test_endpoint_mismatch(self):
+        with self.assertRaises(ValueError):
+            Mirror(self.mirror.path, 'http://bar/brapi/v1/')
+
+
+if __name__ == '__main__':
+    unittest.main()
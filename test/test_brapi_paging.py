@@ -0,0 +1,94 @@
+import logging
+import tempfile
+import unittest
+
+import mock
+import requests_mock
+
+import brapi_calls
+import mock_data
+from brapi_client import BrapiClient
+from brapi_paging import AdaptivePager, EndpointProfile, call_key
+
+logger = logging.getLogger()
+
+
+class AdaptivePagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.endpoint = 'http://foo/'
+        self.cache_dir = tempfile.TemporaryDirectory()
+        patcher = mock.patch.object(brapi_calls, 'CACHE_DIR', self.cache_dir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.cache_dir.cleanup)
+        EndpointProfile.clear()
+        self.addCleanup(EndpointProfile.clear)
+
+    def test_call_key(self):
+        assert call_key('/studies/1/germplasm') == 'germplasm'
+        assert call_key('/observationunits') == 'observationunits'
+        # the search results ids are random, the results of all the searches of an entity share their profile
+        assert call_key('/search/studies/a31f0d2c') == call_key('/search/studies') == 'search/studies'
+
+    def test_offset_stays_aligned(self):
+        pager = AdaptivePager(self.endpoint, '/studies/1/observationunits', logger)
+        assert pager.size == 1000
+
+        # slow page: shrink to a divisor of the page size
+        pager.observe(25.0, 1000, 1000)
+        assert pager.advance(1000, 10)
+        assert pager.size == 250
+        assert pager.page == 4
+
+        # fast pages: grow back to multiples of the page size dividing the offset
+        pager.observe(0.5, 1000, 250)
+        assert pager.advance(250, 36)
+        assert pager.size == 250
+        pager.observe(0.5, 1000, 250)
+        assert pager.advance(250, 36)
+        assert pager.size == 500
+        assert pager.page == 3
+
+        # last page
+        pager.observe(0.5, 1000, 500)
+        assert not pager.advance(500, 4)
+        assert pager.offset == 2000
+
+    def test_timeouts(self):
+        pager = AdaptivePager(self.endpoint, '/germplasm', logger)
+        sizes = []
+        while pager.timed_out():
+            sizes.append(pager.size)
+        assert sizes == [250, 50, 10]
+
+    @mock.patch('brapi_paging.time.sleep')
+    def test_throttling(self, sleep_mock):
+        pager = AdaptivePager(self.endpoint, '/germplasm', logger)
+        response = mock.Mock(status_code=429, headers={'Retry-After': '7'})
+        assert pager.throttled(response)
+        sleep_mock.assert_called_with(7.0)
+
+        response.headers = {}
+        while pager.throttled(response):
+            pass
+        assert sleep_mock.call_count == 5
+
+    @requests_mock.Mocker()
+    def test_profile_reused(self, mock_requests):
+        page = mock_data.mock_brapi_results(mock_data.mock_germplasms)
+        req = mock_requests.get(requests_mock.ANY, [{"status_code": 504}, {"json": page}])
+
+        client = BrapiClient(self.endpoint, logger)
+        assert len(list(client.fetch_objects('GET', '/studies/1/germplasm'))) == 2
+        assert req.last_request.qs['pagesize'] == ['250']
+
+        # a later run starts with the page size that worked
+        EndpointProfile.clear()
+        pager = AdaptivePager(self.endpoint, '/studies/2/germplasm', logger)
+        assert pager.size == 250
+        assert pager.profile.get('germplasm')['errors'] == {'504': 1}
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import threading
+import time
+import unittest
+
+from brapi_pipeline import Pipeline
+
+
+class PipelineTest(unittest.TestCase):
+
+    def test_results_keep_the_item_order(self):
+        pipeline = Pipeline([lambda x: x * 2, lambda x: x + 1])
+
+        assert pipeline.run(range(10)) == [x * 2 + 1 for x in range(10)]
+
+    def test_stages_overlap(self):
+        # the second item is downloaded while the first one is built
+        downloading_second = threading.Event()
+
+        def download(item):
+            if item == 2:
+                downloading_second.set()
+            return item
+
+        def build(item):
+            if item == 1:
+                assert downloading_second.wait(5)
+            return item
+
+        assert Pipeline([download, build]).run([1, 2]) == [1, 2]
+
+    def test_backpressure(self):
+        fed = []
+
+        def items():
+            for i in range(10):
+                fed.append(i)
+                yield i
+
+        def slow(item):
+            time.sleep(0.05)
+            # the feeder is at most a few items ahead: the queues and the items held by the stages
+            assert len(fed) - item <= 4
+            return item
+
+        assert Pipeline([slow, lambda x: x], maxsize=1).run(items()) == list(range(10))
+
+    def test_stage_failure_stops_the_pipeline(self):
+        built = []
+
+        def build(item):
+            if item == 3:
+                raise RuntimeError("Non-200 status code")
+            built.append(item)
+            return item
+
+        with self.assertRaises(RuntimeError):
+            Pipeline([build, lambda x: x]).run(range(100))
+        assert built == [0, 1, 2]
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import io
+import logging
+import unittest
+
+import brapi_plan
+from brapi_paging import EndpointProfile
+from brapi_plan import Progress, estimate_study, format_plan, plan_trial
+
+logger = logging.getLogger()
+
+
+class FakeClient:
+    endpoint = 'http://foo/brapi/v1/'
+    logger = logger
+
+    def count_study(self, study_id):
+        if study_id == '3':
+            raise RuntimeError("Non-200 status code")
+        return {'observation_units': 2500, 'germplasm': 10, 'variables': 4}
+
+
+class PlanTest(unittest.TestCase):
+
+    def test_estimate_from_the_endpoint_profile(self):
+        profile = EndpointProfile('http://foo/brapi/v1/', {'observationunits': {
+            'pages': 3, 'page_size': 500, 'latency': 2.0, 'bytes_per_object': 1000}})
+
+        estimate = estimate_study({'observation_units': 2500, 'germplasm': 10, 'variables': 4}, profile)
+        default = estimate_study({'observation_units': 2500, 'germplasm': 10, 'variables': 4})
+
+        # study, 5 pages of units, germplasm and variables pages, 10 germplasm
+        assert estimate['requests'] == 1 + 5 + 1 + 1 + 10
+        assert default['requests'] == 1 + 3 + 1 + 1 + 10
+        assert estimate['bytes'] == 2500 * 1000 + 10 * 1000 + 4 * 1500
+        assert estimate['fetch_seconds'] == brapi_plan.REQUEST_SECONDS * 13 + 5 * 2.0
+        assert estimate['cpu_seconds'] == default['cpu_seconds'] > 0
+
+    def test_plan_trial(self):
+        plan = plan_trial(FakeClient(), {'trialDbId': '1', 'trialName': 'Trial'}, ['1', '2', '3'])
+
+        assert [study['observation_units'] for study in plan['studies']] == [2500, 2500, None]
+        assert plan['totals']['observation_units'] == 5000
+        assert plan['totals']['memory_bytes'] == 5000 * brapi_plan.ISA_BYTES_PER_UNIT + 2500 * brapi_plan.UNIT_BYTES * 2
+        table = format_plan([plan])
+        assert table.startswith('Trial 1 (Trial): 3 studies')
+        assert '\n3 ' in table and ' ? ' in table
+        assert '\ntotal ' in table
+
+    def test_mirror_plan_has_no_request(self):
+        plan = plan_trial(FakeClient(), {'trialDbId': '1', 'trialName': 'Trial'}, ['1'], remote=False)
+
+        assert plan['totals']['requests'] == plan['totals']['bytes'] == 0
+
+
+class ProgressTest(unittest.TestCase):
+
+    def test_eta(self):
+        stream = io.StringIO()
+        progress = Progress('Trial', 2, 1000, stream=stream, interval=0)
+        assert progress.eta() is None
+
+        progress.page('/studies/1/observationunits', 400)
+        progress.page('/studies/1/germplasm', 50)
+        progress.fetched(500)
+        progress.started -= 10
+        # 500 units out of 1000 fetched, none built: a quarter of the work in 10 seconds
+        assert round(progress.eta()) == 30
+        progress.built(500)
+        progress.written()
+
+        assert round(progress.eta()) == 10
+        assert stream.getvalue().splitlines()[-1] == \
+            "Trial: 1/2 studies, 500/1000 observation units fetched, 500 built, ETA 10s"
+
+    def test_rendered_at_intervals(self):
+        stream = io.StringIO()
+        progress = Progress('Trial', 1, 10, stream=stream, interval=60)
+        for _ in range(10):
+            progress.page('/search/observationunits/abc', 1)
+        progress.close()
+
+        assert len(stream.getvalue().splitlines()) == 2
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import logging
+import os
+import pstats
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+import brapi_to_isa
+from brapi_profile import StageProfiler
+
+logger = logging.getLogger()
+
+
+def spin(n):
+    return sum(i * i for i in range(n))
+
+
+def inner():
+    return spin(20000)
+
+
+def outer(profiler):
+    with profiler.stage('inner'):
+        inner()
+    return spin(20000)
+
+
+class StageProfilerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def functions(self, stage):
+        stats = pstats.Stats(os.path.join(self.directory, 'profile_' + stage + '.prof'))
+        return {name for filename, line, name in stats.stats}
+
+    def test_nested_stages_are_profiled_on_their_own(self):
+        profiler = StageProfiler()
+        with profiler.stage('outer'):
+            outer(profiler)
+
+        profiler.write(self.directory, logger)
+
+        assert 'inner' in self.functions('inner')
+        assert 'inner' not in self.functions('outer')
+        with open(os.path.join(self.directory, 'profile.collapsed')) as fh:
+            stacks = [line.rsplit(' ', 1)[0].split(';') for line in fh]
+        assert any(stack[0] == 'outer' and stack[-2].endswith(':spin') for stack in stacks)
+        assert any(stack[0] == 'inner' and stack[1].endswith(':inner') for stack in stacks)
+        assert not any(stack[0] == 'outer' and stack[-1].endswith(':inner') for stack in stacks)
+        assert not os.path.exists(os.path.join(self.directory, 'profile_allocations.txt'))
+
+    def test_stage_in_several_threads(self):
+        profiler = StageProfiler()
+        # the threads are all in the stage at the same time
+        barrier = threading.Barrier(3, timeout=10)
+
+        def work():
+            with profiler.stage('work'):
+                barrier.wait()
+                spin(10000)
+
+        threads = [threading.Thread(target=work) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        with self.assertLogs(logger, 'INFO') as logs:
+            profiler.write(self.directory, logger)
+
+        assert logs.output[0].startswith('INFO:root:Profile of work: 3 calls')
+        stats = pstats.Stats(os.path.join(self.directory, 'profile_work.prof'))
+        spins = [calls for (filename, line, name), (calls, *_) in stats.stats.items() if name == 'spin']
+        if sys.version_info >= (3, 12):
+            # a single thread is profiled, its profile may include the calls of the others
+            assert len(spins) == 1 and 1 <= spins[0] <= 3
+        else:
+            assert spins == [3]
+
+    def test_allocations(self):
+        profiler = StageProfiler(memory=True)
+        self.addCleanup(profiler.close)
+        with profiler.stage('allocate'):
+            kept = [str(i) * 10 for i in range(10000)]
+
+        profiler.write(self.directory, logger)
+
+        with open(os.path.join(self.directory, 'profile_allocations.txt')) as fh:
+            table = fh.read()
+        assert table.startswith('allocate (1 calls): +')
+        assert 'test_brapi_profile.py' in table
+        assert kept
+
+    def test_not_profiled_by_default(self):
+        assert brapi_to_isa.PROFILER is None
+        assert brapi_to_isa.profiled('fetch') is brapi_to_isa.profiled('build')
+
+
+if __name__ == '__main__':
+    unittest.main()
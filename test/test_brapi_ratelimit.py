@@ -0,0 +1,130 @@
+import json
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import mock
+import requests
+
+import brapi_calls
+import mock_data
+from brapi_client import BrapiClient
+from brapi_ratelimit import HedgePolicy, RateLimiter
+
+logger = logging.getLogger()
+
+
+def _acquire_tokens(path, count):
+    limiter = RateLimiter('http://foo/', 20, burst=1, path=path)
+    for _ in range(count):
+        limiter.acquire()
+    limiter.close()
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.cache_dir.cleanup)
+        patcher = mock.patch.object(brapi_calls, 'CACHE_DIR', self.cache_dir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.now = 1000.0
+        self.slept = []
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+    def limiter(self, **kwargs):
+        limiter = RateLimiter('http://foo/', 2, clock=self.clock, sleep=self.sleep, **kwargs)
+        self.addCleanup(limiter.close)
+        return limiter
+
+    def test_token_bucket(self):
+        limiter = self.limiter()
+
+        assert limiter.acquire() == 0 and limiter.acquire() == 0
+        assert not limiter.try_acquire()
+        assert limiter.acquire() == 0.5
+        self.now += 10
+        # the bucket holds one second of requests
+        assert [limiter.try_acquire() for _ in range(3)] == [True, True, False]
+
+    def test_bucket_shared_through_the_file(self):
+        first, second = self.limiter(), self.limiter()
+
+        first.acquire()
+        first.acquire()
+
+        assert not second.try_acquire()
+        assert os.listdir(os.path.join(self.cache_dir.name, 'ratelimits'))
+
+    def test_processes_share_the_rate(self):
+        path = os.path.join(self.cache_dir.name, 'bucket')
+        start = time.time()
+        processes = [multiprocessing.Process(target=_acquire_tokens, args=(path, 4)) for _ in range(3)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+        # 12 requests at 20 per second, the first one right away
+        assert time.time() - start >= 11 / 20
+
+
+class HedgePolicyTest(unittest.TestCase):
+
+    def test_delay_and_budget(self):
+        policy = HedgePolicy(90, budget=0.1, min_samples=10)
+        assert policy.delay('studies/{id}') is None
+        for latency in range(1, 11):
+            policy.observe('studies/{id}', latency)
+
+        assert policy.delay('studies/{id}') == 10
+        assert policy.delay('germplasm/{id}') is None
+        assert not policy.spend('studies/{id}')
+        for _ in range(8):
+            policy.delay('studies/{id}')
+        assert policy.spend('studies/{id}')
+        assert not policy.spend('studies/{id}')
+
+    def test_hedged_get(self):
+        release = threading.Event()
+        calls = []
+
+        def request(method, url, **kwargs):
+            # requests_mock serializes the requests of all threads, the session is replaced instead
+            calls.append(url)
+            if len(calls) == 1:
+                # the first request is stuck
+                release.wait(5)
+            response = requests.Response()
+            response.status_code = 200
+            response._content = json.dumps(mock_data.mock_brapi_result(mock_data.mock_study)).encode('utf-8')
+            return response
+
+        client = BrapiClient('http://foo/', logger, hedge=95)
+        self.addCleanup(client.close)
+        self.addCleanup(release.set)
+        client.session.request = request
+        client.hedging = HedgePolicy(95, budget=1, min_samples=1)
+        client.hedging.observe('studies/{id}', 0.01)
+
+        start = time.time()
+        assert client.get_study('1') == mock_data.mock_study
+
+        assert time.time() - start < 5
+        assert len(calls) == 2
+        metrics = client.metrics.summary()['calls']['studies/{id}']
+        assert metrics['hedged_requests'] == 1 and metrics['hedge_wins'] == 1
+
+if __name__ == '__main__':
+    unittest.main()
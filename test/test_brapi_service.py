@@ -0,0 +1,144 @@
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import tempfile
+import threading
+import unittest
+import urllib.error
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from http.server import ThreadingHTTPServer
+from unittest.mock import patch
+
+import brapi_logging
+import brapi_service
+import brapi_to_isa
+from brapi_service import ConversionService, QueueFull, ServiceHandler
+
+
+def log_in_worker():
+    """Job of a worker process: log as a conversion does"""
+    brapi_to_isa.setup_logging()
+    brapi_to_isa.logger.warning("logged by worker %d", os.getpid())
+    return os.getpid()
+
+
+class ServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.events = queue.Queue()
+        self.release = threading.Event()
+        self.service = ConversionService(max_queue=2, executor=ThreadPoolExecutor(max_workers=1), events=self.events)
+        self.addCleanup(self.service.shutdown)
+        self.addCleanup(self.release.set)
+        patcher = patch.object(brapi_service, '_events', self.events)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        brapi_service._warm.clear()
+
+    def fake_main(self, argv, client, converter):
+        self.release.wait(5)
+        return ['outputdir/' + argv[-1] + '/']
+
+    def finished(self, job_id):
+        state = self.service.status(job_id)
+        while state['status'] not in brapi_service.FINISHED:
+            state = self.service.wait(job_id, state['version'], 5)
+        return state
+
+    def test_job_arguments(self):
+        argv = brapi_service.job_arguments({'endpoint': 'http://foo/brapi/v1/', 'studies': '1,2', 'json': False,
+                                            'validator_engine': 'builtin'})
+        assert argv == ['-e', 'http://foo/brapi/v1/', '-s', '1', '-s', '2', '-J', '--validator-engine', 'builtin']
+
+        for job in ({'trials': ['1']}, {'endpoint': 'http://foo/brapi/v1/'}):
+            with self.assertRaises(ValueError):
+                brapi_service.job_arguments(job)
+
+    def test_warm_instances_are_reused(self):
+        with patch('brapi_to_isa.main', side_effect=self.fake_main) as main:
+            self.release.set()
+            first = self.service.submit({'endpoint': 'http://foo/brapi/v1/', 'trials': ['1']})
+            second = self.service.submit({'endpoint': 'http://foo/brapi/v1/', 'trials': ['2']})
+            first = self.finished(first['id'])
+            second = self.finished(second['id'])
+
+        assert first['status'] == second['status'] == brapi_service.DONE
+        assert first['outputs'][0].endswith('outputdir/1')
+        clients = {call[1]['client'] for call in main.call_args_list}
+        assert len(clients) == 1
+
+    def test_bounded_queue(self):
+        with patch('brapi_to_isa.main', side_effect=self.fake_main):
+            jobs = [self.service.submit({'endpoint': 'http://foo/brapi/v1/', 'trials': [str(i)]}) for i in range(2)]
+            with self.assertRaises(QueueFull):
+                self.service.submit({'endpoint': 'http://foo/brapi/v1/', 'trials': ['3']})
+            self.release.set()
+            for job in jobs:
+                self.finished(job['id'])
+            job = self.service.submit({'endpoint': 'http://foo/brapi/v1/', 'trials': ['3']})
+            assert self.finished(job['id'])['status'] == brapi_service.DONE
+
+    def test_failed_job(self):
+        with patch('brapi_to_isa.main', side_effect=RuntimeError("Non-200 status code")):
+            job = self.service.submit({'endpoint': 'http://foo/brapi/v1/', 'trials': ['1']})
+            job = self.finished(job['id'])
+
+        assert job['status'] == brapi_service.FAILED
+        assert job['error'] == "Non-200 status code"
+
+    def test_http_events_stream(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), ServiceHandler)
+        server.service = self.service
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = 'http://127.0.0.1:%d/jobs' % server.server_port
+
+        with patch('brapi_to_isa.main', side_effect=self.fake_main):
+            request = urllib.request.Request(url, data=json.dumps({'endpoint': 'http://foo/brapi/v1/',
+                                                                   'trials': ['1']}).encode('utf-8'))
+            with urllib.request.urlopen(request) as response:
+                assert response.status == 202
+                job = json.loads(response.read())
+            self.release.set()
+            with urllib.request.urlopen(url + '/' + job['id'] + '/events') as response:
+                states = [json.loads(line) for line in response]
+
+        assert [state['status'] for state in states][-1] == brapi_service.DONE
+        assert states[-1]['outputs'][0].endswith('outputdir/1')
+        with self.assertRaises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(urllib.request.Request(url, data=b'{}'))
+        assert error.exception.code == 400
+
+
+class WorkerLoggingTest(unittest.TestCase):
+
+    def test_worker_records_are_written(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        log_file = os.path.join(directory.name, 'brapilog.log')
+        logger = logging.getLogger('brapi_converter')
+        patcher = patch.object(brapi_to_isa, 'log_file', log_file)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # the service writes its own log before forking the workers, which inherit its logging state
+        brapi_logging.stop_async(logger)
+        self.addCleanup(brapi_logging.stop_async, logger)
+        brapi_to_isa.setup_logging()
+        executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('fork'),
+                                       initializer=brapi_service.init_worker, initargs=(None,))
+
+        pid = executor.submit(log_in_worker).result()
+        executor.shutdown(wait=True)
+
+        assert pid != os.getpid()
+        brapi_logging.stop_async(logger)
+        with open(log_file) as fh:
+            assert "logged by worker " + str(pid) in fh.read()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import logging
+import multiprocessing
+import os
+import tempfile
+import unittest
+
+import requests_mock
+
+import mock_data
+from brapi_client import BrapiClient
+from brapi_shared_cache import SharedCache
+
+logger = logging.getLogger()
+
+
+def _put(path, key, value):
+    cache = SharedCache(path)
+    cache.put(key, value)
+    cache.close()
+
+
+class SharedCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, 'shared')
+
+    def cache(self, **kwargs):
+        cache = SharedCache(self.path, **kwargs)
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_put_and_get(self):
+        cache = self.cache()
+        ontologies = {'id' + str(k): ['Ontology ' + str(k), 'http://purl.obolibrary.org/obo/' + str(k)]
+                      for k in range(100)}
+
+        assert cache.get('ontologies') is None
+        cache.put('ontologies', ontologies)
+        cache.put('taxon', 4577)
+        cache.put('taxon', 4578)
+
+        assert cache.get('ontologies') == ontologies and cache.get('taxon') == 4578
+        # the registry is compressed
+        assert os.path.getsize(self.path) < len(str(ontologies)) / 2
+
+    def test_shared_between_processes(self):
+        cache = self.cache()
+        assert cache.get('germplasm', kind='germplasm/{id}') is None
+
+        process = multiprocessing.Process(target=_put, args=(self.path, 'germplasm', mock_data.mock_germplasms[0]))
+        process.start()
+        process.join()
+
+        assert cache.get('germplasm', kind='germplasm/{id}') == mock_data.mock_germplasms[0]
+        assert cache.report() == {'germplasm/{id}': {'hits': 1, 'misses': 1, 'hit_rate': 0.5}}
+
+    def test_expired_and_full(self):
+        self.cache().put('taxon', 4577)
+        assert self.cache(ttl=-1).get('taxon') is None
+
+        full = self.cache(max_bytes=os.path.getsize(self.path) + 10)
+        full.put('ontologies', {})
+        assert full.get('ontologies') is None
+
+    @requests_mock.Mocker()
+    def test_client_germplasm(self, mock_requests):
+        germplasm = mock_data.mock_germplasms[0]
+        mock_requests.get('http://foo/germplasm/1', json=mock_data.mock_brapi_result(germplasm))
+        first = BrapiClient('http://foo/', logger, shared_cache=self.path)
+        second = BrapiClient('http://foo/', logger)
+        # the client of another worker process
+        second.shared_cache = self.cache()
+
+        assert first.get_germplasm('1') == germplasm
+        assert second.get_germplasm('1') == germplasm
+
+        assert mock_requests.call_count == 1
+        assert second.metrics.summary()['calls']['germplasm/{id}']['shared_cache_hits'] == 1
+        assert second.shared_cache_report() == {'germplasm/{id}': {'hits': 1, 'misses': 0, 'hit_rate': 1.0}}
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,20 +1,88 @@
+import filecmp
 import logging
 import os
+import shutil
+import subprocess
+import sys
+import tempfile
 import unittest
 from functools import reduce
 
 import mock
 from isatools import isatab
-from isatools.model import Investigation
+from isatools.model import Assay, Characteristic, DataFile, Investigation, OntologyAnnotation, Protocol, Source, Study, \
+    StudyFactor
 
 import brapi_to_isa
 import mock_data
-from brapi_to_isa_converter import BrapiToIsaConverter
+from brapi_to_isa_converter import BrapiToIsaConverter, ObsUnit, ObsUnitsByLevel, PAR_defaultObsLvl, compact_obs_units
 
 logger = logging.getLogger()
 endpoint = 'http://foo.com/'
 
 
+class UnsharedNodes(brapi_to_isa.AssayGraphNodes):
+    """New nodes for every unit, as create_study_sample_and_assay made them before the nodes were shared"""
+
+    def annotation(self, term, term_source="", term_accession=""):
+        return OntologyAnnotation(term=term, term_source=term_source, term_accession=term_accession)
+
+    def characteristic(self, category, value):
+        return Characteristic(category=self.annotation(category), value=self.annotation(value))
+
+    def factor(self, name):
+        return StudyFactor(name=name, factor_type=self.annotation(name))
+
+
+def study_with_units(count, shared=True):
+    """Study of count units on two levels with repeated unit names and treatments, built with shared nodes or not"""
+    germplasm = ['G' + str(k) for k in range(4)]
+    study = Study(identifier='1', filename='s_1.txt',
+                  sources=[Source(name=name, characteristics=[Characteristic(category=OntologyAnnotation(term='Organism'),
+                                                                             value=OntologyAnnotation(term=name.lower()))])
+                           for name in germplasm])
+    for level in ('plot', 'plant'):
+        study.assays.append(Assay(filename='a_1_' + level + '.txt'))
+        study.assays[-1].characteristic_categories.append(level)
+    study.protocols = [Protocol(name=name, protocol_type=OntologyAnnotation(term=name))
+                       for name in ('Growth', 'Phenotyping', 'Data Transformation')]
+    units = [dict(mock_data.mock_observation_units[0], observationLevel=['plot', 'plant'][k % 3 % 2],
+                  observationUnitName='u' + str(k * 7 % (count - 5)), germplasmName=germplasm[k * 5 % 4],
+                  treatments=[{'factor': 'water', 'modality': str(k % 3)}] if k % 4 else [])
+             for k in range(count)]
+    with mock.patch.object(brapi_to_isa, 'AssayGraphNodes', brapi_to_isa.AssayGraphNodes if shared else UnsharedNodes):
+        brapi_to_isa.create_study_sample_and_assay(None, '1', study, *study.protocols, units)
+    return study
+
+
+def detach_growth_processes(study):
+    """Cut the links from the phenotyping processes to the growth processes of the study: isatools (0.14) can not
+    write the assay tables with them"""
+    for assay in study.assays:
+        for process in assay.process_sequence:
+            if process.prev_process is not None and process.prev_process not in assay.process_sequence:
+                process.prev_process = None
+
+
+def dump_study(directory, shared, count=120):
+    """Dump with isatools the ISA-Tab files of study_with_units"""
+    study = study_with_units(count, shared)
+    detach_growth_processes(study)
+    investigation = Investigation(identifier='1')
+    investigation.studies.append(study)
+    os.makedirs(directory)
+    isatab.dump(investigation, directory)
+
+
+def dump_in_subprocess(directory, shared):
+    """dump_study in a fresh interpreter: the order of the study table rows of isatools depends on the identity of the
+    nodes of the graph, it is only reproducible from one interpreter to the next"""
+    code = f"import test_brapi_to_isa; test_brapi_to_isa.dump_study({directory!r}, {shared})"
+    test_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.dirname(test_dir), test_dir]), PYTHONHASHSEED='0')
+    subprocess.run([sys.executable, '-c', code], cwd=test_dir, env=env, capture_output=True, check=True)
+
+
 class ConvertTest(unittest.TestCase):
     """Run BrAPI 2 ISA conversion test on mocked data (from http://test-server.brapi.org)"""
 
@@ -67,6 +135,137 @@ class ConvertTest(unittest.TestCase):
         assert terms['commonCropName'] == germplasm1['commonCropName']
         assert terms['Material Source ID'] == germplasm1['accessionNumber']
 
+    def test_merge_obs_data(self):
+        header = "observationUnitName\tgermplasmDbId\tseason\tobservationTimeStamp\theight\twidth"
+        records = [header, "p1\t1\t2013\t2013-06-14\t10\t", "p1\t1\t2013\t2013-06-14\t\t5"]
+        delta = [header, "p1\t1\t2013\t2013-06-14\t12\t", "p2\t1\t2014\t2014-06-14\t\t6"]
+
+        merged = self.converter.merge_obs_data(records, delta)
+        assert merged == [header, "p1\t1\t2013\t2013-06-14\t12\t", "p1\t1\t2013\t2013-06-14\t\t5",
+                          "p2\t1\t2014\t2014-06-14\t\t6"]
+
+        flat = [header, "p1\t1\t2013\t2013-06-14\t10\t5"]
+        merged = self.converter.merge_obs_data(flat, delta, flat=True)
+        assert merged == [header, "p1\t1\t2013\t2013-06-14\t12\t5", "p2\t1\t2014\t2014-06-14\t\t6"]
+
+    def test_obs_units_by_level(self):
+        units = [dict(unit, observationLevel=level) for unit, level in
+                 zip(mock_data.mock_observation_units * 2, ['Plot', 'plant', None, 'plot'])]
+        del units[2]['observationLevel']
+        germplasminfo = {g['germplasmDbId']: [g.get('accessionNumber', '')] for g in mock_data.mock_germplasms}
+        variables = [v['name'] for v in mock_data.mock_variables]
+        obs_levels = {'plot': [], PAR_defaultObsLvl: []}
+
+        units_by_level = ObsUnitsByLevel(units)
+        assert units_by_level.of_level('plot') == (units[0], units[3])
+        assert units_by_level.of_level(PAR_defaultObsLvl) == tuple(units)
+        assert units_by_level.of_level('pot') == ()
+        for level in ('plot', PAR_defaultObsLvl):
+            assert self.converter.create_isa_obs_data_from_obsvars(units_by_level.of_level(level), variables, level, germplasminfo, obs_levels, True) == \
+                self.converter.create_isa_obs_data_from_obsvars(units, variables, level, germplasminfo, obs_levels, True)
+
+    def test_compact_obs_units(self):
+        units = [dict(unit, observationLevel='plot', observationLevels='block:1, plot:' + unit['observationUnitDbId'],
+                      observationUnitXref=[{'source': 'ark', 'id': 'x1'}], treatments=[{'factor': 'water', 'modality': 'dry'}])
+                 for unit in mock_data.mock_observation_units]
+        germplasminfo = {g['germplasmDbId']: [g.get('accessionNumber', '')] for g in mock_data.mock_germplasms}
+        variables = [v['name'] for v in mock_data.mock_variables]
+
+        compact = list(compact_obs_units(units))
+
+        assert all(isinstance(unit, ObsUnit) for unit in compact)
+        assert 'collector' not in compact[0]['observations'][0]
+        assert compact[0]['observations'][0]['value'] == units[0]['observations'][0]['value']
+        assert compact[0]['treatments'][0]['factor'] is compact[1]['treatments'][0]['factor']
+        with self.assertRaises(KeyError):
+            compact[0]['observationUnitPosition']
+        assert self.converter.get_obs_levels('1', compact) == self.converter.get_obs_levels('1', units)
+        obs_levels = self.converter.get_obs_levels('1', units)[1]
+        assert self.converter.create_isa_obs_data_from_obsvars(compact, variables, 'plot', germplasminfo, obs_levels, True) == \
+            self.converter.create_isa_obs_data_from_obsvars(units, variables, 'plot', germplasminfo, obs_levels, True)
+
+    def test_assay_graph_shares_nodes(self):
+        units = [dict(unit, observationLevel='plot', observationUnitName=name, treatments=[{'factor': 'water', 'modality': 'dry'}])
+                 for unit, name in zip(mock_data.mock_observation_units * 2, ['p1', 'p2', 'p3', 'p4'])]
+        study = Study(filename='s_1.txt', sources=[Source(name=g['germplasmName']) for g in mock_data.mock_germplasms])
+        study.assays.append(Assay(filename='a_1_plot.txt'))
+        study.assays[0].characteristic_categories.append('plot')
+        protocols = [Protocol(name=name, protocol_type=OntologyAnnotation(term=name)) for name in ('Growth', 'Phenotyping', 'Data Transformation')]
+
+        brapi_to_isa.create_study_sample_and_assay(None, '1', study, *protocols, units)
+
+        # the data files are nodes of the graph, one per unit
+        for protocol in protocols[1:]:
+            outputs = {id(process.outputs[0]) for process in study.assays[0].process_sequence if process.executes_protocol is protocol}
+            assert len(outputs) == len(units)
+        assert study.assays[0].process_sequence[1].outputs[0].filename == 'd_1_plot.txt'
+        assert len({id(sample.characteristics[0]) for sample in study.samples}) == 1
+        assert len({id(sample.factor_values[0].value) for sample in study.samples}) == 1
+        assert [sample.characteristics[0].value.term for sample in study.samples] == ['plot'] * len(units)
+
+    def test_shared_nodes_keep_the_isatab_files(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        shared, unshared = os.path.join(directory, 'shared'), os.path.join(directory, 'unshared')
+
+        dump_in_subprocess(shared, True)
+        dump_in_subprocess(unshared, False)
+
+        files = sorted(os.listdir(shared))
+        assert files == ['a_1_plant.txt', 'a_1_plot.txt', 'i_investigation.txt', 's_1.txt']
+        assert sorted(os.listdir(unshared)) == files
+        assert filecmp.cmpfiles(shared, unshared, files, shallow=False)[0] == files
+
+    def test_partitioned_sample_and_assay(self):
+        germplasm = [g['germplasmName'] for g in mock_data.mock_germplasms]
+        # repeated unit names (multiyear units) and units without a source reuse the sample of the unit before them
+        names = ['p1', 'p2', 'p1', 'p3', 'p4', 'p2', 'p5', 'p6']
+        units = [dict(mock_data.mock_observation_units[0], observationLevel=level, observationUnitName=name,
+                      germplasmName=germplasm[k % len(germplasm)] if k != 4 else 'unknown',
+                      treatments=[{'factor': 'water', 'modality': str(k % 3)}])
+                 for k, (name, level) in enumerate(zip(names, ['plot', 'plant'] * 4))]
+
+        def label(node):
+            return node.filename if isinstance(node, DataFile) else node.name
+
+        def convert(partitions):
+            study = Study(filename='s_1.txt', sources=[Source(name=name) for name in germplasm])
+            for level in ('plot', 'plant'):
+                study.assays.append(Assay(filename='a_1_' + level + '.txt'))
+                study.assays[-1].characteristic_categories.append(level)
+            protocols = [Protocol(name=name, protocol_type=OntologyAnnotation(term=name)) for name in ('Growth', 'Phenotyping', 'Data Transformation')]
+            with mock.patch.object(brapi_to_isa, 'PARTITIONS', partitions):
+                brapi_to_isa.create_study_sample_and_assay(None, '1', study, *protocols, units)
+            return ([sample.name for sample in study.samples],
+                    [process.outputs[0].name for process in study.process_sequence],
+                    [[sample.name for sample in assay.samples] for assay in study.assays],
+                    [[label(process.inputs[0]) for process in assay.process_sequence] for assay in study.assays],
+                    [(factor.name, [comment.value for comment in factor.comments]) for factor in study.factors])
+
+        expected = convert(1)
+        assert expected[0] == ['p1', 'p2', 'p3', 'p5', 'p6']
+        for partitions in (2, 3, 8):
+            assert convert(partitions) == expected
+
+    def test_level_data_files_in_processes(self):
+        units = list(compact_obs_units(dict(unit, observationLevel=level, observationUnitName='p' + str(k))
+                                       for k, (unit, level) in enumerate(zip(mock_data.mock_observation_units * 4, ['plot', 'plant'] * 4))))
+        germplasminfo = {g['germplasmDbId']: [g.get('accessionNumber', '')] for g in mock_data.mock_germplasms}
+        variables = [v['name'] for v in mock_data.mock_variables]
+        obs_level, obs_levels = self.converter.get_obs_levels('1', units)
+        units_by_level = ObsUnitsByLevel(units)
+        levels = [(level, units_by_level.of_level(level), variables, germplasminfo, obs_levels, True, 3) for level in obs_level]
+        # the accession numbers of the germplasm are missing
+        levels.append(('plant', units_by_level.of_level('plant'), variables, {}, obs_levels, False, 1))
+
+        expected = brapi_to_isa.map_levels(brapi_to_isa.level_data_files, levels)
+        with mock.patch.object(brapi_to_isa, 'LEVEL_WORKERS', 2):
+            results = brapi_to_isa.map_levels(brapi_to_isa.level_data_files, levels)
+
+        assert [files[0][0] for files in expected[:-1]] == list(obs_level) and isinstance(expected[-1], KeyError)
+        assert results[:-1] == expected[:-1] and isinstance(results[-1], KeyError)
+        assert expected[0][0][1] == self.converter.create_isa_obs_data_from_obsvars(units_by_level.of_level(expected[0][0][0]), variables, expected[0][0][0], germplasminfo, obs_levels, True)[0]
+
     def test_create_isa_characteristic(self):
         category = 'category'
         value = 'value'
@@ -90,6 +289,22 @@ class ConvertTest(unittest.TestCase):
         assert tdf
         assert len(tdf) == len(variables) + 1
 
+    def test_variable_registry(self):
+        self.converter._ontologies = {'to': ['Plant Trait Ontology', 'http://purl.obolibrary.org/obo/to.owl']}
+        # the first variable has a Variable Accession Number, the second one does not
+        variables = [dict(mock_data.mock_variables[0], observationVariableDbId='TO:1'),
+                     dict(mock_data.mock_variables[1], observationVariableDbId='2')]
+
+        first = self.converter.create_isa_tdf_from_obsvars(variables)
+        with mock.patch('brapi_to_isa_converter.re.search') as search:
+            second = self.converter.create_isa_tdf_from_obsvars(list(reversed(variables)))
+
+        assert not search.called
+        assert self.converter.variable_registry.hits == 2
+        assert first[0].split('\t')[2] == 'Variable Accession Number'
+        # as before, the accession numbers are packed at the top of their column
+        assert [line.split('\t')[2] for line in first[1:]] == [line.split('\t')[2] for line in second[1:]] == ['TO:1']
+
     def test_create_data_records(self):
         observation_units = mock_data.mock_observation_units
 
@@ -0,0 +1,107 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+from isatools.model import Study
+
+import brapi_to_isa
+import brapi_workqueue
+from brapi_workqueue import WorkQueue, Worker
+
+ARGV = ['-e', 'http://foo/brapi/v1/', '-t', '1', '-J', '-V']
+
+
+class WorkQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.queue = WorkQueue(os.path.join(self.directory, 'queue.sqlite'), max_attempts=2)
+        self.addCleanup(self.queue.close)
+        self.output_directory = os.path.join(self.directory, 'trial') + os.sep
+        self.queue.enqueue('http://foo/brapi/v1/', {'trialDbId': '1', 'trialName': 'trial', 'studies': []},
+                           ['11', '12'], ARGV, self.output_directory)
+        for name in ('SERVER', 'TRIAL_IDS', 'STUDY_IDS'):
+            patcher = patch.object(brapi_to_isa, name, getattr(brapi_to_isa, name))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(brapi_to_isa.parse_arguments, [])
+
+    def test_enqueue_once(self):
+        added = self.queue.enqueue('http://foo/brapi/v1/', {'trialDbId': '1'}, ['11', '12', '13'], ARGV,
+                                   self.output_directory)
+
+        assert added == 0
+        assert self.queue.status()['pending'] == 2
+
+    def test_expired_lease_is_retried(self):
+        crashed = self.queue.lease('crashed', seconds=-1)
+        retried = self.queue.lease('worker')
+
+        assert crashed['studyDbId'] == retried['studyDbId'] == '11'
+        assert retried['attempts'] == 2
+        assert retried['argv'] == ARGV and retried['output_directory'] == self.output_directory
+        assert not self.queue.renew(crashed)
+        assert not self.queue.complete(crashed, 'part')
+        assert self.queue.complete(retried, 'part')
+        assert self.queue.lease('worker')['studyDbId'] == '12'
+        assert self.queue.status()['done'] == 1
+
+    def test_failed_after_max_attempts(self):
+        for attempt in range(2):
+            item = self.queue.lease('worker')
+            assert item['studyDbId'] == '11'
+            self.queue.fail(item, 'error')
+        self.queue.lease('crashed', seconds=-1)
+        self.queue.lease('crashed', seconds=-1)
+
+        assert self.queue.lease('worker') is None
+        assert self.queue.status()['failed'] == 2
+        trials = self.queue.claim_trials()
+        assert [item['error'] for item in trials[0]['items']] == ['error', 'lease expired']
+        assert self.queue.claim_trials() == []
+
+    def test_trial_is_assembled_once_all_studies_are_converted(self):
+        self.queue.complete(self.queue.lease('worker'), 'part')
+        item = self.queue.lease('worker')
+
+        assert self.queue.claim_trials() == []
+        self.queue.complete(item, 'part')
+        trials = self.queue.claim_trials()
+        assert [trial['trialDbId'] for trial in trials] == ['1']
+        self.queue.release_trial(trials[0])
+        assert len(self.queue.claim_trials()) == 1
+
+    def test_worker(self):
+        def build_study(client, converter, investigation, downloaded):
+            if downloaded == '12':
+                raise ValueError("Study 12 is broken")
+            investigation.studies.append(Study(identifier=downloaded))
+
+        assembled = []
+        with patch.object(brapi_to_isa, 'open_client', MagicMock), \
+                patch.object(brapi_to_isa, 'download_study', lambda client, study_id: study_id), \
+                patch.object(brapi_to_isa, 'build_study', build_study), \
+                patch.object(brapi_to_isa, 'write_study') as write_study, \
+                patch.object(brapi_to_isa, 'dump_investigation',
+                             lambda investigation, output_directory: assembled.append(investigation)), \
+                patch.object(brapi_to_isa, 'convert_and_validate') as convert_and_validate:
+            worker = Worker(self.queue, owner='worker')
+            converted = worker.run()
+            worker.close()
+
+        assert converted == 1
+        assert write_study.call_count == 1
+        assert brapi_to_isa.SERVER == 'http://foo/brapi/v1/'
+        assert [study.identifier for study in assembled[0].studies] == ['11']
+        assert assembled[0].identifier == '1'
+        convert_and_validate.assert_called_once()
+        assert not os.path.exists(os.path.join(self.output_directory, brapi_workqueue.PARTS_DIR))
+        assert self.queue.status() == {'pending': 0, 'leased': 0, 'done': 1, 'failed': 1, 'trials': 1,
+                                       'assembled': 1}
+
+
+if __name__ == '__main__':
+    unittest.main()
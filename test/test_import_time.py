@@ -0,0 +1,54 @@
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules only needed by the conversion stages, they must not be imported by `import brapi_to_isa`
+HEAVY_MODULES = ['isatools', 'isatools.model', 'isatools.isatab', 'isatools.convert', 'pycountry_convert',
+                 'pandas', 'networkx']
+# Generous bound on the cumulative import time of brapi_to_isa, in microseconds
+MAX_IMPORT_TIME = 1500000
+
+
+def import_in_subprocess(module, cwd=ROOT):
+    """Import a module in a fresh interpreter, return the loaded modules and the import time report"""
+    code = f"import sys, {module}; print('\\n'.join(sys.modules))"
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=cwd, env=env,
+                            capture_output=True, text=True, check=True)
+    return result.stdout.split(), result.stderr
+
+
+class ImportTimeTest(unittest.TestCase):
+    """Benchmark of `import brapi_to_isa`, importing the module must stay a cheap library entry point"""
+
+    def test_import_is_lazy(self):
+        modules, _ = import_in_subprocess('brapi_to_isa')
+
+        assert 'brapi_to_isa' in modules
+        loaded = [module for module in HEAVY_MODULES if module in modules]
+        assert not loaded, f"heavy modules imported by brapi_to_isa: {loaded}"
+
+    def test_import_has_no_side_effect(self):
+        with tempfile.TemporaryDirectory() as cwd:
+            _, report = import_in_subprocess('brapi_to_isa', cwd)
+
+            # no argument parsing (it would fail on -c) and no log file created on import
+            assert 'error:' not in report
+            assert not os.listdir(cwd)
+
+    def test_import_time(self):
+        _, report = import_in_subprocess('brapi_to_isa')
+
+        cumulative = [int(match.group(1)) for match in
+                      re.finditer(r'import time:\s+\d+ \|\s+(\d+) \| brapi_to_isa$', report, re.MULTILINE)]
+        assert cumulative, report
+        assert cumulative[0] < MAX_IMPORT_TIME, f"import brapi_to_isa: {cumulative[0] / 1000:.1f} ms"
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import filecmp
+import os
+import shutil
+import tempfile
+import unittest
+
+from isatools import isatab
+from isatools.model import Investigation
+
+import isatab_writer
+from test_brapi_to_isa import detach_growth_processes, study_with_units
+
+
+class IsatabWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_same_files_as_isatab_dump(self):
+        study = study_with_units(200)
+        investigation = Investigation(identifier='1', title='trial')
+        investigation.studies.append(study)
+        expected = os.path.join(self.directory, 'isatools')
+        actual = os.path.join(self.directory, 'builtin')
+        os.makedirs(expected)
+        os.makedirs(actual)
+
+        # the graph as create_study_sample_and_assay builds it
+        isatab_writer.dump(investigation, actual)
+        detach_growth_processes(study)
+        isatab.dump(investigation, expected)
+
+        files = sorted(os.listdir(expected))
+        assert files == ['a_1_plant.txt', 'a_1_plot.txt', 'i_investigation.txt', 's_1.txt']
+        assert sorted(os.listdir(actual)) == files
+        assert filecmp.cmpfiles(expected, actual, files, shallow=False)[0] == files
+
+    def test_headers(self):
+        assert isatab_writer.study_header(['Source Name', 'Source Name.Characteristics[Organism]',
+                                           'Source Name.Characteristics[Organism].Term Source REF', 'Protocol REF.0',
+                                           'Sample Name.0', 'Sample Name.0.Factor Value[water]']) == \
+            ['Source Name', 'Characteristics[Organism]', 'Term Source REF', 'Protocol REF', 'Sample Name',
+             'Factor Value[water]']
+        assert isatab_writer.assay_header(['Sample Name', 'Protocol REF.0', 'Assay Name.0', 'Raw Data File.0',
+                                           'Protocol REF.1', 'Derived Data File.0']) == \
+            ['Sample Name', 'Protocol REF', 'Assay Name', 'Raw Data File', 'Protocol REF', 'Derived Data File']
+
+
+if __name__ == '__main__':
+    unittest.main()
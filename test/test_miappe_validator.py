@@ -0,0 +1,110 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import brapi_calls
+import miappe_validator
+
+CONFIG_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'isaconfig-phenotyping-basic')
+
+INVESTIGATION = """ONTOLOGY SOURCE REFERENCE
+Term Source Name
+INVESTIGATION
+Investigation Identifier\t"1"
+Investigation Title\t""
+INVESTIGATION PUBLICATIONS
+INVESTIGATION CONTACTS
+Investigation Person Last Name\t"Doe"\t""
+STUDY
+Study Identifier\t"1001"
+Study Title\t"A study"
+Study File Name\t"s_study.txt"
+STUDY ASSAYS
+Study Assay File Name\t"a_plot.txt"\t"a_missing.txt"\t"a_pot.txt"
+Study Assay Measurement Type\t"phenotyping"\t"phenotyping"\t"phenotyping"
+Study Assay Technology Type\t"plot level analysis"\t"plot level analysis"\t"unknown level analysis"
+STUDY PROTOCOLS
+Study Protocol Name\t""
+"""
+
+STUDY = """Source Name\tCharacteristics[Organism]\tSample Name\tCharacteristics[Observation Unit Type]
+"g1"\t"Zea mays"\t"p1"\t"plot"
+"g1"\t""\t"p2"\t"plot"
+"""
+
+ASSAY = """Sample Name\tProtocol REF\tAssay Name\tRaw Data File\tDerived Data File\tFactor Value[rep]
+"p1"\t"Phenotyping"\t"p1"\t"NA in endpoint"\t"d_plot.txt"\t"1"
+"p3"\t"Phenotyping"\t"p3"\t"NA in endpoint"\t"d_plot.txt"\t""
+"""
+
+
+class MiappeValidatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        patcher = patch.object(brapi_calls, 'CACHE_DIR', os.path.join(self.directory, 'cache'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.directory)
+        miappe_validator._compiled.clear()
+        for filename, content in (('i_investigation.txt', INVESTIGATION), ('s_study.txt', STUDY),
+                                  ('a_plot.txt', ASSAY), ('a_pot.txt', ASSAY)):
+            with open(os.path.join(self.directory, filename), 'w') as fh:
+                fh.write(content)
+
+    def validate(self, **kwargs):
+        return miappe_validator.validate(os.path.join(self.directory, 'i_investigation.txt'), CONFIG_DIR,
+                                         ignored_files=('NA in endpoint',), **kwargs)
+
+    def test_report_layout(self):
+        report = self.validate()
+
+        assert sorted(report) == ['errors', 'info', 'validation_finished', 'warnings']
+        assert report['validation_finished'] is True
+        for message in report['errors'] + report['warnings']:
+            assert sorted(message) == ['code', 'message', 'supplemental']
+
+    def test_rules(self):
+        report = self.validate()
+
+        errors = [(e['code'], e['supplemental']) for e in report['errors']]
+        assert errors == [
+            (4003, "A property value in Investigation Title of investigation file at column 1 is required"),
+            (4003, "A property value in Investigation Person Last Name of investigation file at column 2 is required"),
+            (4003, "A property value in Study Protocol Name of investigation file at column 1 is required"),
+            (8, "Assay File a_missing.txt does not appear to exist"),
+            (4002, "Measurement phenotyping/technology unknown level analysis, STUDY.0, STUDY ASSAY.2"),
+        ]
+        warnings = [(w['code'], w['supplemental']) for w in report['warnings']]
+        assert warnings == [
+            (4012, "Missing value for the required field 'Characteristics[Organism]' in the file 's_study.txt'"),
+            (7, "Data File d_plot.txt referenced in a_plot.txt does not appear to exist"),
+            (4007, "Missing value for 'Factor Value[rep]' at row 1 in a_plot.txt"),
+            (1003, "p3 is a Sample Name in a_plot.txt, but it is not defined in the Study Sample File s_study.txt."),
+        ]
+
+    def test_parallel_report_is_identical(self):
+        serial = self.validate(workers=1)
+        with patch.object(miappe_validator, 'PARALLEL_MIN_BYTES', 0):
+            parallel = self.validate(workers=2)
+
+        assert parallel == serial
+
+    def test_rules_are_cached(self):
+        self.validate()
+        miappe_validator._compiled.clear()
+        with patch.object(miappe_validator, 'compile_rules') as compile_rules:
+            self.validate()
+        compile_rules.assert_not_called()
+
+    def test_missing_configuration(self):
+        report = miappe_validator.validate(os.path.join(self.directory, 'i_investigation.txt'), self.directory)
+
+        assert report['validation_finished'] is False
+        assert [e['code'] for e in report['errors']] == [4001]
+
+
+if __name__ == '__main__':
+    unittest.main()